@@ -25,10 +25,14 @@ def get_args() -> Args:
     common.add_argument('-d', '--dataset', type=str, metavar="DATASET", dest="dataset_spec")
     common.add_argument('-r', '--recursive', action='store_true')
     common.add_argument('-n', '--dry-run', action='store_true')
+    common.add_argument('--shell-channel', action='store_true')
+    common.add_argument('--snapshot-cache', type=str, metavar="PATH")
     DEFAULTS = dict(
         dataset_spec=None,
         recursive=False,
-        dry_run=False
+        dry_run=False,
+        shell_channel=False,
+        snapshot_cache=None
     )
 
     # create top-level parser
@@ -13,7 +13,7 @@ log = logging.getLogger(__name__)
 
 
 def entrypoint(args: Args) -> None:
-  cli, dataset = get_zfs_cli(args.dataset_spec)
+  cli, dataset = get_zfs_cli(args.dataset_spec, shell_channel=args.shell_channel, snapshot_cache=args.snapshot_cache)
   if dataset is None:
     raise ValueError("No dataset specified")
   
@@ -8,6 +8,7 @@ from .args import Args
 from zfsnappr.common.filter import filter_snaps, parse_tags
 from zfsnappr.common.utils import get_zfs_cli
 from zfsnappr.common.sort import sort_snaps_by_time
+from zfsnappr.common.table import SnapshotTable
 
 
 log = logging.getLogger(__name__)
@@ -23,9 +24,9 @@ class Field:
 # TODO: Use this list output for other subcommands as well
 
 def entrypoint(args: Args) -> None:
-  cli, dataset = get_zfs_cli(args.dataset_spec)
+  cli, dataset = get_zfs_cli(args.dataset_spec, shell_channel=args.shell_channel, snapshot_cache=args.snapshot_cache)
 
-  snaps = cli.get_all_snapshots(datasets=[dataset] if dataset else None, recursive=args.recursive)
+  snaps = SnapshotTable.from_snapshots(cli.iter_snapshots(datasets=[dataset] if dataset else None, recursive=args.recursive))
   snaps = filter_snaps(snaps, tag=parse_tags(args.tag))
   snaps = sort_snaps_by_time(snaps)
 
@@ -31,6 +31,9 @@ class Args(CommonArgs):
   group_by: str
   keep_tag: list[str]
 
+  jobs: int
+  remote_jobs: int
+
 
 COUNT_OPTS = [
   "--keep-last",
@@ -64,5 +67,9 @@ def setup(parser: ArgumentParser) -> None:
   parser.add_argument('--group-by', type=str, metavar='GROUP', choices={'', 'dataset'}, default='dataset')
   parser.add_argument('--keep-tag', type=str, action='append', default=[])
 
+  # parallel destroy
+  parser.add_argument('-j', '--jobs', type=int, metavar='N', default=1, help="destroy the snapshots of up to N datasets in parallel, not supported with --shell-channel")
+  parser.add_argument('--remote-jobs', type=int, metavar='N', default=4)
+
   # filter snapshots by name
   parser.add_argument('snapshot', nargs='*', type=str)
@@ -0,0 +1,91 @@
+from __future__ import annotations
+from collections.abc import Collection
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import CalledProcessError
+import logging
+
+from zfsnappr.common.zfs import Snapshot, ZfsCli, MAX_ARGS_LENGTH, batched_by_length
+from zfsnappr.common.utils import group_snaps_by_dataset
+
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class DestroyResult:
+  destroyed: list[Snapshot] = field(default_factory=list)
+  skipped: list[Snapshot] = field(default_factory=list)
+
+
+def destroy_snapshots_bulk(cli: ZfsCli, snapshots: Collection[Snapshot], jobs: int = 1) -> dict[str, DestroyResult]:
+  """
+  Destroys the given snapshots with as few `zfs destroy` calls as possible.
+  Snapshots are grouped by dataset and destroyed in chunks using the comma syntax.
+  Up to `jobs` datasets are processed at the same time.
+  Returns the result for each dataset. Progress is logged in dataset order, regardless of completion order.
+  Each failure is logged once, when it occurs.
+  """
+  assert jobs >= 1
+  groups = group_snaps_by_dataset(snapshots)
+  results: dict[str, DestroyResult] = {}
+  num_destroyed, num_skipped = 0, 0
+
+  with ThreadPoolExecutor(max_workers=min(jobs, len(groups) or 1)) as executor:
+    futures = {dataset: executor.submit(destroy_dataset_snapshots, cli, dataset, snaps) for dataset, snaps in groups.items()}
+    for dataset, future in futures.items():
+      result = future.result()
+      results[dataset] = result
+      num_destroyed += len(result.destroyed)
+      num_skipped += len(result.skipped)
+      log.info(
+        f"    '{dataset}': {len(result.destroyed)} destroyed, {len(result.skipped)} skipped"
+        f" ({num_destroyed}/{len(snapshots)} destroyed, {num_skipped} skipped in total)"
+      )
+  return results
+
+
+def destroy_dataset_snapshots(cli: ZfsCli, dataset: str, snapshots: Collection[Snapshot]) -> DestroyResult:
+  """Destroys snapshots of a single dataset. Snapshots that cannot be destroyed are skipped."""
+  by_shortname = {s.shortname: s for s in snapshots}
+  assert all(s.dataset == dataset for s in snapshots)
+
+  result = DestroyResult()
+  # the destroy argument has the form 'dataset@snap1,snap2,...'
+  max_length = MAX_ARGS_LENGTH - len(dataset) - 1
+  for chunk in batched_by_length(by_shortname.keys(), max_length):
+    _destroy_chunk(cli, dataset, [by_shortname[n] for n in chunk], result)
+  return result
+
+
+def _destroy_chunk(cli: ZfsCli, dataset: str, snapshots: list[Snapshot], result: DestroyResult) -> None:
+  """
+  Destroying multiple snapshots is atomic, i.e. a single held or busy snapshot makes the whole call fail.
+  In that case, the chunk is bisected so that only the offending snapshots are skipped.
+  Other errors, e.g. a lost connection or missing permissions, are not specific to a snapshot, so the whole chunk is skipped.
+  """
+  try:
+    cli.destroy_snapshots(dataset, [s.shortname for s in snapshots])
+  except CalledProcessError as e:
+    reason = (e.stderr or '').strip() or str(e)
+    if len(snapshots) == 1 or not _is_snapshot_error(e):
+      what = f"snapshot '{snapshots[0].shortname}'" if len(snapshots) == 1 else f"{len(snapshots)} snapshots"
+      log.warning(f"Failed to destroy {what} on '{dataset}': {reason}")
+      result.skipped += snapshots
+      return
+    log.debug(f"Failed to destroy {len(snapshots)} snapshots on '{dataset}', bisecting: {reason}")
+    mid = len(snapshots) // 2
+    _destroy_chunk(cli, dataset, snapshots[:mid], result)
+    _destroy_chunk(cli, dataset, snapshots[mid:], result)
+  else:
+    result.destroyed += snapshots
+
+
+# `zfs destroy` errors that are caused by individual snapshots
+_SNAPSHOT_ERRORS = ('busy', 'held', 'dependent clones')
+
+def _is_snapshot_error(error: CalledProcessError) -> bool:
+  if not error.stderr:
+    # cannot tell, so bisect to be safe
+    return True
+  return any(msg in error.stderr for msg in _SNAPSHOT_ERRORS)
@@ -6,6 +6,7 @@ from zfsnappr.common.zfs import ZfsProperty
 from zfsnappr.common import filter
 from zfsnappr.common.utils import get_zfs_cli
 from zfsnappr.common.sort import sort_snaps_by_time
+from zfsnappr.common.table import SnapshotTable
 
 from .policy import KeepPolicy
 from .prune_snaps import prune_snapshots
@@ -37,11 +38,19 @@ def entrypoint(args: Args):
     tags = frozenset(args.keep_tag)
   )
 
-  cli, dataset = get_zfs_cli(args.dataset_spec)
+  cli, dataset = get_zfs_cli(args.dataset_spec, shell_channel=args.shell_channel, snapshot_cache=args.snapshot_cache)
   if dataset is None:
     raise ValueError(f"No dataset specified")
 
-  snaps = cli.get_all_snapshots(datasets=[dataset], recursive=args.recursive)
+  # remote targets have a separate limit, since each job holds an ssh connection
+  jobs = min(args.jobs, args.remote_jobs) if cli.is_remote else args.jobs
+  if jobs < 1:
+    raise ValueError(f"Number of jobs must be at least 1")
+  if jobs > 1 and args.shell_channel:
+    # all commands go through the single shell of the channel, so destroys would not run in parallel
+    raise ValueError(f"--jobs is not supported with --shell-channel")
+
+  snaps = SnapshotTable.from_snapshots(cli.iter_snapshots(datasets=[dataset], recursive=args.recursive))
   snaps = filter.filter_snaps(snaps, tag=filter.parse_tags(args.tag), shortname=filter.parse_shortnames(args.snapshot))
   snaps = sort_snaps_by_time(snaps)
   if not snaps:
@@ -58,6 +67,7 @@ def entrypoint(args: Args):
     snaps,
     policy,
     dry_run=args.dry_run,
+    jobs=jobs,
     group_by=get_grouptype[args.group_by],
     allow_destroy_all=bool(args.snapshot)  # only allow if specific snapshots were passed
   )
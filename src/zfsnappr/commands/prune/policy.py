@@ -108,9 +108,11 @@ def year_bucket(date: datetime) -> int:
 Returns tuple (keep, destroy)
 Keeps snapshot ordering intact
 """
-def apply_policy(snapshots: Collection[Snapshot], policy: KeepPolicy) -> tuple[list[Snapshot], list[Snapshot]]:
+def apply_policy(snapshots: Collection[Snapshot], policy: KeepPolicy, now: Optional[datetime] = None) -> tuple[list[Snapshot], list[Snapshot]]:
   # all snapshots, sorted from latest to oldest. Sorting is important for the algorithm to work correctly.
   snaps = sort_snaps_by_time(snapshots, reverse=True)
+  if now is None:
+    now = datetime.now()
   keep: set[Snapshot] = set()
   destroy: set[Snapshot] = set()
   
@@ -162,7 +164,6 @@ def apply_policy(snapshots: Collection[Snapshot], policy: KeepPolicy) -> tuple[l
           bucket.count -= 1
 
     # keep duration-based
-    now = datetime.now()
     for bucket in buckets_within:
       if snap.timestamp <= now - bucket.within:
         # snap too old
@@ -1,12 +1,13 @@
 from typing import Optional, Any
 from collections.abc import Collection
-from subprocess import CalledProcessError
 import logging
 
 from zfsnappr.common.zfs import Snapshot, ZfsCli
-from .policy import apply_policy, KeepPolicy
-from zfsnappr.common.utils import group_snaps_by
+from .policy import KeepPolicy
+from .vectorized_policy import apply_policy_vectorized
+from zfsnappr.common.utils import group_snaps_by, group_snaps_by_dataset
 from .grouping import GroupType, GET_GROUP
+from .bulk_destroy import destroy_snapshots_bulk
 
 
 log = logging.getLogger(__name__)
@@ -19,23 +20,24 @@ def prune_snapshots(
   *,
   group_by: Optional[GroupType] = GroupType.DATASET,
   dry_run: bool = True,
-  allow_destroy_all: bool = False
+  allow_destroy_all: bool = False,
+  jobs: int = 1
 ) -> None:
   """
   Prune given snapshots according to keep policy
   """
   if group_by is None:
     log.info(f'Pruning {len(snapshots)} snapshots without grouping')
-    keep, destroy = apply_policy(snapshots, policy)
+    keep, destroy = apply_policy_vectorized(snapshots, policy)
     print_policy_result(keep, destroy, group=None, group_by=None)
   else:
     log.info(f'Pruning {len(snapshots)} snapshots, grouped by {group_by.value}')
     # group the snapshots. Result is a dict with group name as key and set of snaps as value
-    groups = group_snaps_by(snapshots, GET_GROUP[group_by])
+    groups = group_snaps_by_dataset(snapshots) if group_by == GroupType.DATASET else group_snaps_by(snapshots, GET_GROUP[group_by])
     keep: list[Snapshot] = []
     destroy: list[Snapshot] = []
     for _group, _snaps in groups.items():
-      _keep, _destroy = apply_policy(_snaps, policy)
+      _keep, _destroy = apply_policy_vectorized(_snaps, policy)
       keep += _keep
       destroy += _destroy
       print_policy_result(_keep, _destroy, group=_group, group_by=group_by)
@@ -49,16 +51,8 @@ def prune_snapshots(
     log.info("Dry-run enabled, not destroying any snapshots")
     return
 
-  log.info(f'Destroying...')
-  _num_destroyed, _num_skipped = 0, 0
-  for snap in destroy:
-    try:
-      cli.destroy_snapshots(snap.dataset, [snap.shortname])
-      _num_destroyed += 1
-    except CalledProcessError:
-      log.warning(f"Failed to destroy snapshot '{snap.shortname}' on '{snap.dataset}'")
-      _num_skipped += 1
-    log.info(f"    {_num_destroyed}/{len(destroy)} destroyed ({_num_skipped} skipped)")
+  log.info(f'Destroying...' if jobs == 1 else f'Destroying with {jobs} parallel jobs...')
+  destroy_snapshots_bulk(cli, destroy, jobs=jobs)
 
 
 def print_policy_result(keep: Collection[Snapshot], destroy: Collection[Snapshot], *, group: str | None = None, group_by: GroupType | None = None):
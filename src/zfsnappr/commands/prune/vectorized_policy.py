@@ -0,0 +1,157 @@
+from __future__ import annotations
+from typing import Optional, Any
+from collections.abc import Collection
+from datetime import datetime, timedelta
+import time
+import logging
+
+from zfsnappr.common.zfs import Snapshot
+from zfsnappr.common.table import SnapshotTable, has_numpy
+from .policy import KeepPolicy, apply_policy
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+
+log = logging.getLogger(__name__)
+
+_EPOCH = datetime(1970, 1, 1)
+_QUARTER_HOUR = 900
+
+
+def apply_policy_vectorized(snapshots: Collection[Snapshot], policy: KeepPolicy, now: Optional[datetime] = None) -> tuple[list[Snapshot], list[Snapshot]]:
+  """
+  Same as `apply_policy`, but computes the bucket keys of all snapshots at once from their creation epochs
+  and finds the first snapshot of each bucket with array operations. Falls back to `apply_policy` without NumPy.
+
+  Returns tuple (keep, destroy)
+  Keeps snapshot ordering intact
+  """
+  if not has_numpy():
+    return apply_policy(snapshots, policy, now=now)
+  assert np is not None
+  if now is None:
+    now = datetime.now()
+
+  table = snapshots if isinstance(snapshots, SnapshotTable) else SnapshotTable.from_snapshots(snapshots)
+  n = len(table)
+  if n == 0:
+    return [], []
+
+  # all snapshots, sorted from latest to oldest
+  order = np.asarray(table.argsort_by_time(reverse=True), dtype=np.intp)
+  rows = [table.rows[i] for i in order.tolist()]
+  local = _local_seconds(table.epoch[order])
+  keep = np.zeros(n, dtype=bool)
+
+  # keep matching name
+  if policy.name is not None:
+    name = policy.name
+    keep |= np.fromiter((name.fullmatch(s.shortname) is not None for s in rows), dtype=bool, count=n)
+
+  # keep matching tag
+  if policy.tags:
+    unset = np.array([t is None for t in table.tagsets], dtype=bool)[table.tagset_id[order]]
+    for i in np.flatnonzero(unset).tolist():
+      log.warning(f"Snapshot {rows[i].longname} was created externally and will be kept regardless of keep-tag policy")
+    matches = np.array([t is not None and not policy.tags.isdisjoint(t) for t in table.tagsets], dtype=bool)
+    keep |= unset | matches[table.tagset_id[order]]
+
+  keys = _bucket_keys(local)
+
+  # keep count-based
+  for count, key in zip(
+    [policy.last, policy.hourly, policy.daily, policy.weekly, policy.monthly, policy.yearly],
+    keys
+  ):
+    if count == 0:
+      continue
+    starts = _run_starts(key) if key is not None else np.ones(n, dtype=bool)
+    if count > 0:
+      # bucket is exhausted after `count` distinct values
+      starts &= np.cumsum(starts) <= count
+    keep |= starts
+
+  # keep duration-based. Snapshots that are too old are skipped, i.e. they do not end a bucket run.
+  local_us = local * 1_000_000
+  for within, key in zip(
+    [policy.within, policy.within_hourly, policy.within_daily, policy.within_weekly, policy.within_monthly, policy.within_yearly],
+    keys
+  ):
+    threshold_us = (now - within - _EPOCH) // timedelta(microseconds=1)
+    candidates = np.flatnonzero(local_us > threshold_us)
+    if key is None:
+      keep[candidates] = True
+    else:
+      keep[candidates[_run_starts(key[candidates])]] = True
+
+  # map back to input order
+  keep_ids = {id(rows[i]) for i in np.flatnonzero(keep).tolist()}
+  return [s for s in snapshots if id(s) in keep_ids], [s for s in snapshots if id(s) not in keep_ids]
+
+
+def _run_starts(values: Any) -> Any:
+  """Marks the first element of each run of equal values"""
+  starts = np.empty(len(values), dtype=bool)
+  if len(values):
+    starts[0] = True
+    np.not_equal(values[1:], values[:-1], out=starts[1:])
+  return starts
+
+
+def _local_seconds(epoch: Any) -> Any:
+  """
+  Converts epoch seconds to seconds since 1970-01-01 in local wall time, like `datetime.fromtimestamp`.
+  UTC offsets are looked up once per quarter hour, since offsets only change on quarter hour boundaries.
+  Quarter hours with differing offsets at start and end are resolved per snapshot.
+  """
+  blocks, inverse = np.unique(epoch // _QUARTER_HOUR, return_inverse=True)
+  offsets = np.empty(len(blocks), dtype=np.int64)
+  irregular = np.zeros(len(blocks), dtype=bool)
+  for i, block in enumerate(blocks.tolist()):
+    start = block * _QUARTER_HOUR
+    offsets[i] = time.localtime(start).tm_gmtoff
+    irregular[i] = offsets[i] != time.localtime(start + _QUARTER_HOUR - 1).tm_gmtoff
+
+  result = epoch + offsets[inverse]
+  for i in np.flatnonzero(irregular[inverse]).tolist():
+    result[i] = epoch[i] + time.localtime(int(epoch[i])).tm_gmtoff
+  return result
+
+
+def _bucket_keys(local: Any) -> list[Any]:
+  """
+  Bucket keys for last, hourly, daily, weekly, monthly and yearly buckets, in that order.
+  `None` stands for the unique bucket. Keys are equal iff the corresponding keys of `policy.py` are equal.
+  """
+  days = local // 86400
+  year, month = _civil_from_days(days)
+
+  # ISO weeks are identified by their thursday
+  weekday = (days + 3) % 7  # 1970-01-01 was a thursday; monday is 0
+  thursday = days - weekday + 3
+
+  return [
+    None,
+    local // 3600,
+    days,
+    thursday,
+    year * 12 + month,
+    year
+  ]
+
+
+def _civil_from_days(days: Any) -> tuple[Any, Any]:
+  """Year and month of days since 1970-01-01 in the proleptic Gregorian calendar"""
+  # see https://howardhinnant.github.io/date_algorithms.html#civil_from_days
+  z = days + 719468
+  era = z // 146097
+  doe = z - era * 146097
+  yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+  doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+  mp = (5 * doy + 2) // 153
+  month = np.where(mp < 10, mp + 3, mp - 9)
+  year = yoe + era * 400 + (month <= 2)
+  return year, month
@@ -1,9 +1,12 @@
 from __future__ import annotations
 from dataclasses import dataclass
-from typing import Optional, Protocol
-from argparse import ArgumentParser
+from typing import Optional, Protocol, IO, Literal
+from argparse import ArgumentParser, FileType
 
 from zfsnappr.common.args import CommonArgs
+from zfsnappr.common.replication.options import parse_send_flags, parse_size, parse_percentage, SEND_FLAGS
+from zfsnappr.common.replication.compression import parse_compression, CODECS
+from zfsnappr.common.replication.ratelimit import parse_schedule, RateSchedule
 
 
 class Args(CommonArgs):
@@ -11,6 +14,23 @@ class Args(CommonArgs):
   init: bool
   rollback: bool
   exclude_dataset: list[str]
+  jobs: int
+  order: Literal['smallest', 'largest'] | None
+  estimate: bool
+  hold_window: int
+  single_stream: bool
+  recursive_stream: bool
+  send_flags: str | None
+  buffer: int
+  buffer_high: float
+  buffer_low: float
+  compress: tuple[str, int | None] | None
+  resumable: bool
+  abort_partial: bool
+  rate_limit: RateSchedule | None
+  progress_json: IO[str] | None
+  save_plan: str | None
+  apply_plan: IO[str] | None
 
 
 def setup(parser: ArgumentParser) -> None:
@@ -18,3 +38,20 @@ def setup(parser: ArgumentParser) -> None:
   parser.add_argument('--init', action='store_true')
   parser.add_argument('--rollback', action='store_true')
   parser.add_argument('--exclude-dataset', action='append', default=[])
+  parser.add_argument('-j', '--jobs', type=int, metavar='N', default=1)
+  parser.add_argument('--order', choices=['smallest', 'largest'], help="replicate datasets with the smallest or largest estimated transfer first")
+  parser.add_argument('--estimate', action='store_true', help="estimate and log the transfer size of each dataset before sending")
+  parser.add_argument('--single-stream', action='store_true')
+  parser.add_argument('--recursive-stream', action='store_true')
+  parser.add_argument('--send-flags', type=parse_send_flags, metavar='auto|FLAGS', help=f"'auto' or any of '{SEND_FLAGS}'")
+  parser.add_argument('--buffer', type=parse_size, metavar='SIZE', default=0, help="in-memory stream buffer, e.g. '256M'")
+  parser.add_argument('--buffer-high', type=parse_percentage, metavar='PCT', default=0, help="start draining an empty buffer at this fill level")
+  parser.add_argument('--buffer-low', type=parse_percentage, metavar='PCT', default=1, help="resume filling a full buffer at this fill level")
+  parser.add_argument('--compress', type=parse_compression, metavar='CODEC[:LEVEL]', help=f"compress the stream between hosts with one of {', '.join(CODECS)}")
+  parser.add_argument('--no-resume', action='store_false', dest='resumable', help="do not receive with -s")
+  parser.add_argument('--hold-window', type=int, metavar='N', default=1, help="update tags and holds once every N incremental transfers")
+  parser.add_argument('--abort-partial', action='store_true', help="discard partially received state instead of resuming it")
+  parser.add_argument('--rate-limit', type=parse_schedule, metavar='SCHEDULE', help="e.g. '50Mbit,22:00-06:00=unlimited'")
+  parser.add_argument('--progress-json', type=FileType('w'), metavar='FILE', help="write progress and throughput as JSON lines to FILE, or '-' for stdout")
+  parser.add_argument('--save-plan', metavar='FILE', help="with -n, write the transfer plan as JSON to FILE, or '-' for stdout")
+  parser.add_argument('--apply-plan', type=FileType('r'), metavar='FILE', help="execute a transfer plan written by --save-plan")
@@ -2,6 +2,12 @@ from __future__ import annotations
 import logging
 
 from zfsnappr.common.replication import replicate
+from zfsnappr.common.replication.options import TransferOptions
+from zfsnappr.common.replication.ratelimit import RateLimiter
+from zfsnappr.common.replication.progress import ProgressReporter
+from zfsnappr.common.replication.plan import TransferPlan, build_plan, apply_plan, log_plan
+from zfsnappr.common.replication.replicate_fanout import replicate_fanout
+from zfsnappr.common.zfs import ZfsCli
 from zfsnappr.common.utils import get_zfs_cli
 from .args import Args
 
@@ -10,16 +16,98 @@ log = logging.getLogger(__name__)
 
 
 def entrypoint(args: Args) -> None:
-  source_cli, source_dataset = get_zfs_cli(args.dataset_spec)
+  source_cli, source_dataset = get_zfs_cli(args.dataset_spec, shell_channel=args.shell_channel, snapshot_cache=args.snapshot_cache)
   if source_dataset is None:
     raise ValueError(f"No dataset specified")
 
-  dest_cli, dest_dataset = get_zfs_cli(args.dest)
-  if dest_dataset is None:
-    raise ValueError(f"No dest dataset specified")
+  dests: list[tuple[ZfsCli, str]] = []
+  for spec in args.dest:
+    dest_cli, dest_dataset = get_zfs_cli(spec, shell_channel=args.shell_channel, snapshot_cache=args.snapshot_cache)
+    if dest_dataset is None:
+      raise ValueError(f"No dest dataset specified")
+    dests.append((dest_cli, dest_dataset))
+  dest_cli, dest_dataset = dests[0]
+  if len(dests) > 1:
+    for option, unsupported in [('-n', args.dry_run), ('--apply-plan', args.apply_plan), ('--recursive-stream', args.recursive_stream), ('--single-stream', args.single_stream), ('--compress', args.compress), ('--jobs', args.jobs != 1), ('--order', args.order), ('--estimate', args.estimate)]:
+      if unsupported:
+        raise ValueError(f"{option} is not supported with multiple destinations")
+
+  dest_limiters: list[tuple[RateLimiter, ...]] = [() for _ in dests]
+  for spec, schedule in args.dest_rate_limit:
+    if spec not in args.dest:
+      raise ValueError(f"Rate limited destination '{spec}' is not a destination")
+    i = args.dest.index(spec)
+    dest_limiters[i] += (RateLimiter(schedule, name=spec),)
+
+  if args.jobs < 1:
+    raise ValueError(f"Number of jobs must be at least 1")
+  if args.hold_window < 1:
+    raise ValueError(f"Hold window must be at least 1")
+  if args.save_plan is not None and not args.dry_run:
+    raise ValueError(f"--save-plan requires -n")
+  if args.apply_plan is not None:
+    for option, unsupported in [('--jobs', args.jobs != 1), ('--order', args.order)]:
+      if unsupported:
+        raise ValueError(f"{option} is not supported with --apply-plan")
 
   prefix = "Recursively pushing" if args.recursive else "Pushing"
-  log.info(prefix + f' from source "{source_dataset}" to dest "{dest_dataset}"')
+  log.info(prefix + f' from source "{source_dataset}" to dest ' + ', '.join(f'"{ds}"' for _, ds in dests))
+
+  options = TransferOptions(
+    single_stream=args.single_stream,
+    recursive_stream=args.recursive_stream,
+    send_flags=args.send_flags,
+    buffer_size=args.buffer,
+    buffer_high=args.buffer_high,
+    buffer_low=args.buffer_low,
+    compression=args.compress[0] if args.compress else None,
+    compression_level=args.compress[1] if args.compress else None,
+    resumable=args.resumable,
+    abort_partial=args.abort_partial,
+    estimate=args.estimate,
+    hold_window=args.hold_window,
+    # with a single destination, its limiters apply to the whole pipeline
+    rate_limiters=((RateLimiter(args.rate_limit),) if args.rate_limit else ()) + (dest_limiters[0] if len(dests) == 1 else ()),
+    progress=ProgressReporter(args.progress_json)
+  )
+
+  if len(dests) > 1:
+    replicate_fanout(
+      source_cli=source_cli,
+      source_dataset=source_dataset,
+      dests=dests,
+      recursive=args.recursive,
+      initialize=args.init,
+      rollback=args.rollback,
+      exclude_datasets=args.exclude_dataset,
+      dest_limiters=dest_limiters,
+      options=options
+    )
+    return
+
+  if args.apply_plan is not None:
+    plan = TransferPlan.load(args.apply_plan)
+    if (plan.source_dataset, plan.dest_dataset, plan.recursive) != (source_dataset, dest_dataset, args.recursive):
+      raise ValueError(f"Plan is for '{plan.source_dataset}' -> '{plan.dest_dataset}'{' recursively' if plan.recursive else ''}, which does not match the arguments")
+    log.info(f"Applying plan created at {plan.created}")
+    apply_plan(plan, source_cli, dest_cli, rollback=args.rollback, options=options)
+    return
+
+  if args.dry_run:
+    plan = build_plan(
+      source_cli,
+      source_dataset,
+      dest_cli,
+      dest_dataset,
+      recursive=args.recursive,
+      initialize=args.init,
+      exclude_datasets=args.exclude_dataset,
+      options=options
+    )
+    log_plan(plan)
+    if args.save_plan is not None:
+      plan.save(args.save_plan)
+    return
 
   replicate(
     source_cli=source_cli,
@@ -29,5 +117,8 @@ def entrypoint(args: Args) -> None:
     recursive=args.recursive,
     initialize=args.init,
     rollback=args.rollback,
-    exclude_datasets=args.exclude_dataset
+    exclude_datasets=args.exclude_dataset,
+    jobs=args.jobs,
+    order=args.order,
+    options=options
   )
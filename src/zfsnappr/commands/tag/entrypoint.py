@@ -14,7 +14,7 @@ TAG_SEPARATOR = "_"
 
 
 def entrypoint(args: Args) -> None:
-  cli, dataset = get_zfs_cli(args.dataset_spec)
+  cli, dataset = get_zfs_cli(args.dataset_spec, shell_channel=args.shell_channel, snapshot_cache=args.snapshot_cache)
   if dataset is None:
     raise ValueError(f"No dataset specified")
 
@@ -50,7 +50,7 @@ def entrypoint(args: Args) -> None:
 
   # --- get snapshots ---
   props = [p for p in [args.add_from_prop, args.set_from_prop] if p is not None]
-  _all_snaps = cli.get_all_snapshots(datasets=[dataset], recursive=args.recursive, properties=props)
+  _all_snaps = cli.iter_snapshots(datasets=[dataset], recursive=args.recursive, properties=props)
   snapshots = filter.filter_snaps(_all_snaps, tag=filter.parse_tags(args.tag), shortname=filter.parse_shortnames(args.snapshot))
   if not snapshots:
     log.info(f"No matching snapshots, nothing to do")
@@ -58,6 +58,8 @@ def entrypoint(args: Args) -> None:
 
   # --- apply tag operations ---
   # SET sets the tags even if no new tags were found, while ADD and REMOVE leave the tags potentially unset, i.e. as None
+  batch = cli.batch()
+  retagged: set[str] = set()
   for snap in snapshots:
     for get_tags, action in operations:
       tags = snap.tags
@@ -72,7 +74,12 @@ def entrypoint(args: Args) -> None:
 
       # apply tag changes
       if tags != snap.tags and tags is not None:
-        cli.set_tags(snap.longname, tags)
+        batch.set_tags(snap.longname, tags)
+        retagged.add(snap.longname)
+
+  # apply all changes at once
+  log.info(f"Updating tags of {len(retagged)} snapshots")
+  batch.run()
 
 
 def get_from_prop(snap: Snapshot, property: str) -> Optional[set[str]]:
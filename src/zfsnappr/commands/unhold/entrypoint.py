@@ -15,11 +15,12 @@ log = logging.getLogger(__name__)
 
 
 def entrypoint(args: Args) -> None:
-  cli, dataset = get_zfs_cli(args.dataset_spec)
+  cli, dataset = get_zfs_cli(args.dataset_spec, shell_channel=args.shell_channel, snapshot_cache=args.snapshot_cache)
   if dataset is None:
     raise ValueError(f"No dataset specified")
 
-  snaps = cli.get_all_snapshots(datasets=[dataset], recursive=args.recursive)
+  # the holds count of cached snapshots may be outdated
+  snaps = cli.iter_snapshots(datasets=[dataset], recursive=args.recursive, cached=False)
   snaps = filter_snaps(snaps, shortname=args.snapshot)
   snaps = sort_snaps_by_time(snaps)
   if not snaps:
@@ -6,3 +6,5 @@ class CommonArgs(Protocol):
   dataset_spec: str | None
   recursive: bool
   dry_run: bool
+  shell_channel: bool
+  snapshot_cache: str | None
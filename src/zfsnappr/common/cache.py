@@ -0,0 +1,80 @@
+from __future__ import annotations
+from typing import Optional
+from collections.abc import Collection
+import sqlite3
+import threading
+import logging
+import atexit
+
+
+log = logging.getLogger(__name__)
+
+
+class SnapshotCache:
+  """
+  Persistent cache for snapshot listings, stored in an SQLite database.
+  Entries are keyed by pool GUID and dataset GUID and store the raw `zfs list` rows of a dataset,
+  together with the dataset's `snapshots_changed` value at the time of listing.
+  An entry is only valid as long as the dataset name and `snapshots_changed` are unchanged.
+  The database is closed on exit, or by `close`.
+
+  `snapshots_changed` does not change when holds or user properties are modified. Such changes made by
+  zfsnappr itself invalidate the affected entries, changes made by other tools are not detected.
+  Therefore, replication and `unhold` bypass the cache, since they act on holds counts and tags.
+  """
+  path: str
+
+  def __init__(self, path: str) -> None:
+    self.path = path
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self._conn.execute('PRAGMA journal_mode=WAL')
+    self._conn.execute(
+      'CREATE TABLE IF NOT EXISTS datasets ('
+      '  pool_guid TEXT NOT NULL,'
+      '  dataset_guid TEXT NOT NULL,'
+      '  name TEXT NOT NULL,'
+      '  snapshots_changed TEXT NOT NULL,'
+      '  rows TEXT NOT NULL,'
+      '  PRIMARY KEY (pool_guid, dataset_guid)'
+      ')'
+    )
+    self._conn.execute('CREATE INDEX IF NOT EXISTS datasets_name ON datasets (name)')
+    atexit.register(self.close)
+
+  def get(self, pool_guid: int, dataset_guid: int, name: str, snapshots_changed: str) -> Optional[list[str]]:
+    """Returns the cached rows, or None if there is no valid entry"""
+    with self._lock:
+      row = self._conn.execute(
+        'SELECT name, snapshots_changed, rows FROM datasets WHERE pool_guid = ? AND dataset_guid = ?',
+        (str(pool_guid), str(dataset_guid))
+      ).fetchone()
+    if row is None or row[0] != name or row[1] != snapshots_changed:
+      return None
+    return row[2].splitlines()
+
+  def put(self, pool_guid: int, dataset_guid: int, name: str, snapshots_changed: str, rows: Collection[str]) -> None:
+    with self._lock:
+      self._conn.execute(
+        'INSERT OR REPLACE INTO datasets (pool_guid, dataset_guid, name, snapshots_changed, rows) VALUES (?, ?, ?, ?, ?)',
+        (str(pool_guid), str(dataset_guid), name, snapshots_changed, '\n'.join(rows))
+      )
+
+  def invalidate(self, datasets: Collection[str], recursive: bool = False) -> None:
+    """Removes the entries of the given datasets, and optionally of all their descendants"""
+    if not datasets:
+      return
+    with self._lock:
+      for name in datasets:
+        log.debug(f"Invalidating cached snapshots of '{name}'")
+        if recursive:
+          # escape LIKE wildcards in the dataset name
+          pattern = name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '/%'
+          self._conn.execute("DELETE FROM datasets WHERE name = ? OR name LIKE ? ESCAPE '\\'", (name, pattern))
+        else:
+          self._conn.execute('DELETE FROM datasets WHERE name = ?', (name,))
+
+  def close(self) -> None:
+    with self._lock:
+      self._conn.close()
+    atexit.unregister(self.close)
@@ -1,7 +1,8 @@
-from typing import Callable, Optional, Literal
-from collections.abc import Collection
+from typing import Callable, Optional, Literal, overload
+from collections.abc import Collection, Iterable
 
 from .zfs import Snapshot
+from .table import SnapshotTable
 
 
 def parse_tags(tags: Collection[str]) -> Optional[set[frozenset[str]]]:
@@ -14,31 +15,53 @@ def parse_shortnames(shortnames: Collection[str]) -> Optional[set[str]]:
     return None
   return set(shortnames)
 
+def match_tags(tags: Optional[Collection[str]], tag: Collection[Collection[str]]) -> bool:
+  """Snapshot tags match iff they contain all the tags of one of the groups in `tag`"""
+  for tag_group in tag:
+    tag_group = set(tag_group)
+    # normal case: snap has all group tags
+    if tags is not None and tags >= tag_group:
+      return True
+    # snap tags are unset and group contains UNSET
+    if tags is None and len(tag_group) == 1 and next(iter(tag_group)) == 'UNSET':
+      return True
+    # snap tags are empty and group contains empty tag
+    if tags == set() and len(tag_group) == 1 and next(iter(tag_group)) == '':
+      return True
+  return False
+
+@overload
 def filter_snaps(
-  snapshots: Collection[Snapshot],
+  snapshots: SnapshotTable,
   *,
   tag: Optional[Collection[Collection[str]]] = None,
   dataset: Optional[Collection[str]] = None,
   shortname: Optional[Collection[str]] = None
-) -> list[Snapshot]:
+) -> SnapshotTable: ...
+@overload
+def filter_snaps(
+  snapshots: Iterable[Snapshot],
+  *,
+  tag: Optional[Collection[Collection[str]]] = None,
+  dataset: Optional[Collection[str]] = None,
+  shortname: Optional[Collection[str]] = None
+) -> list[Snapshot]: ...
+def filter_snaps(
+  snapshots: Iterable[Snapshot],
+  *,
+  tag: Optional[Collection[Collection[str]]] = None,
+  dataset: Optional[Collection[str]] = None,
+  shortname: Optional[Collection[str]] = None
+) -> list[Snapshot] | SnapshotTable:
+  if isinstance(snapshots, SnapshotTable):
+    return _filter_table(snapshots, tag=tag, dataset=dataset, shortname=shortname)
+
   filtered_snaps = []
   for snap in snapshots:
     keep = True
 
-    # snap is included iff it has all the tags of one of the groups in "tag"
     if tag is not None:
-      for tag_group in tag:
-        tag_group = set(tag_group)
-        # normal case: snap has all group tags
-        if snap.tags is not None and snap.tags >= tag_group:
-          break
-        # snap tags are unset and group contains UNSET
-        if snap.tags is None and len(tag_group) == 1 and next(iter(tag_group)) == 'UNSET':
-          break
-        # snap tags are empty and group contains empty tag
-        if snap.tags == set() and len(tag_group) == 1 and next(iter(tag_group)) == '':
-          break
-      else:
+      if not match_tags(snap.tags, tag):
         keep = False
 
     if dataset is not None:
@@ -53,3 +76,19 @@ def filter_snaps(
       filtered_snaps.append(snap)
 
   return filtered_snaps
+
+def _filter_table(
+  table: SnapshotTable,
+  *,
+  tag: Optional[Collection[Collection[str]]] = None,
+  dataset: Optional[Collection[str]] = None,
+  shortname: Optional[Collection[str]] = None
+) -> SnapshotTable:
+  masks = []
+  if tag is not None:
+    masks.append(table.mask_tagsets(lambda t: match_tags(t, tag)))
+  if dataset is not None:
+    masks.append(table.mask_datasets(dataset))
+  if shortname is not None:
+    masks.append(table.mask_shortnames(shortname))
+  return table.filter(*masks)
@@ -0,0 +1,167 @@
+from __future__ import annotations
+from typing import Optional, Callable
+from dataclasses import dataclass
+from weakref import WeakKeyDictionary
+import threading
+import shutil
+import logging
+import zlib
+import lzma
+
+from ..zfs import ZfsCli
+from .stream import Transform
+
+
+log = logging.getLogger(__name__)
+
+
+class _ZlibCompress:
+  def __init__(self, level: int) -> None:
+    # gzip format, so that `gzip -d` can decompress it
+    self._obj = zlib.compressobj(level, wbits=31)
+
+  def process(self, data: bytes) -> bytes:
+    return self._obj.compress(data)
+
+  def flush(self) -> bytes:
+    return self._obj.flush()
+
+
+class _ZlibDecompress:
+  def __init__(self) -> None:
+    self._obj = zlib.decompressobj(wbits=31)
+
+  def process(self, data: bytes) -> bytes:
+    return self._obj.decompress(data)
+
+  def flush(self) -> bytes:
+    if not self._obj.eof:
+      raise zlib.error("Compressed stream ended unexpectedly")
+    return self._obj.flush()
+
+
+class _LzmaCompress:
+  def __init__(self, level: int) -> None:
+    self._obj = lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=level)
+
+  def process(self, data: bytes) -> bytes:
+    return self._obj.compress(data)
+
+  def flush(self) -> bytes:
+    return self._obj.flush()
+
+
+class _LzmaDecompress:
+  def __init__(self) -> None:
+    self._obj = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+
+  def process(self, data: bytes) -> bytes:
+    return self._obj.decompress(data)
+
+  def flush(self) -> bytes:
+    if not self._obj.eof:
+      raise lzma.LZMAError("Compressed stream ended unexpectedly")
+    return b''
+
+
+@dataclass(frozen=True)
+class Codec:
+  """
+  A stream compression codec. `tool` is the external command that is used on remote hosts,
+  and locally if there is no Python implementation.
+  """
+  name: str
+  tool: str
+  default_level: int
+  levels: range
+  compress_in_python: Optional[Callable[[int], Transform]] = None
+  decompress_in_python: Optional[Callable[[], Transform]] = None
+
+  def compress_cmd(self, level: int) -> list[str]:
+    return [self.tool, f'-{level}', '-c', '-q']
+
+  def decompress_cmd(self) -> list[str]:
+    return [self.tool, '-d', '-c', '-q']
+
+
+CODECS: dict[str, Codec] = {c.name: c for c in [
+  Codec('zlib', 'gzip', 6, range(1, 10), _ZlibCompress, _ZlibDecompress),
+  Codec('lzma', 'xz', 6, range(0, 10), _LzmaCompress, _LzmaDecompress),
+  Codec('zstd', 'zstd', 3, range(1, 20)),
+  Codec('lz4', 'lz4', 1, range(1, 13)),
+]}
+
+
+def parse_compression(value: str) -> tuple[str, Optional[int]]:
+  """Parses 'CODEC' or 'CODEC:LEVEL'"""
+  name, _, level = value.partition(':')
+  if name not in CODECS:
+    raise ValueError(f"Unknown codec '{name}'")
+  if not level:
+    return name, None
+  if int(level) not in CODECS[name].levels:
+    raise ValueError(f"Invalid level {level} for codec '{name}'")
+  return name, int(level)
+
+
+@dataclass
+class CompressionPlan:
+  """
+  Where the stream is compressed and decompressed. Sides with a command run it in a shell pipeline
+  together with `zfs send` or `zfs receive`. At most one side runs in Python, in the local process.
+  """
+  codec: Codec
+  level: int
+  send_cmd: Optional[list[str]] = None
+  receive_cmd: Optional[list[str]] = None
+  transform: Optional[Transform] = None
+
+  def __str__(self) -> str:
+    return f"{self.codec.name} level {self.level}"
+
+
+_available: WeakKeyDictionary[ZfsCli, dict[str, bool]] = WeakKeyDictionary()
+_available_lock = threading.Lock()
+
+
+def _has_tool(cli: ZfsCli, tool: str) -> bool:
+  """Checks once per CLI whether the tool is installed"""
+  with _available_lock:
+    known = _available.setdefault(cli, {})
+    if tool not in known:
+      known[tool] = cli.has_command(tool) if cli.is_remote else shutil.which(tool) is not None
+      if not known[tool]:
+        log.warning(f"'{tool}' is not installed on {'remote' if cli.is_remote else 'local'} host")
+    return known[tool]
+
+
+def plan_compression(clis: tuple[ZfsCli, ZfsCli], codec_name: str, level: Optional[int], flags: str) -> Optional[CompressionPlan]:
+  """
+  Returns None if the stream should not be compressed. This is the case if both sides are local,
+  if the stream is already compressed by `zfs send -c` or `-w`, or if the codec is not available.
+  """
+  src_cli, dest_cli = clis
+  if not src_cli.is_remote and not dest_cli.is_remote:
+    return None
+  if 'c' in flags or 'w' in flags:
+    log.debug(f"Not compressing stream, since it is sent with flags '{flags}'")
+    return None
+
+  codec = CODECS[codec_name]
+  plan = CompressionPlan(codec, level if level is not None else codec.default_level)
+
+  if not src_cli.is_remote and codec.compress_in_python is not None:
+    plan.transform = codec.compress_in_python(plan.level)
+  elif _has_tool(src_cli, codec.tool):
+    plan.send_cmd = codec.compress_cmd(plan.level)
+  else:
+    return None
+
+  if not dest_cli.is_remote and codec.decompress_in_python is not None:
+    plan.transform = codec.decompress_in_python()
+  elif _has_tool(dest_cli, codec.tool):
+    plan.receive_cmd = codec.decompress_cmd()
+  else:
+    return None
+
+  return plan
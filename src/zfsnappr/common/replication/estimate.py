@@ -0,0 +1,83 @@
+from __future__ import annotations
+from typing import Optional
+from collections.abc import Collection, Mapping
+from itertools import pairwise
+from subprocess import CalledProcessError
+import logging
+
+from ..zfs import Snapshot, ZfsCli, Inventory
+from ..utils import group_snaps_by_dataset
+from zfsnappr.common.sort import sort_snaps_by_time
+from .replicate_snaps import determine_latest_common
+from .stream import format_size
+
+
+log = logging.getLogger(__name__)
+
+# (snapshot, base, intermediates) as passed to `ZfsCli.estimate_send_sizes`
+Send = tuple[str, Optional[str], bool]
+
+
+def pending_sends(source_snaps: list[Snapshot], dest_snaps: list[Snapshot], single_stream: bool) -> list[Send]:
+  """
+  The sends that bring the destination up to date. Both lists must be sorted from latest to oldest.
+  A destination without snapshots is initialized with the oldest source snapshot.
+  Returns no sends if the destination cannot be updated incrementally.
+  """
+  if not source_snaps:
+    return []
+  sends: list[Send] = []
+  if not dest_snaps:
+    base = source_snaps[-1]
+    sends.append((base.longname, None, False))
+  else:
+    common = determine_latest_common((source_snaps, dest_snaps))
+    if common is None:
+      return []
+    base = common[0]
+  base_index = next(i for i, s in enumerate(source_snaps) if s.guid == base.guid)
+  sequence = list(reversed(source_snaps[:base_index+1]))
+  if len(sequence) <= 1:
+    return sends
+  if single_stream:
+    return sends + [(sequence[-1].longname, sequence[0].longname, True)]
+  return sends + [(b.longname, a.longname, False) for a, b in pairwise(sequence)]
+
+
+def estimate_hierarchy(
+  source_cli: ZfsCli,
+  source_snaps: Collection[Snapshot],
+  dest_inventory: Inventory,
+  pairs: Mapping[str, str],
+  flags: Mapping[str, str]
+) -> dict[str, int]:
+  """
+  Estimates the bytes that are pending for each source dataset in `pairs`, which maps source to destination datasets.
+  Destination snapshots are taken from the inventory, and each dataset is estimated with a single `zfs send -n -I`.
+  Returns an empty dict if the sizes cannot be estimated.
+  """
+  dest_grouped = {ds: sort_snaps_by_time(snaps, reverse=True) for ds, snaps in dest_inventory.snapshots.items()}
+  grouped = group_snaps_by_dataset(sort_snaps_by_time(source_snaps, reverse=True))
+
+  sends: list[tuple[str, Send, str]] = []
+  for ds, dest_ds in pairs.items():
+    for send in pending_sends(list(grouped.get(ds, [])), list(dest_grouped.get(dest_ds, [])), single_stream=True):
+      sends.append((ds, send, flags.get(ds, '')))
+
+  sizes: dict[str, int] = {ds: 0 for ds in pairs}
+  # flags change the size of the stream, so sends with the same flags are estimated together
+  for f in set(f for _, _, f in sends):
+    batch = [(ds, send) for ds, send, _f in sends if _f == f]
+    try:
+      estimates = source_cli.estimate_send_sizes([send for _, send in batch], flags=f)
+    except CalledProcessError as e:
+      log.warning(f"Could not estimate transfer sizes: {e}")
+      return {}
+    for (ds, _), size in zip(batch, estimates):
+      sizes[ds] += size
+
+  log.info(f"Estimated {format_size(sum(sizes.values()))} to transfer in {sum(1 for s in sizes.values() if s)} datasets")
+  for ds, size in sizes.items():
+    if size:
+      log.debug(f"  {ds}: {format_size(size)}")
+  return sizes
@@ -0,0 +1,123 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Optional
+from collections.abc import Iterable
+
+from ..zfs import Dataset, ZfsProperty
+from .ratelimit import RateLimiter
+from .progress import ProgressReporter
+
+
+# single-letter flags of `zfs send` that can be passed through
+SEND_FLAGS = 'cLewp'
+
+# dataset properties needed to detect send flags
+SEND_FLAG_PROPERTIES = [ZfsProperty.COMPRESSION, ZfsProperty.RECORDSIZE, ZfsProperty.ENCRYPTION]
+
+# properties sent with -p that must not be received, since they would conflict with the destination
+EXCLUDED_RECEIVE_PROPERTIES = [ZfsProperty.MOUNTPOINT, ZfsProperty.CANMOUNT, 'sharenfs', 'sharesmb']
+
+
+def parse_send_flags(value: str) -> str:
+  """Accepts 'auto' or any combination of the letters in `SEND_FLAGS`"""
+  if value == 'auto':
+    return value
+  if any(f not in SEND_FLAGS for f in value):
+    raise ValueError(f"Invalid send flags '{value}'")
+  return ''.join(f for f in SEND_FLAGS if f in value)
+
+
+def parse_size(value: str) -> int:
+  """Parses sizes like '512K', '256M' or '1G' into bytes"""
+  units = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3}
+  value = value.strip().upper().removesuffix('B')
+  unit = value[-1:] if value[-1:] in units else ''
+  number = float(value[:len(value)-len(unit)])
+  if number < 0:
+    raise ValueError(f"Negative size '{value}'")
+  return int(number * units[unit])
+
+
+def parse_percentage(value: str) -> float:
+  """Parses percentages like '80' or '80%' into fractions"""
+  number = float(value.strip().removesuffix('%'))
+  if not 0 <= number <= 100:
+    raise ValueError(f"Percentage '{value}' out of range")
+  return number / 100
+
+
+def detect_send_flags(dataset: Dataset) -> str:
+  """
+  Detects suitable send flags from the properties in `SEND_FLAG_PROPERTIES`.
+  Compressed datasets are sent with -c -e, datasets with records larger than 128K with -L,
+  and encrypted datasets raw with -w.
+  """
+  props = dataset.properties
+  if props.get(ZfsProperty.ENCRYPTION, 'off') not in ('off', '-'):
+    return 'w'
+  flags = ''
+  if props.get(ZfsProperty.COMPRESSION, 'off') not in ('off', '-'):
+    flags += 'ce'
+  recordsize = props.get(ZfsProperty.RECORDSIZE, '-')
+  if recordsize.isdigit() and int(recordsize) > 128*1024:
+    flags += 'L'
+  return normalize_send_flags(flags)
+
+
+def normalize_send_flags(flags: Iterable[str]) -> str:
+  """Raw sends already contain compressed, large and embedded blocks as they are on disk"""
+  flags = set(flags)
+  if 'w' in flags:
+    flags -= set('cLe')
+  return ''.join(f for f in SEND_FLAGS if f in flags)
+
+
+@dataclass(frozen=True)
+class TransferOptions:
+  """Options that control how snapshots are transferred"""
+
+  # send all snapshots from base to latest as a single `zfs send -I` stream
+  single_stream: bool = False
+  # send whole hierarchies as a single `zfs send -R -I` stream where possible
+  recursive_stream: bool = False
+  # send flags, or 'auto' to detect them per dataset
+  send_flags: Optional[str] = None
+  # size of the in-memory buffer between sender and receiver in bytes, 0 to disable
+  buffer_size: int = 0
+  # fill level at which an empty buffer starts draining
+  buffer_high: float = 0
+  # fill level at which a full buffer resumes filling
+  buffer_low: float = 1
+  # codec for compressing the stream between hosts, see `compression.CODECS`
+  compression: Optional[str] = None
+  compression_level: Optional[int] = None
+  # receive with -s, so that interrupted transfers can be resumed
+  resumable: bool = True
+  # discard partially received state instead of resuming it
+  abort_partial: bool = False
+  # limit the throughput of the stream. Limiters are shared by all concurrent transfers.
+  rate_limiters: tuple[RateLimiter, ...] = ()
+  # number of consecutive incremental transfers whose tags and holds are updated together
+  hold_window: int = 1
+  # estimate and log the size of the pending streams before sending
+  estimate: bool = False
+  # receives the progress of all transfers
+  progress: ProgressReporter = field(default_factory=ProgressReporter)
+
+  def resolve_send_flags(self, datasets: Iterable[Dataset]) -> str:
+    """Send flags for a stream containing the given datasets, which must have the `SEND_FLAG_PROPERTIES`"""
+    if self.send_flags is None:
+      return ''
+    if self.send_flags != 'auto':
+      return self.send_flags
+    return normalize_send_flags(f for d in datasets for f in detect_send_flags(d))
+
+
+def receive_exclude_properties(flags: str, properties: Iterable[str] = (), recursive: bool = False) -> list[str]:
+  """
+  Properties to exclude when receiving a stream sent with `flags`, except for the explicitly set `properties`.
+  Recursive replication streams always contain properties.
+  """
+  if 'p' not in flags and not recursive:
+    return []
+  return [p for p in EXCLUDED_RECEIVE_PROPERTIES if p not in properties]
@@ -0,0 +1,337 @@
+from __future__ import annotations
+from typing import Optional, Any, IO
+from collections.abc import Collection
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+from itertools import pairwise
+from subprocess import CalledProcessError
+import logging
+import json
+import sys
+
+from ..zfs import Snapshot, ZfsCli, ZfsProperty, Inventory
+from zfsnappr.common.exception import ReplicationError
+from zfsnappr.common.sort import sort_snaps_by_time
+from .replicate_snaps import (
+  replicate_snaps, holdtag_src, holdtag_dest, determine_latest_common, get_holdtags, update_holds, HoldState
+)
+from .send_receive_snap import MetadataBatches
+from .estimate import estimate_hierarchy
+from .options import TransferOptions, SEND_FLAG_PROPERTIES
+from .stream import format_size
+
+
+log = logging.getLogger(__name__)
+
+PLAN_VERSION = 1
+
+
+@dataclass
+class PlannedSnapshot:
+  name: str
+  guid: int
+
+
+@dataclass
+class HoldChange:
+  """A `zfs hold` or `zfs release` of a tag on snapshots"""
+  action: str
+  tag: str
+  snapshots: list[str]
+
+
+@dataclass
+class DatasetPlan:
+  """
+  How a single dataset is replicated. `snapshots` are sent oldest first, incrementally from `base`.
+  If the destination must be created, there is no base and the first snapshot is sent in full.
+  `hold_changes` reconcile the holds before the transfer. During the transfer, the holds move from base to the last snapshot.
+  """
+  source: str
+  dest: str
+  create: bool = False
+  base: Optional[PlannedSnapshot] = None
+  snapshots: list[PlannedSnapshot] = field(default_factory=list)
+  hold_changes: dict[str, list[HoldChange]] = field(default_factory=lambda: {'source': [], 'dest': []})
+  # there is an interrupted receive that is finished first
+  resume: bool = False
+  estimated_bytes: Optional[int] = None
+  # why the dataset cannot be replicated
+  error: Optional[str] = None
+
+  def __str__(self) -> str:
+    if self.error is not None:
+      return f"'{self.source}' -> '{self.dest}': {self.error}"
+    if not self.snapshots:
+      return f"'{self.source}' -> '{self.dest}': up to date"
+    s = f"'{self.source}' -> '{self.dest}': "
+    if self.create:
+      s += f"create with {len(self.snapshots)} snapshots"
+    else:
+      assert self.base is not None
+      s += f"{len(self.snapshots)} snapshots from base '{self.base.name}'"
+    if self.resume:
+      s += ", after resuming an interrupted transfer"
+    if self.estimated_bytes is not None:
+      s += f", {format_size(self.estimated_bytes)}"
+    return s
+
+
+@dataclass
+class TransferPlan:
+  source_dataset: str
+  dest_dataset: str
+  recursive: bool
+  created: str
+  datasets: list[DatasetPlan]
+  version: int = PLAN_VERSION
+
+  @property
+  def estimated_bytes(self) -> int:
+    return sum(d.estimated_bytes or 0 for d in self.datasets)
+
+  def dump(self, file: IO[str]) -> None:
+    json.dump(asdict(self) | {'estimated_bytes': self.estimated_bytes}, file, indent=2)
+    file.write('\n')
+
+  def save(self, path: str) -> None:
+    """Writes the plan to the file at `path`, or to stdout for '-'"""
+    if path == '-':
+      self.dump(sys.stdout)
+      return
+    with open(path, 'w') as f:
+      self.dump(f)
+
+  @staticmethod
+  def load(file: IO[str]) -> TransferPlan:
+    data: dict[str, Any] = json.load(file)
+    if data.get('version') != PLAN_VERSION:
+      raise ValueError(f"Unsupported plan version {data.get('version')}")
+    datasets = []
+    for d in data['datasets']:
+      datasets.append(DatasetPlan(
+        source=d['source'],
+        dest=d['dest'],
+        create=d['create'],
+        base=PlannedSnapshot(**d['base']) if d['base'] else None,
+        snapshots=[PlannedSnapshot(**s) for s in d['snapshots']],
+        hold_changes={side: [HoldChange(**c) for c in changes] for side, changes in d['hold_changes'].items()},
+        resume=d['resume'],
+        estimated_bytes=d['estimated_bytes'],
+        error=d['error']
+      ))
+    return TransferPlan(data['source_dataset'], data['dest_dataset'], data['recursive'], data['created'], datasets)
+
+
+def build_plan(
+  source_cli: ZfsCli,
+  source_dataset: str,
+  dest_cli: ZfsCli,
+  dest_dataset: str,
+  recursive: bool = False,
+  initialize: bool = False,
+  exclude_datasets: Collection[str] | None = None,
+  options: TransferOptions = TransferOptions()
+) -> TransferPlan:
+  """
+  Plans the replication without changing anything. Each side is listed once,
+  holds are queried once per side, and the sizes are estimated with `zfs send -n`.
+  """
+  exclude_datasets = set(exclude_datasets or [])
+  source_inventory = source_cli.get_inventory(
+    source_dataset,
+    recursive=recursive,
+    properties=SEND_FLAG_PROPERTIES if options.send_flags == 'auto' else []
+  )
+  if source_dataset not in source_inventory.datasets:
+    raise ReplicationError(f"Source dataset '{source_dataset}' does not exist")
+  dest_inventory = dest_cli.get_inventory(dest_dataset, recursive=recursive, properties=[ZfsProperty.RECEIVE_RESUME_TOKEN])
+
+  # parents first, like `replicate_hierarchy`
+  pairs = {
+    ds: dest_dataset + ds[len(source_dataset):]
+    for ds in sorted(source_inventory.datasets, key=lambda ds: (ds.count('/'), ds))
+    if ds not in exclude_datasets and source_inventory.snapshots[ds]
+  }
+  source_snaps = {ds: sort_snaps_by_time(source_inventory.snapshots[ds], reverse=True) for ds in pairs}
+  dest_snaps = {ds: sort_snaps_by_time(snaps, reverse=True) for ds, snaps in dest_inventory.snapshots.items()}
+
+  plans = {ds: _plan_dataset(ds, dest_ds, source_snaps[ds], dest_snaps.get(dest_ds), dest_inventory, initialize) for ds, dest_ds in pairs.items()}
+
+  # hold changes of all existing destinations, from a single query per side
+  states = {
+    ds: HoldState(
+      (source_snaps[ds], dest_snaps[dest_ds]),
+      (holdtag_src(dest_inventory.datasets[dest_ds]), holdtag_dest(source_inventory.datasets[ds])),
+      determine_latest_common((source_snaps[ds], dest_snaps[dest_ds])),
+      datasets=(ds, dest_ds)
+    )
+    for ds, dest_ds in pairs.items() if dest_ds in dest_inventory.datasets
+  }
+  holds = get_holdtags((source_cli, dest_cli), states.values())
+  for ds, state in states.items():
+    batches = MetadataBatches((source_cli, dest_cli))
+    update_holds(batches, state.snaps, state.holdtags, holds, state.latest_common_snap, state.datasets)
+    plans[ds].hold_changes = {
+      side: [HoldChange(action=cmd[1], tag=cmd[2], snapshots=cmd[3:]) for cmd in (*hold_batch.cmds, *release_batch.cmds)]
+      for side, hold_batch, release_batch in zip(('source', 'dest'), batches.holds, batches.releases)
+    }
+
+  pending = {ds: dest_ds for ds, dest_ds in pairs.items() if plans[ds].error is None and plans[ds].snapshots}
+  if pending:
+    flags = {ds: options.resolve_send_flags([source_inventory.datasets[ds]]) for ds in pending}
+    sizes = estimate_hierarchy(source_cli, [s for ds in pending for s in source_snaps[ds]], dest_inventory, pending, flags)
+    for ds, size in sizes.items():
+      plans[ds].estimated_bytes = size
+
+  return TransferPlan(
+    source_dataset=source_dataset,
+    dest_dataset=dest_dataset,
+    recursive=recursive,
+    created=datetime.now().isoformat(timespec='seconds'),
+    datasets=list(plans.values())
+  )
+
+
+def _plan_dataset(
+  source_dataset: str,
+  dest_dataset: str,
+  source_snaps: list[Snapshot],
+  dest_snaps: Optional[list[Snapshot]],
+  dest_inventory: Inventory,
+  initialize: bool
+) -> DatasetPlan:
+  """Plans a dataset like `replicate_snaps` would replicate it. Both snapshot lists are newest first."""
+  plan = DatasetPlan(source_dataset, dest_dataset)
+  if dest_snaps is None:
+    if not initialize:
+      plan.error = "destination does not exist and will not be created"
+      return plan
+    plan.create = True
+    plan.snapshots = [PlannedSnapshot(s.shortname, s.guid) for s in reversed(source_snaps)]
+    return plan
+
+  token = dest_inventory.datasets[dest_dataset].properties.get(ZfsProperty.RECEIVE_RESUME_TOKEN, '-')
+  plan.resume = token != '-'
+  if not dest_snaps:
+    plan.error = "destination does not contain any snapshots"
+    return plan
+  common = determine_latest_common((source_snaps, dest_snaps))
+  if common is None:
+    plan.error = "no common snapshot"
+    return plan
+  if common[1].guid != dest_snaps[0].guid:
+    plan.error = f"destination has snapshots newer than latest common snapshot '{common[1].shortname}'"
+    return plan
+
+  base_index = next(i for i, s in enumerate(source_snaps) if s.guid == common[0].guid)
+  sequence = list(reversed(source_snaps[:base_index+1]))
+  for a, b in pairwise(sequence):
+    if a.creation == b.creation:
+      plan.error = f"snapshot '{b.shortname}' shares timestamp with predecessor '{a.shortname}'"
+      return plan
+  plan.base = PlannedSnapshot(common[0].shortname, common[0].guid)
+  plan.snapshots = [PlannedSnapshot(s.shortname, s.guid) for s in sequence[1:]]
+  return plan
+
+
+def log_plan(plan: TransferPlan) -> None:
+  for d in plan.datasets:
+    if d.error is not None:
+      log.warning(str(d))
+    else:
+      log.info(str(d))
+  pending = [d for d in plan.datasets if d.error is None and d.snapshots]
+  log.info(f"Planned {sum(len(d.snapshots) for d in pending)} snapshots in {len(pending)} datasets, {format_size(plan.estimated_bytes)} estimated")
+
+
+def apply_plan(
+  plan: TransferPlan,
+  source_cli: ZfsCli,
+  dest_cli: ZfsCli,
+  rollback: bool = False,
+  options: TransferOptions = TransferOptions()
+) -> None:
+  """
+  Executes a plan of `build_plan`. Instead of listing both sides again, the GUIDs of the planned source snapshots
+  are checked with a single command, and the destination is listed with a single command.
+  Fails if any planned snapshot changed, or if the base is no longer the newest snapshot of its destination.
+  """
+  for d in plan.datasets:
+    if d.error is not None:
+      log.warning(f"Skipping {d}")
+  runnable = [d for d in plan.datasets if d.error is None and d.snapshots]
+  if not runnable:
+    log.info(f"Nothing to transfer")
+    return
+
+  # check that the planned source snapshots still exist with the same GUIDs
+  source_names = {f'{d.source}@{s.name}': s.guid for d in runnable for s in ([d.base] if d.base else []) + d.snapshots}
+  try:
+    source_snaps = {s.longname: s for s in source_cli.get_snapshots(list(source_names))}
+  except CalledProcessError as e:
+    raise ReplicationError(f"Plan is outdated, planned source snapshots do not exist anymore") from e
+  for name, guid in source_names.items():
+    if source_snaps[name].guid != guid:
+      raise ReplicationError(f"Plan is outdated, source snapshot '{name}' has changed")
+
+  # check that the destinations did not change since the plan was built
+  existing = [d for d in runnable if not d.create]
+  dest_inventory = dest_cli.get_inventory(plan.dest_dataset, recursive=plan.recursive, properties=[ZfsProperty.RECEIVE_RESUME_TOKEN])
+  for d in runnable:
+    if d.create and d.dest in dest_inventory.datasets:
+      raise ReplicationError(f"Plan is outdated, destination '{d.dest}' was created in the meantime")
+  for d in existing:
+    assert d.base is not None
+    if d.dest not in dest_inventory.datasets:
+      raise ReplicationError(f"Plan is outdated, destination '{d.dest}' does not exist anymore")
+    dest_snaps = sort_snaps_by_time(dest_inventory.snapshots[d.dest], reverse=True)
+    if not dest_snaps or dest_snaps[0].guid != d.base.guid:
+      raise ReplicationError(f"Plan is outdated, base snapshot '{d.base.name}' is no longer the newest snapshot of destination '{d.dest}'")
+
+  holds_reconciled = _apply_hold_changes((source_cli, dest_cli), existing)
+
+  is_error = False
+  for d in runnable:
+    planned = [source_snaps[f'{d.source}@{s.name}'] for s in ([d.base] if d.base else []) + d.snapshots]
+    if not holds_reconciled and not d.create:
+      # holds are reconciled per dataset, which needs all source snapshots up to the last planned one
+      planned = [s for s in source_cli.get_all_snapshots(datasets=[d.source], cached=False) if s.creation <= planned[-1].creation]
+    try:
+      replicate_snaps(
+        source_cli=source_cli,
+        source_snaps=planned,
+        dest_cli=dest_cli,
+        dest_dataset=d.dest,
+        dest_inventory=dest_inventory,
+        initialize=d.create,
+        rollback=rollback,
+        options=options,
+        holds_reconciled=holds_reconciled
+      )
+    except ReplicationError as e:
+      log.error(e)
+      is_error = True
+    finally:
+      options.progress.dataset_summary(d.dest)
+
+  if is_error:
+    raise ReplicationError(f"Replication failed for one or more datasets")
+
+
+def _apply_hold_changes(clis: tuple[ZfsCli, ZfsCli], plans: Collection[DatasetPlan]) -> bool:
+  """Applies the planned hold changes, the holds of both sides before the releases. Returns whether this succeeded."""
+  batches = MetadataBatches(clis)
+  for d in plans:
+    for i, side in enumerate(('source', 'dest')):
+      for change in d.hold_changes[side]:
+        if change.action == 'hold':
+          batches.holds[i].hold(change.snapshots, change.tag)
+        else:
+          batches.releases[i].release_hold(change.snapshots, change.tag)
+  try:
+    batches.run()
+  except CalledProcessError as e:
+    log.warning(f"Could not apply the planned hold changes, updating holds per dataset: {e}")
+    return False
+  return True
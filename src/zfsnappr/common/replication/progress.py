@@ -0,0 +1,188 @@
+from __future__ import annotations
+from typing import IO, Optional, Any
+from dataclasses import dataclass, field
+import threading
+import logging
+import json
+import time
+import re
+
+from .stream import format_size
+
+
+log = logging.getLogger(__name__)
+
+# e.g. '12:00:01	1048576	pool/fs@snap', optionally with a block count before the name
+_PROGRESS_LINE = re.compile(r'\d{2}:\d{2}:\d{2}\t(\d+)\t(?:\d+\t)?(\S+)')
+
+
+@dataclass
+class TransferProgress:
+  """
+  Progress of a single `zfs send -v -P` stream, parsed from its output.
+  The byte counter of zfs send starts at zero for every snapshot in the stream,
+  so the counters of finished snapshots are added up in `done`.
+  """
+  dataset: str
+  snapshot: Optional[str]
+  started: float = field(default_factory=time.monotonic)
+  estimated: Optional[int] = None
+  bytes: int = 0
+  duration: float = 0
+  success: Optional[bool] = None
+  current: Optional[str] = None
+  done: int = 0
+  # estimated sizes of the individual snapshots, summed up if there is no total
+  _estimates: int = 0
+
+  @property
+  def elapsed(self) -> float:
+    return self.duration if self.success is not None else time.monotonic() - self.started
+
+  @property
+  def rate(self) -> float:
+    return self.bytes / self.elapsed if self.elapsed > 0 else 0
+
+  @property
+  def eta(self) -> Optional[float]:
+    if self.estimated is None or not self.rate:
+      return None
+    return max(self.estimated - self.bytes, 0) / self.rate
+
+  def parse(self, line: str) -> Optional[str]:
+    """Updates the progress from a line of output. Returns 'estimate' or 'progress', or None if the line was not parsed."""
+    fields = line.split('\t')
+    if fields[0] in ('full', 'incremental') and len(fields) >= 3 and fields[-1].isdigit():
+      self._estimates += int(fields[-1])
+      self.estimated = self._estimates
+      return 'estimate'
+    if fields[0] == 'size' and len(fields) == 2 and fields[1].isdigit():
+      self.estimated = int(fields[1])
+      return 'estimate'
+    if m := _PROGRESS_LINE.fullmatch(line):
+      snapshot_bytes, name = int(m[1]), m[2]
+      if name != self.current:
+        # the previous snapshot is complete
+        self.done = self.bytes
+        self.current = name
+      self.bytes = self.done + snapshot_bytes
+      return 'progress'
+    return None
+
+  def finish(self, success: bool) -> None:
+    self.duration = time.monotonic() - self.started
+    self.success = success
+    if success and self.estimated is not None:
+      # the counter is only updated once per second, so it lags behind
+      self.bytes = max(self.bytes, self.estimated)
+
+  def to_dict(self) -> dict[str, Any]:
+    return {
+      'dataset': self.dataset,
+      'snapshot': self.snapshot,
+      'bytes': self.bytes,
+      'estimated': self.estimated,
+      'elapsed': round(self.elapsed, 3),
+      'rate': round(self.rate),
+      'eta': round(eta, 1) if (eta := self.eta) is not None else None
+    }
+
+  def __str__(self) -> str:
+    s = format_size(self.bytes)
+    if self.estimated:
+      s += f" of {format_size(self.estimated)} ({min(self.bytes / self.estimated, 1):.0%})"
+    s += f" in {self.elapsed:.1f}s, {format_size(self.rate)}/s"
+    if self.success is None and (eta := self.eta) is not None:
+      s += f", ETA {eta:.0f}s"
+    return s
+
+
+@dataclass
+class DatasetTotals:
+  transfers: int = 0
+  failed: int = 0
+  bytes: int = 0
+  duration: float = 0
+
+  @property
+  def rate(self) -> float:
+    return self.bytes / self.duration if self.duration > 0 else 0
+
+
+class ProgressReporter:
+  """
+  Collects the progress of all transfers. Thread-safe.
+  Logs the progress of running transfers every `interval` seconds, and a summary per transfer and per destination dataset.
+  With `json_file`, all updates are also written to it as JSON lines with an 'event' of
+  'progress', 'transfer' or 'dataset'.
+  """
+  json_file: Optional[IO[str]]
+  interval: float
+
+  def __init__(self, json_file: Optional[IO[str]] = None, interval: float = 10) -> None:
+    self.json_file = json_file
+    self.interval = interval
+    self.totals: dict[str, DatasetTotals] = {}
+    self._lock = threading.Lock()
+    self._last_log: dict[int, float] = {}
+
+  def start(self, dataset: str, snapshot: Optional[str]) -> TransferProgress:
+    return TransferProgress(dataset, snapshot)
+
+  def handle_line(self, progress: TransferProgress, line: str) -> None:
+    """Handles a line of `zfs send` output. Lines that are not progress information are logged as they are."""
+    kind = progress.parse(line)
+    if kind is None:
+      log.info(f"    {line}")
+      return
+    if kind == 'estimate':
+      log.debug(f"    {line}")
+      return
+    self._write('progress', progress.to_dict())
+    now = time.monotonic()
+    with self._lock:
+      if now - self._last_log.get(id(progress), progress.started) < self.interval:
+        return
+      self._last_log[id(progress)] = now
+    log.info(f"    {progress}")
+
+  def finish(self, progress: TransferProgress, success: bool) -> None:
+    progress.finish(success)
+    with self._lock:
+      self._last_log.pop(id(progress), None)
+      totals = self.totals.setdefault(progress.dataset, DatasetTotals())
+      totals.transfers += 1
+      totals.failed += not success
+      totals.bytes += progress.bytes
+      totals.duration += progress.duration
+    if success:
+      log.info(f"    Sent {progress}")
+    self._write('transfer', progress.to_dict() | {'success': success})
+
+  def dataset_summary(self, dataset: str) -> None:
+    """Logs the totals of all transfers to the destination dataset so far, if there were any"""
+    with self._lock:
+      totals = self.totals.get(dataset)
+    if totals is None:
+      return
+    failed = f", {totals.failed} failed" if totals.failed else ''
+    log.info(
+      f"Sent {format_size(totals.bytes)} to '{dataset}' in {totals.transfers} streams{failed}, "
+      f"{totals.duration:.1f}s, {format_size(totals.rate)}/s"
+    )
+    self._write('dataset', {
+      'dataset': dataset,
+      'transfers': totals.transfers,
+      'failed': totals.failed,
+      'bytes': totals.bytes,
+      'duration': round(totals.duration, 3),
+      'rate': round(totals.rate)
+    })
+
+  def _write(self, event: str, data: dict[str, Any]) -> None:
+    if self.json_file is None:
+      return
+    line = json.dumps({'event': event, 'time': round(time.time(), 3)} | data)
+    with self._lock:
+      self.json_file.write(line + '\n')
+      self.json_file.flush()
@@ -0,0 +1,130 @@
+from __future__ import annotations
+from typing import Optional
+from dataclasses import dataclass
+from datetime import datetime, time as dtime
+import threading
+import logging
+import time
+import re
+
+
+log = logging.getLogger(__name__)
+
+_RATE_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3}
+_BIT_UNITS = {'': 1, 'K': 1000, 'M': 1000**2, 'G': 1000**3}
+
+
+def parse_rate(value: str) -> Optional[float]:
+  """
+  Parses rates like '50Mbit', '6M' or '500K' into bytes per second.
+  Units without 'bit' are bytes. 'unlimited' and '0' stand for no limit, which is returned as None.
+  """
+  value = value.strip()
+  if value in ('unlimited', '0'):
+    return None
+  m = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([KMG]?)(bit|B)?(?:/s)?', value, re.IGNORECASE)
+  if not m:
+    raise ValueError(f"Invalid rate '{value}'")
+  number, unit, kind = float(m[1]), m[2].upper(), (m[3] or 'B').lower()
+  if kind == 'bit':
+    # network rates are decimal
+    return number * _BIT_UNITS[unit] / 8
+  return number * _RATE_UNITS[unit]
+
+
+@dataclass(frozen=True)
+class RateWindow:
+  start: dtime
+  end: dtime
+  rate: Optional[float]
+
+  def contains(self, t: dtime) -> bool:
+    if self.start <= self.end:
+      return self.start <= t < self.end
+    # wraps around midnight
+    return t >= self.start or t < self.end
+
+
+@dataclass(frozen=True)
+class RateSchedule:
+  """A default rate and time-of-day windows with other rates. The first matching window wins."""
+  default: Optional[float]
+  windows: tuple[RateWindow, ...] = ()
+
+  def rate_at(self, now: datetime) -> Optional[float]:
+    t = now.time()
+    for window in self.windows:
+      if window.contains(t):
+        return window.rate
+    return self.default
+
+
+def parse_schedule(value: str) -> RateSchedule:
+  """
+  Parses schedules like '50Mbit,22:00-06:00=unlimited'.
+  Entries of the form 'HH:MM-HH:MM=RATE' are windows, an entry with only a rate is the default.
+  Without a default, transfers outside of the windows are unlimited.
+  """
+  default: Optional[float] = None
+  windows: list[RateWindow] = []
+  for entry in value.split(','):
+    span, sep, rate = entry.partition('=')
+    if not sep:
+      default = parse_rate(span)
+      continue
+    start, _, end = span.partition('-')
+    try:
+      windows.append(RateWindow(dtime.fromisoformat(start.strip()), dtime.fromisoformat(end.strip()), parse_rate(rate)))
+    except ValueError:
+      raise ValueError(f"Invalid schedule window '{entry}'")
+  return RateSchedule(default, tuple(windows))
+
+
+def parse_dest_schedule(value: str) -> tuple[str, RateSchedule]:
+  """Parses 'DEST=SCHEDULE', where SCHEDULE is parsed with `parse_schedule`"""
+  dest, sep, schedule = value.partition('=')
+  if not sep or not dest:
+    raise ValueError(f"Invalid destination rate limit '{value}'")
+  return dest, parse_schedule(schedule)
+
+
+class RateLimiter:
+  """
+  Token bucket limiting the throughput of all streams that share it. Thread-safe.
+  Consumers that exceed the rate go into debt and sleep until it is paid off,
+  so concurrent streams are served in order and share the rate fairly.
+  The rate follows the schedule and is re-evaluated on every call.
+  """
+  name: str
+  schedule: RateSchedule
+
+  # seconds worth of tokens that can be saved up
+  BURST = 0.25
+
+  def __init__(self, schedule: RateSchedule, name: str = 'global') -> None:
+    self.schedule = schedule
+    self.name = name
+    self._lock = threading.Lock()
+    self._rate: Optional[float] = None
+    self._tokens = 0.0
+    self._last = time.monotonic()
+
+  def acquire(self, n: int) -> float:
+    """Blocks until `n` bytes may be sent. Returns the time spent waiting."""
+    with self._lock:
+      now = time.monotonic()
+      rate = self.schedule.rate_at(datetime.now())
+      if rate != self._rate:
+        log.info(f"Rate limit '{self.name}' is now {'unlimited' if rate is None else f'{rate * 8 / 1e6:.1f} Mbit/s'}")
+        self._rate = rate
+        self._tokens = 0.0
+        self._last = now
+      if rate is None:
+        return 0
+      self._tokens = min(self._tokens + (now - self._last) * rate, rate * self.BURST)
+      self._last = now
+      self._tokens -= n
+      wait = -self._tokens / rate if self._tokens < 0 else 0
+    if wait > 0:
+      time.sleep(wait)
+    return wait
@@ -1,10 +1,14 @@
 from __future__ import annotations
+from typing import Optional, Literal
 from collections.abc import Collection
 
 from ..zfs import ZfsCli, ZfsProperty
 from .replicate_snaps import replicate_snaps
 from .replicate_hierarchy import replicate_hierarchy
+from .replicate_tree import replicate_tree
+from .options import TransferOptions
 from zfsnappr.common.sort import sort_snaps_by_time
+from zfsnappr.common.table import SnapshotTable
 
 
 def replicate(
@@ -15,17 +19,44 @@ def replicate(
   recursive: bool = False,
   initialize: bool = False,
   rollback: bool = False,
-  exclude_datasets: Collection[str] | None = None
+  exclude_datasets: Collection[str] | None = None,
+  jobs: int = 1,
+  order: Optional[Literal['smallest', 'largest']] = None,
+  options: TransferOptions = TransferOptions()
 ):
-  source_snaps = source_cli.get_all_snapshots(
+  source_snaps = SnapshotTable.from_snapshots(source_cli.iter_snapshots(
     datasets=[source_dataset],
     recursive=recursive,
-    exclude_datasets=exclude_datasets
-  )
+    exclude_datasets=exclude_datasets,
+    # holds are reconciled based on the listed snapshots
+    cached=False
+  ))
   source_snaps = sort_snaps_by_time(source_snaps, reverse=True)
 
-  # Precompute destination datasets that already exist
-  existing_dest_datasets = {d.name for d in dest_cli.get_all_datasets()}
+  # datasets and snapshots of the destination subtree, shared by all datasets
+  dest_inventory = dest_cli.get_inventory(dest_dataset, recursive=recursive, properties=[ZfsProperty.RECEIVE_RESUME_TOKEN])
+
+  if recursive and options.recursive_stream:
+    if replicate_tree(
+      source_cli,
+      source_dataset,
+      source_snaps,
+      dest_cli,
+      dest_dataset,
+      dest_inventory=dest_inventory,
+      exclude_datasets=exclude_datasets or [],
+      rollback=rollback,
+      options=options
+    ):
+      return
+    # refresh, since a failed stream might have changed snapshots and holds
+    source_snaps = sort_snaps_by_time(SnapshotTable.from_snapshots(source_cli.iter_snapshots(
+      datasets=[source_dataset],
+      recursive=recursive,
+      exclude_datasets=exclude_datasets,
+      cached=False
+    )), reverse=True)
+    dest_inventory = dest_cli.get_inventory(dest_dataset, recursive=recursive, properties=[ZfsProperty.RECEIVE_RESUME_TOKEN])
 
   if recursive:
     replicate_hierarchy(
@@ -34,17 +65,24 @@ def replicate(
       source_snaps,
       dest_cli,
       dest_dataset,
-      existing_dest_datasets=existing_dest_datasets,
-      initialize=initialize,
-      rollback=rollback
-    )
-  else:
-    replicate_snaps(
-      source_cli=source_cli,
-      source_snaps=source_snaps,
-      dest_cli=dest_cli,
-      dest_dataset=dest_dataset,
-      existing_dest_datasets=existing_dest_datasets,
+      dest_inventory=dest_inventory,
       initialize=initialize,
       rollback=rollback,
+      jobs=jobs,
+      order=order,
+      options=options
     )
+  else:
+    try:
+      replicate_snaps(
+        source_cli=source_cli,
+        source_snaps=source_snaps,
+        dest_cli=dest_cli,
+        dest_dataset=dest_dataset,
+        dest_inventory=dest_inventory,
+        initialize=initialize,
+        rollback=rollback,
+        options=options
+      )
+    finally:
+      options.progress.dataset_summary(dest_dataset)
@@ -0,0 +1,247 @@
+from __future__ import annotations
+from typing import Optional
+from collections.abc import Collection, Sequence
+from dataclasses import dataclass, field
+from itertools import pairwise
+from subprocess import CalledProcessError
+import logging
+
+from ..zfs import Snapshot, ZfsCli, ZfsProperty, Dataset, Inventory
+from zfsnappr.common.exception import ReplicationError
+from zfsnappr.common.sort import sort_snaps_by_time
+from .replicate_snaps import finish_partial_receive, ensure_holds, determine_latest_common, holdtag_src, holdtag_dest
+from .send_receive_snap import send_receive_fanout, add_transfer_metadata, initial_properties, MetadataBatches
+from .options import TransferOptions, SEND_FLAG_PROPERTIES
+from .ratelimit import RateLimiter
+
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class _Destination:
+  """Replication state of a source dataset at one destination"""
+  cli: ZfsCli
+  dataset: str
+  # in addition to the rate limiters of the transfer options
+  limiters: Sequence[RateLimiter] = ()
+  holdtags: tuple[str, str] = ('', '')
+  # latest source snapshot that was received, and the one that is held on both sides
+  base: Optional[Snapshot] = None
+  held: Optional[Snapshot] = None
+  # received since the holds were last moved, oldest first
+  received: list[Snapshot] = field(default_factory=list)
+
+
+def replicate_fanout(
+  source_cli: ZfsCli,
+  source_dataset: str,
+  dests: Sequence[tuple[ZfsCli, str]],
+  recursive: bool = False,
+  initialize: bool = False,
+  rollback: bool = False,
+  exclude_datasets: Collection[str] | None = None,
+  dest_limiters: Sequence[Sequence[RateLimiter]] = (),
+  options: TransferOptions = TransferOptions()
+) -> None:
+  """
+  Replicates to several destinations at once. Each snapshot is sent once and received by all destinations
+  that are at the same base, so the source reads every block once instead of once per destination.
+  A destination that fails is dropped for the rest of the dataset, while the others continue.
+  Datasets are replicated one after another, parents first.
+  `dest_limiters` are the rate limiters of each destination.
+  """
+  exclude_datasets = set(exclude_datasets or [])
+  source_inventory = source_cli.get_inventory(
+    source_dataset,
+    recursive=recursive,
+    properties=SEND_FLAG_PROPERTIES if options.send_flags == 'auto' else []
+  )
+  if source_dataset not in source_inventory.datasets:
+    raise ReplicationError(f"Source dataset '{source_dataset}' does not exist")
+  dest_limiters = dest_limiters or [()] * len(dests)
+  dest_inventories = [cli.get_inventory(ds, recursive=recursive, properties=[ZfsProperty.RECEIVE_RESUME_TOKEN]) for cli, ds in dests]
+
+  is_error = False
+  for ds in sorted(source_inventory.datasets, key=lambda ds: (ds.count('/'), ds)):
+    if ds in exclude_datasets or not source_inventory.snapshots[ds]:
+      continue
+    suffix = ds[len(source_dataset):]
+    try:
+      is_error |= not _replicate_dataset(
+        source_cli,
+        source_inventory.datasets[ds],
+        sort_snaps_by_time(source_inventory.snapshots[ds], reverse=True),
+        [(cli, dest_ds + suffix, inventory, limiters) for (cli, dest_ds), inventory, limiters in zip(dests, dest_inventories, dest_limiters)],
+        initialize=initialize,
+        rollback=rollback,
+        options=options
+      )
+    except ReplicationError as e:
+      log.error(e)
+      is_error = True
+    finally:
+      options.progress.dataset_summary(ds)
+
+  if is_error:
+    raise ReplicationError(f"Replication failed for one or more datasets or destinations")
+
+
+def _replicate_dataset(
+  source_cli: ZfsCli,
+  source_ds: Dataset,
+  source_snaps: list[Snapshot],
+  targets: Sequence[tuple[ZfsCli, str, Inventory, Sequence[RateLimiter]]],
+  initialize: bool,
+  rollback: bool,
+  options: TransferOptions
+) -> bool:
+  """
+  Replicates source_snaps, newest first, to all targets. Checks each destination like `replicate_snaps`.
+  Returns whether all destinations were brought up to date.
+  """
+  flags = options.resolve_send_flags([source_ds])
+  if flags:
+    log.debug(f"Sending '{source_ds.name}' with flags '{flags}'")
+
+  ok = True
+  active: list[_Destination] = []
+  create: list[_Destination] = []
+  for cli, dest_dataset, inventory, limiters in targets:
+    dest = _Destination(cli, dest_dataset, limiters)
+    dest_ds = inventory.datasets.get(dest_dataset)
+    try:
+      if dest_ds is None:
+        if not initialize:
+          raise ReplicationError(f"Destination dataset '{dest_dataset}' does not exist and will not be created")
+        _check_sequence(source_snaps, source_ds.name, dest_dataset)
+        create.append(dest)
+        continue
+      _prepare((source_cli, cli), source_ds, source_snaps, dest, dest_ds, inventory, rollback, flags, options)
+      active.append(dest)
+    except ReplicationError as e:
+      log.error(e)
+      ok = False
+
+  if create:
+    oldest = source_snaps[-1]
+    log.info(f"Creating {len(create)} destination datasets by transferring the oldest snapshot of '{source_ds.name}'")
+    errors = send_receive_fanout(source_cli, [(d.cli, d.dataset) for d in create], oldest, None, properties=initial_properties(source_ds.type), flags=flags, options=options, limiters=[d.limiters for d in create])
+    for dest, error in zip(create, errors):
+      if error is not None:
+        log.error(error)
+        ok = False
+        continue
+      dest.base = oldest
+      dest.received = [oldest]
+      try:
+        dest.holdtags = (holdtag_src(dest.cli.get_dataset(dest.dataset)), holdtag_dest(source_ds))
+      except CalledProcessError as e:
+        log.error(ReplicationError(f"Cannot look up created destination '{dest.dataset}': {e}"))
+        ok = False
+        continue
+      if not _move_holds(source_cli, dest):
+        ok = False
+        continue
+      active.append(dest)
+
+  if not active:
+    return ok
+
+  # transfer from the oldest base, each snapshot to the destinations that are at its predecessor
+  base_index = max(next(i for i, s in enumerate(source_snaps) if s.guid == d.base.guid) for d in active if d.base)
+  transfer_sequence = list(reversed(source_snaps[:base_index+1]))
+  if len(transfer_sequence) <= 1:
+    log.info(f"Source '{source_ds.name}' has no new snapshots to transfer")
+    return ok
+
+  log.info(f"Transferring up to {len(transfer_sequence) - 1} snapshots from '{source_ds.name}' to {len(active)} destinations")
+  try:
+    for count, (_base, _snap) in enumerate(pairwise(transfer_sequence), start=1):
+      group = [d for d in active if d.base is not None and d.base.guid == _base.guid]
+      if not group:
+        continue
+      errors = send_receive_fanout(source_cli, [(d.cli, d.dataset) for d in group], _snap, _base, flags=flags, options=options, limiters=[d.limiters for d in group])
+      for dest, error in zip(group, errors):
+        if error is not None:
+          # drop the destination, the others continue
+          log.error(error)
+          ok = False
+          active.remove(dest)
+          _move_holds(source_cli, dest)
+          continue
+        dest.base = _snap
+        dest.received.append(_snap)
+        if len(dest.received) >= options.hold_window and not _move_holds(source_cli, dest):
+          ok = False
+          active.remove(dest)
+      log.info(f"{count}/{len(transfer_sequence) - 1} transferred to {len(group) - sum(e is not None for e in errors)} destinations")
+  finally:
+    for dest in active:
+      ok &= _move_holds(source_cli, dest)
+  log.info(f'Transfer complete')
+  return ok
+
+
+def _prepare(
+  clis: tuple[ZfsCli, ZfsCli],
+  source_ds: Dataset,
+  source_snaps: list[Snapshot],
+  dest: _Destination,
+  dest_ds: Dataset,
+  inventory: Inventory,
+  rollback: bool,
+  flags: str,
+  options: TransferOptions
+) -> None:
+  """Finishes interrupted receives, reconciles holds and sets the base of an existing destination"""
+  dest_ds, finished = finish_partial_receive(clis, (source_ds.name, dest.dataset), flags, options, dest_ds)
+  dest_snaps = list(inventory.snapshots[dest.dataset]) if not finished else clis[1].get_all_snapshots(datasets=[dest.dataset], cached=False)
+  dest_snaps = sort_snaps_by_time(dest_snaps, reverse=True)
+
+  dest.holdtags = (holdtag_src(dest_ds), holdtag_dest(source_ds))
+  base_snap = determine_latest_common((source_snaps, dest_snaps))
+  ensure_holds(clis, (source_snaps, dest_snaps), dest.holdtags, latest_common_snap=base_snap, datasets=(source_ds.name, dest.dataset))
+
+  if not dest_snaps:
+    raise ReplicationError(f"Destination '{dest.dataset}' does not contain any snapshots")
+  if base_snap is None:
+    raise ReplicationError(f"Source '{source_ds.name}' and destination '{dest.dataset}' have no common snapshot")
+  if base_snap[1].guid != dest_snaps[0].guid:
+    raise ReplicationError(f"Destination '{dest.dataset}' has snapshots newer than latest common snapshot '{base_snap[1].shortname}'")
+  base_index = next(i for i, s in enumerate(source_snaps) if s.guid == base_snap[0].guid)
+  _check_sequence(source_snaps[:base_index+1], source_ds.name, dest.dataset)
+
+  if rollback:
+    log.info(f"Rolling back destination '{dest.dataset}' to latest snapshot")
+    clis[1].rollback(dest_snaps[0].longname)
+  dest.base = dest.held = base_snap[0]
+
+
+def _check_sequence(source_snaps: list[Snapshot], source_dataset: str, dest_dataset: str) -> None:
+  """Source snapshots to transfer, newest first, must have distinct timestamps"""
+  for a, b in pairwise(reversed(source_snaps)):
+    if a.creation == b.creation:
+      raise ReplicationError(
+        f"Cannot transfer snapshots from '{source_dataset}' to '{dest_dataset}': "
+        f"snapshot '{b.shortname}' shares timestamp with predecessor '{a.shortname}'"
+      )
+
+
+def _move_holds(source_cli: ZfsCli, dest: _Destination) -> bool:
+  """
+  Tags the snapshots received since the last call and moves the holds of both sides to the latest one.
+  Returns whether this succeeded. A failure only concerns this destination, so it is logged instead of raised.
+  """
+  if not dest.received:
+    return True
+  batches = MetadataBatches((source_cli, dest.cli))
+  add_transfer_metadata(batches, dest.dataset, dest.received, dest.held, dest.holdtags)
+  try:
+    batches.run()
+  except CalledProcessError as e:
+    log.error(ReplicationError(f"Updating holds and tags of '{dest.dataset}' after the transfer failed: {e}"))
+    return False
+  dest.held = dest.received[-1]
+  dest.received = []
+  return True
@@ -1,10 +1,17 @@
 from __future__ import annotations
-from collections.abc import Collection
+from typing import Any, Optional, Literal
+from collections.abc import Callable, Collection, Mapping
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, wait
+from subprocess import CalledProcessError
+import heapq
 import logging
 
-from ..zfs import Snapshot, ZfsCli
-from ..utils import group_snaps_by
-from .replicate_snaps import replicate_snaps
+from ..zfs import Snapshot, ZfsCli, Inventory, Dataset
+from ..utils import group_snaps_by_dataset
+from zfsnappr.common.sort import sort_snaps_by_time
+from .replicate_snaps import replicate_snaps, holdtag_src, holdtag_dest, determine_latest_common, reconcile_holds, HoldState
+from .options import TransferOptions, SEND_FLAG_PROPERTIES
+from .estimate import estimate_hierarchy
 from zfsnappr.common.exception import ReplicationError
 
 
@@ -14,19 +21,24 @@ log = logging.getLogger(__name__)
 def replicate_hierarchy(
     source_cli: ZfsCli, source_dataset_root: str, source_snaps: Collection[Snapshot],
     dest_cli: ZfsCli, dest_dataset_root: str,
-    existing_dest_datasets: Collection[str],
+    dest_inventory: Inventory,
     initialize: bool,
     rollback: bool,
+    jobs: int = 1,
+    order: Optional[Literal['smallest', 'largest']] = None,
+    options: TransferOptions = TransferOptions(),
 ):
   """
   replicates given snaps under dest_dataset
   keeps the dataset hierarchy
   all source_snaps must be under source_dataset_root
+  with jobs > 1, up to that many datasets are replicated at the same time
+  with order, datasets are replicated smallest or largest estimated transfer first, but always after their parents
   """
   is_error: bool = False
 
   # Group by absolute source dataset name
-  grouped = group_snaps_by(source_snaps, lambda s: s.dataset)
+  grouped = group_snaps_by_dataset(source_snaps)
 
   src_ds_rootparts = source_dataset_root.split('/')
   dest_ds_rootparts = dest_dataset_root.split('/')
@@ -45,10 +57,45 @@ def replicate_hierarchy(
 
   ordered_source_datasets = sorted(grouped.keys(), key=lambda ds: (_depth(ds), ds))
 
-  for abs_source_dataset in ordered_source_datasets:
+  def _dest_dataset(abs_source_dataset: str) -> str:
+    return '/'.join(dest_ds_rootparts + _rel_parts(abs_source_dataset))
+
+  source_datasets = {
+    d.name: d for d in source_cli.get_all_datasets(
+      properties=SEND_FLAG_PROPERTIES if options.send_flags == 'auto' else [],
+      datasets=[source_dataset_root],
+      recursive=True
+    )
+  }
+  holds_reconciled = _reconcile_holds(
+    (source_cli, dest_cli),
+    grouped,
+    source_datasets,
+    dest_inventory,
+    pairs={ds: _dest_dataset(ds) for ds in ordered_source_datasets}
+  )
+
+  index = {ds: i for i, ds in enumerate(ordered_source_datasets)}
+  key: Callable[[str], Any] = index.__getitem__
+  if order is not None:
+    if options.send_flags == 'auto':
+      flags = {ds: options.resolve_send_flags([source_datasets[ds]]) for ds in ordered_source_datasets}
+    else:
+      flags = {ds: options.resolve_send_flags([]) for ds in ordered_source_datasets}
+    sizes = estimate_hierarchy(
+      source_cli,
+      source_snaps,
+      dest_inventory,
+      pairs={ds: _dest_dataset(ds) for ds in ordered_source_datasets},
+      flags=flags
+    )
+    sign = 1 if order == 'smallest' else -1
+    key = lambda ds: (sign * sizes.get(ds, 0), index[ds])
+
+  def _replicate(abs_source_dataset: str) -> bool:
+    """Returns whether replication succeeded"""
     snaps_for_dataset = grouped[abs_source_dataset]
-    relparts = _rel_parts(abs_source_dataset)
-    abs_dest_dataset = '/'.join(dest_ds_rootparts + relparts)
+    abs_dest_dataset = _dest_dataset(abs_source_dataset)
 
     try:
       replicate_snaps(
@@ -56,13 +103,106 @@ def replicate_hierarchy(
         source_snaps=snaps_for_dataset,
         dest_cli=dest_cli,
         dest_dataset=abs_dest_dataset,
-        existing_dest_datasets=existing_dest_datasets,
+        dest_inventory=dest_inventory,
         initialize=initialize,
         rollback=rollback,
+        options=options,
+        holds_reconciled=holds_reconciled,
       )
     except ReplicationError as e:
-      is_error = True
       log.error(e)
+      return False
+    finally:
+      options.progress.dataset_summary(abs_dest_dataset)
+    return True
+
+  if jobs <= 1:
+    for abs_source_dataset in _sort_topologically(ordered_source_datasets, key):
+      if not _replicate(abs_source_dataset):
+        is_error = True
+  else:
+    is_error = not _replicate_concurrently(ordered_source_datasets, _replicate, jobs, key)
 
   if is_error:
     raise ReplicationError(f"Replication failed for one or more datasets")
+
+
+def _reconcile_holds(
+  clis: tuple[ZfsCli, ZfsCli],
+  grouped: Mapping[str, Collection[Snapshot]],
+  source_datasets: dict[str, Dataset],
+  dest_inventory: Inventory,
+  pairs: dict[str, str]
+) -> bool:
+  """
+  Updates the holds of all dataset pairs whose destination exists at once, instead of per dataset.
+  Returns whether this succeeded.
+  """
+  states: list[HoldState] = []
+  for ds, dest_ds in pairs.items():
+    if dest_ds not in dest_inventory.datasets:
+      continue
+    snaps = (list(sort_snaps_by_time(grouped[ds], reverse=True)), sort_snaps_by_time(dest_inventory.snapshots[dest_ds], reverse=True))
+    holdtags = (holdtag_src(dest_inventory.datasets[dest_ds]), holdtag_dest(source_datasets[ds]))
+    states.append(HoldState(snaps, holdtags, determine_latest_common(snaps), datasets=(ds, dest_ds)))
+  try:
+    reconcile_holds(clis, states)
+  except CalledProcessError as e:
+    log.warning(f"Could not update holds of all datasets at once, updating them per dataset: {e}")
+    return False
+  return True
+
+
+def _children(ordered_datasets: list[str]) -> dict[str | None, list[str]]:
+  """Maps each dataset to the datasets whose nearest ancestor in `ordered_datasets` it is. Roots are mapped from None."""
+  known = set(ordered_datasets)
+  children: dict[str | None, list[str]] = {}
+  for ds in ordered_datasets:
+    parts = ds.split('/')
+    parent = next(('/'.join(parts[:i]) for i in range(len(parts)-1, 0, -1) if '/'.join(parts[:i]) in known), None)
+    children.setdefault(parent, []).append(ds)
+  return children
+
+
+def _sort_topologically(ordered_datasets: list[str], key: Callable[[str], Any]) -> list[str]:
+  """Sorts datasets by key, but parents before their children. Datasets must be ordered parents first."""
+  children = _children(ordered_datasets)
+  ready = [(key(ds), ds) for ds in children.get(None, [])]
+  heapq.heapify(ready)
+  result: list[str] = []
+  while ready:
+    _, ds = heapq.heappop(ready)
+    result.append(ds)
+    for child in children.get(ds, []):
+      heapq.heappush(ready, (key(child), child))
+  return result
+
+
+def _replicate_concurrently(ordered_datasets: list[str], replicate: Callable[[str], bool], jobs: int, key: Callable[[str], Any]) -> bool:
+  """
+  Runs `replicate` for each dataset with up to `jobs` datasets at the same time.
+  A dataset is only started once its nearest ancestor in `ordered_datasets` has finished,
+  so that parents are created on the destination before their children.
+  Of the datasets that can be started, the one with the lowest key is started first.
+  Datasets must be ordered parents first. Returns whether all datasets succeeded.
+  """
+  children = _children(ordered_datasets)
+  ready = [(key(ds), ds) for ds in children.get(None, [])]
+  heapq.heapify(ready)
+
+  success = True
+  with ThreadPoolExecutor(max_workers=jobs) as executor:
+    running: dict[Future[bool], str] = {}
+    while ready or running:
+      while ready and len(running) < jobs:
+        _, ds = heapq.heappop(ready)
+        running[executor.submit(replicate, ds)] = ds
+      done, _ = wait(running, return_when=FIRST_COMPLETED)
+      for future in done:
+        ds = running.pop(future)
+        if not future.result():
+          success = False
+        # children are started even if the parent failed, just like in sequential mode
+        for child in children.get(ds, []):
+          heapq.heappush(ready, (key(child), child))
+  return success
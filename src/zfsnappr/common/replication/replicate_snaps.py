@@ -1,11 +1,15 @@
 from __future__ import annotations
 from typing import Optional, cast
 from collections.abc import Collection
+from dataclasses import dataclass
 import logging
-from itertools import pairwise
+from itertools import pairwise, batched
+from subprocess import CalledProcessError
 
-from ..zfs import Snapshot, ZfsCli, ZfsProperty, Dataset
-from .send_receive_snap import send_receive_incremental, send_receive_initial
+from ..zfs import Snapshot, ZfsCli, ZfsBatch, ZfsProperty, Dataset, Inventory
+from .send_receive_snap import send_receive_incremental, send_receive_initial, send_receive_range, send_receive_resume, add_transfer_metadata, MetadataBatches
+from .options import TransferOptions, SEND_FLAG_PROPERTIES
+from .stream import format_size
 from zfsnappr.common.exception import ReplicationError
 from zfsnappr.common.sort import sort_snaps_by_time
 
@@ -20,19 +24,22 @@ def holdtag_dest(src_dataset: Dataset):
   return f'zfsnappr-recvbase-{src_dataset.guid}'
 
 
-# TODO: raw send for encrypted datasets?
 def replicate_snaps(
   source_cli: ZfsCli,
   source_snaps: Collection[Snapshot],
   dest_cli: ZfsCli,
   dest_dataset: str,
-  existing_dest_datasets: Collection[str],
+  dest_inventory: Inventory,
   initialize: bool,
   rollback: bool,
+  options: TransferOptions = TransferOptions(),
+  holds_reconciled: bool = False,
 ):
   """
   replicates source_snaps to dest_dataset
   all source_snaps must be of same dataset
+  dest_inventory must contain dest_dataset, if it exists, with the `RECEIVE_RESUME_TOKEN` property
+  with holds_reconciled, the holds were already updated for the snapshots in dest_inventory, see `reconcile_holds`
 
   Let S and D be the snapshots on source and dest, newest first.
   Then D[0] = S[b] for some index b.
@@ -50,40 +57,56 @@ def replicate_snaps(
 
   ##### PHASE 1: Critical preparation, check for abort conditions
 
+  source_ds = source_cli.get_dataset(source_dataset, properties=SEND_FLAG_PROPERTIES if options.send_flags == 'auto' else [])
+  flags = options.resolve_send_flags([source_ds])
+  if flags:
+    log.debug(f"Sending '{source_dataset}' with flags '{flags}'")
+
   # ensure dest dataset exists
-  if dest_dataset not in existing_dest_datasets:
+  dest_ds: Optional[Dataset] = dest_inventory.datasets.get(dest_dataset)
+  if dest_ds is None:
     if initialize:
       log.info(f"Creating destination dataset '{dest_dataset}' by transferring the oldest snapshot")
-      source_dataset_type = source_cli.get_dataset(source_dataset).type
       send_receive_initial(
         clis=(source_cli, dest_cli),
         dest_dataset=dest_dataset,
-        source_dataset_type=source_dataset_type,
+        source_dataset_type=source_ds.type,
         snapshot=source_snaps[-1],
-        holdtags=(holdtag_src, holdtag_dest)
+        # the dest dataset does not exist yet, so its tag is resolved after the transfer
+        holdtags=(holdtag_src, holdtag_dest(source_ds)),
+        flags=flags,
+        options=options
       )
     else:
       raise ReplicationError(f"Destination dataset '{dest_dataset}' does not exist and will not be created")
 
-  # get dest snaps
-  dest_snaps = dest_cli.get_all_snapshots(datasets=[dest_dataset])
+  # finish or discard an interrupted transfer before looking at the dest snaps
+  inventory_valid = dest_ds is not None
+  dest_ds, finished = finish_partial_receive((source_cli, dest_cli), (source_dataset, dest_dataset), flags, options, dest_ds)
+
+  # get dest snaps, unless they changed since the inventory was listed
+  if inventory_valid and not finished:
+    dest_snaps = list(dest_inventory.snapshots[dest_dataset])
+  else:
+    dest_snaps = dest_cli.get_all_snapshots(datasets=[dest_dataset], cached=False)
   dest_snaps = sort_snaps_by_time(dest_snaps, reverse=True)
 
   # resolve hold tags
-  source_tag = holdtag_src(dest_cli.get_dataset(dest_dataset))
-  dest_tag = holdtag_dest(source_cli.get_dataset(source_dataset))
+  source_tag = holdtag_src(dest_ds)
+  dest_tag = holdtag_dest(source_ds)
 
   # Determine latest common snapshot
   base_snap = determine_latest_common((source_snaps, dest_snaps))
 
-  # Update holds
-  ensure_holds(
-    (source_cli, dest_cli),
-    (source_snaps, dest_snaps),
-    (source_tag, dest_tag),
-    datasets=(source_dataset, dest_dataset),
-    latest_common_snap=base_snap
-  )
+  # Update holds, unless they are up to date
+  if not (holds_reconciled and inventory_valid and not finished):
+    ensure_holds(
+      (source_cli, dest_cli),
+      (source_snaps, dest_snaps),
+      (source_tag, dest_tag),
+      datasets=(source_dataset, dest_dataset),
+      latest_common_snap=base_snap
+    )
 
   if not dest_snaps:
     raise ReplicationError(f"Destination '{dest_dataset}' does not contain any snapshots")
@@ -116,7 +139,7 @@ def replicate_snaps(
 
   # Find snapshot that cannot be transferred because their timestamp equals their predecessor
   for i, (a, b) in enumerate(pairwise(transfer_sequence)):
-    if a.timestamp == b.timestamp:
+    if a.creation == b.creation:
       # Snapshot B cannot be sent
       raise ReplicationError(
         f"Cannot transfer snapshots from '{source_dataset}' to '{dest_dataset}': "
@@ -127,6 +150,9 @@ def replicate_snaps(
   ##### PHASE 2: Everything technically good to go, do some quality-of-life checks before actual transfer
 
   assert len(transfer_sequence) >= 2
+
+  if options.estimate:
+    _log_estimate(source_cli, transfer_sequence, (source_dataset, dest_dataset), flags, options.single_stream)
   
   # Optionally ensure dest is at snapshot
   if rollback:
@@ -134,21 +160,132 @@ def replicate_snaps(
     dest_cli.rollback(dest_snaps[0].longname)
 
 
-  ##### PHASE 3: Transfer snapshots sequentially
+  ##### PHASE 3: Transfer snapshots
+
+  if options.single_stream and len(transfer_sequence) > 2:
+    transfer_sequence = _transfer_single_stream(
+      (source_cli, dest_cli),
+      transfer_sequence,
+      (source_tag, dest_tag),
+      datasets=(source_dataset, dest_dataset),
+      flags=flags,
+      options=options
+    )
+    if len(transfer_sequence) <= 1:
+      log.info(f'Transfer complete')
+      return
 
   total = len(transfer_sequence) - 1
   log.info(f"Transferring {total} snapshots from '{source_dataset}' to '{dest_dataset}'")
-  for i, (_base, _snap) in enumerate(pairwise(transfer_sequence)):
-    send_receive_incremental(
-      clis=(source_cli, dest_cli),
+  count = 0
+  # Tags and holds are updated once per window. The base of the window stays held until
+  # the latest received snapshot of the window is held, also if a transfer fails.
+  for window in batched(pairwise(transfer_sequence), options.hold_window):
+    received: list[Snapshot] = []
+    try:
+      for _base, _snap in window:
+        send_receive_incremental(
+          clis=(source_cli, dest_cli),
+          dest_dataset=dest_dataset,
+          holdtags=(source_tag, dest_tag),
+          snapshot=_snap,
+          base=_base,  # guaranteed to have hold, or to be received in this window
+          flags=flags,
+          options=options,
+          update_metadata=False
+        )
+        received.append(_snap)
+        count += 1
+        log.info(f'{count}/{total} transferred')
+    finally:
+      if received:
+        batches = MetadataBatches((source_cli, dest_cli))
+        add_transfer_metadata(batches, dest_dataset, received, window[0][0], (source_tag, dest_tag))
+        batches.run()
+  log.info(f'Transfer complete')
+
+
+def finish_partial_receive(clis: tuple[ZfsCli,ZfsCli], datasets: tuple[str, str], flags: str, options: TransferOptions, dest_ds: Optional[Dataset] = None) -> tuple[Dataset, bool]:
+  """
+  Resumes an interrupted receive into the dest dataset, or discards it with `options.abort_partial`.
+  `dest_ds` is the dest dataset with the `RECEIVE_RESUME_TOKEN` property, if known.
+  Returns the dest dataset, and whether there was an interrupted receive.
+  """
+  source_dataset, dest_dataset = datasets
+  if dest_ds is None:
+    dest_ds = clis[1].get_dataset(dest_dataset, properties=[ZfsProperty.RECEIVE_RESUME_TOKEN])
+  resume_token = dest_ds.properties.get(ZfsProperty.RECEIVE_RESUME_TOKEN, '-')
+  if resume_token == '-':
+    return dest_ds, False
+  if options.abort_partial:
+    log.info(f"Discarding partially received state of destination '{dest_dataset}'")
+    clis[1].abort_receive(dest_dataset)
+  else:
+    log.info(f"Resuming interrupted transfer from '{source_dataset}' to '{dest_dataset}'")
+    send_receive_resume(clis, dest_dataset, resume_token, flags=flags, options=options)
+  return dest_ds, True
+
+
+def _log_estimate(cli: ZfsCli, transfer_sequence: list[Snapshot], datasets: tuple[str, str], flags: str, single_stream: bool) -> None:
+  """Logs the estimated sizes of the streams that will transfer the sequence"""
+  if single_stream and len(transfer_sequence) > 2:
+    sends = [(transfer_sequence[-1].longname, transfer_sequence[0].longname, True)]
+  else:
+    sends = [(b.longname, a.longname, False) for a, b in pairwise(transfer_sequence)]
+  try:
+    sizes = cli.estimate_send_sizes(sends, flags=flags)
+  except CalledProcessError as e:
+    log.warning(f"Could not estimate transfer sizes: {e}")
+    return
+  log.info(f"Estimated {format_size(sum(sizes))} in {len(sends)} streams from '{datasets[0]}' to '{datasets[1]}'")
+  for (snapshot, _, _), size in zip(sends, sizes):
+    log.debug(f"  {snapshot}: {format_size(size)}")
+
+
+def _transfer_single_stream(clis: tuple[ZfsCli,ZfsCli], transfer_sequence: list[Snapshot], holdtags: tuple[str,str], datasets: tuple[str, str], flags: str = '', options: TransferOptions = TransferOptions()) -> list[Snapshot]:
+  """
+  Sends the transfer sequence, oldest first, as a single `zfs send -I` stream.
+  If the stream fails, holds and tags are reconciled with the snapshots that were received before the failure.
+  Returns the part of the transfer sequence that is left to transfer, starting with the new base.
+  """
+  source_dataset, dest_dataset = datasets
+  log.info(f"Transferring {len(transfer_sequence) - 1} snapshots from '{source_dataset}' to '{dest_dataset}' in a single stream")
+  try:
+    send_receive_range(
+      clis=clis,
       dest_dataset=dest_dataset,
-      holdtags=(source_tag, dest_tag),
-      snapshot=_snap,
-      base=_base  # guaranteed to have hold
+      holdtags=holdtags,
+      snapshots=transfer_sequence[1:],
+      base=transfer_sequence[0],  # guaranteed to have hold
+      flags=flags,
+      options=options
     )
-    log.info(f'{i+1}/{total} transferred')
-  dest_snaps = [s.with_dataset(dest_dataset) for s in reversed(transfer_sequence[1:])] + dest_snaps
-  log.info(f'Transfer complete')
+    return transfer_sequence[-1:]
+  except ReplicationError as e:
+    if not isinstance(e.__cause__, Exception):
+      # interrupted
+      raise
+    log.warning(f"{e}. Falling back to per-snapshot transfer")
+
+  # A -I stream is received snapshot by snapshot, so some snapshots might have been received
+  if options.resumable:
+    finish_partial_receive(clis, datasets, flags, options)
+  dest_snaps = sort_snaps_by_time(clis[1].get_all_snapshots(datasets=[dest_dataset], cached=False), reverse=True)
+  source_snaps = list(reversed(transfer_sequence))
+  base_snap = determine_latest_common((source_snaps, dest_snaps))
+  if base_snap is None or base_snap[1].guid != dest_snaps[0].guid:
+    raise ReplicationError(f"Cannot resume transfer to '{dest_dataset}' after failed single-stream transfer")
+  ensure_holds(clis, (source_snaps, dest_snaps), holdtags, latest_common_snap=base_snap, datasets=datasets)
+
+  base_index = next(i for i, s in enumerate(transfer_sequence) if s.guid == base_snap[0].guid)
+  batch = clis[1].batch()
+  for snap in transfer_sequence[1:base_index+1]:
+    if snap.tags is not None:
+      batch.set_tags(snap.with_dataset(dest_dataset).longname, snap.tags)
+  batch.run()
+  if base_index > 0:
+    log.info(f"{base_index} snapshots were transferred before the failure")
+  return transfer_sequence[base_index:]
 
 
 def ensure_holds(clis: tuple[ZfsCli,ZfsCli], snaps: tuple[list[Snapshot],list[Snapshot]], holdtags: tuple[str,str], latest_common_snap: tuple[Snapshot, Snapshot] | None, datasets: tuple[str, str]):
@@ -158,36 +295,69 @@ def ensure_holds(clis: tuple[ZfsCli,ZfsCli], snaps: tuple[list[Snapshot],list[Sn
   1. There are no holdtags on either side, since there was no common snapshot
   2. There is exactly one holdtag on each side, on the latest common snapshot
   """
-  # Get holds
-  holds = (
-    clis[0].get_holdtags([s.longname for s in snaps[0]], userrefs={s.longname: s.holds for s in snaps[0]}),
-    clis[1].get_holdtags([s.longname for s in snaps[1]], userrefs={s.longname: s.holds for s in snaps[1]})
+  reconcile_holds(clis, [HoldState(snaps, holdtags, latest_common_snap, datasets)])
+
+
+@dataclass
+class HoldState:
+  """Snapshots of a dataset pair, newest first, with the hold tags of the pair and the latest common snapshot"""
+  snaps: tuple[list[Snapshot], list[Snapshot]]
+  holdtags: tuple[str, str]
+  latest_common_snap: tuple[Snapshot, Snapshot] | None
+  datasets: tuple[str, str]
+
+
+def reconcile_holds(clis: tuple[ZfsCli,ZfsCli], states: Collection[HoldState]) -> None:
+  """
+  Like `ensure_holds` for many dataset pairs at once.
+  The holds of all pairs are queried with a single command per side, and all changes are applied together,
+  the holds of both sides before the releases.
+  """
+  holds = get_holdtags(clis, states)
+  batches = MetadataBatches(clis)
+  for state in states:
+    update_holds(batches, state.snaps, state.holdtags, holds, state.latest_common_snap, state.datasets)
+  batches.run()
+
+
+def get_holdtags(clis: tuple[ZfsCli,ZfsCli], states: Collection[HoldState]) -> tuple[dict[str, set[str]], dict[str, set[str]]]:
+  """Queries the hold tags of the snapshots of all pairs with a single command per side"""
+  all_snaps = (
+    [s for state in states for s in state.snaps[0]],
+    [s for state in states for s in state.snaps[1]]
+  )
+  return (
+    clis[0].get_holdtags([s.longname for s in all_snaps[0]], userrefs={s.longname: s.holds for s in all_snaps[0]}),
+    clis[1].get_holdtags([s.longname for s in all_snaps[1]], userrefs={s.longname: s.holds for s in all_snaps[1]})
   )
 
+
+def update_holds(batches: MetadataBatches, snaps: tuple[list[Snapshot],list[Snapshot]], holdtags: tuple[str,str], holds: tuple[dict[str, set[str]], dict[str, set[str]]], latest_common_snap: tuple[Snapshot, Snapshot] | None, datasets: tuple[str, str]):
+  """Adds the hold changes of `ensure_holds` to the given batches, based on the current holds"""
   if latest_common_snap is None:
     # Remove all peer holdtags
     release_snaps = (
       [s.longname for s in snaps[0]],
       [s.longname for s in snaps[1]]
     )
-    _release_holds(clis, release_snaps, holdtags, current_holdtags=holds, datasets=datasets)
+    _release_holds(batches.releases, release_snaps, holdtags, current_holdtags=holds, datasets=datasets)
     return
 
   # Ensure latest common snap is held
   src_snap, dest_snap = latest_common_snap
   if holdtags[0] not in holds[0][src_snap.longname]:
     log.info(f"Creating hold for latest common snapshot '{src_snap.shortname}' on source '{src_snap.dataset}'")
-    clis[0].hold([src_snap.longname], tag=holdtags[0])
+    batches.holds[0].hold([src_snap.longname], tag=holdtags[0])
   if holdtags[1] not in holds[1][dest_snap.longname]:
     log.info(f"Creating hold for latest common snapshot '{dest_snap.shortname}' on destination '{dest_snap.dataset}'")
-    clis[1].hold([dest_snap.longname], tag=holdtags[1])
+    batches.holds[1].hold([dest_snap.longname], tag=holdtags[1])
 
-  # Remove all other holdtags
+  # Remove all other holdtags. These are only released if the new holds were created on both sides.
   release_snaps = (
     [s.longname for s in snaps[0] if s.guid != latest_common_snap[0].guid],
     [s.longname for s in snaps[1] if s.guid != latest_common_snap[1].guid]
   )
-  _release_holds(clis, release_snaps, holdtags, current_holdtags=holds, datasets=datasets)
+  _release_holds(batches.releases, release_snaps, holdtags, current_holdtags=holds, datasets=datasets)
 
 
 def determine_latest_common(snaps: tuple[list[Snapshot],list[Snapshot]]) -> tuple[Snapshot, Snapshot] | None:
@@ -202,8 +372,8 @@ def determine_latest_common(snaps: tuple[list[Snapshot],list[Snapshot]]) -> tupl
 
   # For determinism, sort by GUID if timestamps are equal.
   # Just to be safe, ensure the snapshot is actually the latest common snapshot on both sides.
-  _latest_guid_src = max(common_guids, key=lambda g: (guid_to_snap[0][g].timestamp, g))
-  _latest_guid_dest = max(common_guids, key=lambda g: (guid_to_snap[1][g].timestamp, g))
+  _latest_guid_src = max(common_guids, key=lambda g: (guid_to_snap[0][g].creation, g))
+  _latest_guid_dest = max(common_guids, key=lambda g: (guid_to_snap[1][g].creation, g))
   assert _latest_guid_src == _latest_guid_dest
   latest_guid = _latest_guid_src
   latest_common_snap = (guid_to_snap[0][latest_guid], guid_to_snap[1][latest_guid])
@@ -212,7 +382,7 @@ def determine_latest_common(snaps: tuple[list[Snapshot],list[Snapshot]]) -> tupl
   return latest_common_snap
 
 
-def _release_holds(clis: tuple[ZfsCli, ZfsCli], snaps: tuple[list[str], list[str]], release_holdtags: tuple[str, str], current_holdtags: tuple[dict[str, set[str]], dict[str, set[str]]], datasets: tuple[str, str]):
+def _release_holds(batches: tuple[ZfsBatch, ZfsBatch], snaps: tuple[list[str], list[str]], release_holdtags: tuple[str, str], current_holdtags: tuple[dict[str, set[str]], dict[str, set[str]]], datasets: tuple[str, str]):
   # Filter for snaps that have the holdtags
   release_snaps = (
     [s for s in snaps[0] if release_holdtags[0] in current_holdtags[0][s]],
@@ -222,5 +392,5 @@ def _release_holds(clis: tuple[ZfsCli, ZfsCli], snaps: tuple[list[str], list[str
     log.info(f"Releasing {len(release_snaps[0])} obsolete holds in source '{datasets[0]}'")
   if release_snaps[1]:
     log.info(f"Releasing {len(release_snaps[1])} obsolete holds in destination '{datasets[1]}'")
-  clis[0].release_hold(release_snaps[0], release_holdtags[0])
-  clis[1].release_hold(release_snaps[1], release_holdtags[1])
+  batches[0].release_hold(release_snaps[0], release_holdtags[0])
+  batches[1].release_hold(release_snaps[1], release_holdtags[1])
@@ -0,0 +1,136 @@
+from __future__ import annotations
+from collections.abc import Collection
+from itertools import pairwise
+import logging
+
+from ..zfs import Snapshot, ZfsCli, Inventory
+from ..utils import group_snaps_by_dataset
+from zfsnappr.common.exception import ReplicationError
+from zfsnappr.common.sort import sort_snaps_by_time
+from .replicate_snaps import holdtag_src, holdtag_dest, determine_latest_common, reconcile_holds, HoldState
+from .send_receive_snap import send_receive_tree, add_transfer_metadata, MetadataBatches
+from .options import TransferOptions, SEND_FLAG_PROPERTIES
+
+
+log = logging.getLogger(__name__)
+
+
+def replicate_tree(
+  source_cli: ZfsCli,
+  source_dataset_root: str,
+  source_snaps: Collection[Snapshot],
+  dest_cli: ZfsCli,
+  dest_dataset_root: str,
+  dest_inventory: Inventory,
+  exclude_datasets: Collection[str],
+  rollback: bool,
+  options: TransferOptions = TransferOptions(),
+) -> bool:
+  """
+  replicates the whole hierarchy under source_dataset_root with a single `zfs send -R -I` stream
+  source_snaps must be sorted from latest to oldest
+
+  This is only possible if all source datasets have the same snapshot names, no dataset is excluded,
+  and every dataset already exists on the destination with the same latest common snapshot.
+  Returns False if that is not the case, or if the stream failed. The caller should then replicate per dataset.
+  """
+  def _in_tree(ds: str, root: str) -> bool:
+    return ds == root or ds.startswith(root + '/')
+
+  if any(_in_tree(d, source_dataset_root) for d in exclude_datasets):
+    log.info(f"Cannot use a recursive stream for '{source_dataset_root}' because datasets are excluded")
+    return False
+
+  # all datasets must have the same snapshots, including datasets without any snapshots
+  source_datasets = {
+    d.name: d for d in source_cli.get_all_datasets(
+      properties=SEND_FLAG_PROPERTIES if options.send_flags == 'auto' else [],
+      datasets=[source_dataset_root],
+      recursive=True
+    )
+  }
+  grouped = group_snaps_by_dataset(source_snaps)
+  names = [s.shortname for s in grouped.get(source_dataset_root, [])]
+  if not names or any([s.shortname for s in grouped.get(ds, [])] != names for ds in source_datasets):
+    log.info(f"Cannot use a recursive stream for '{source_dataset_root}' because not all datasets have the same snapshots")
+    return False
+
+  # datasets that do not exist on the destination would be created with the received properties
+  pairs = {ds: dest_dataset_root + ds[len(source_dataset_root):] for ds in source_datasets}
+  if any(d not in dest_inventory.datasets for d in pairs.values()):
+    log.info(f"Cannot use a recursive stream for '{source_dataset_root}' because not all datasets exist at destination '{dest_dataset_root}'")
+    return False
+
+  dest_grouped = {ds: sort_snaps_by_time(snaps, reverse=True) for ds, snaps in dest_inventory.snapshots.items()}
+
+  # every pair must have the same latest common snapshot, and nothing newer on the destination
+  bases: dict[str, tuple[Snapshot, Snapshot]] = {}
+  for ds, dest_ds in pairs.items():
+    dest_list = list(dest_grouped.get(dest_ds, []))
+    common = determine_latest_common((list(grouped[ds]), dest_list))
+    if common is None or common[1].guid != dest_list[0].guid:
+      log.info(f"Cannot use a recursive stream for '{source_dataset_root}' because '{dest_ds}' is not in sync")
+      return False
+    bases[ds] = common
+  if len({b[0].shortname for b in bases.values()}) != 1:
+    log.info(f"Cannot use a recursive stream for '{source_dataset_root}' because the latest common snapshots differ")
+    return False
+
+  root_snaps = list(grouped[source_dataset_root])
+  base_index = next(i for i, s in enumerate(root_snaps) if s.guid == bases[source_dataset_root][0].guid)
+  transfer_sequence = list(reversed(root_snaps[:base_index+1]))
+  if any(a.creation == b.creation for a, b in pairwise(transfer_sequence)):
+    log.info(f"Cannot use a recursive stream for '{source_dataset_root}' because snapshots share a timestamp with their predecessor")
+    return False
+
+  holdtags = {ds: (holdtag_src(dest_inventory.datasets[dest_ds]), holdtag_dest(source_datasets[ds])) for ds, dest_ds in pairs.items()}
+
+  # move holds to the latest common snapshots
+  reconcile_holds((source_cli, dest_cli), [
+    HoldState((list(grouped[ds]), list(dest_grouped[dest_ds])), holdtags[ds], bases[ds], datasets=(ds, dest_ds))
+    for ds, dest_ds in pairs.items()
+  ])
+
+  if len(transfer_sequence) <= 1:
+    log.info(f"Source '{source_dataset_root}' has no new snapshots to transfer")
+    return True
+
+  if rollback:
+    log.info(f"Rolling back {len(pairs)} destination datasets to latest snapshot")
+    for dest_ds in pairs.values():
+      dest_cli.rollback(dest_grouped[dest_ds][0].longname)
+
+  log.info(f"Transferring {len(transfer_sequence) - 1} snapshots of {len(pairs)} datasets from '{source_dataset_root}' to '{dest_dataset_root}' in a recursive stream")
+  # the flags apply to the whole stream, so they must suit all datasets
+  flags = options.resolve_send_flags(source_datasets.values())
+  try:
+    send_receive_tree((source_cli, dest_cli), dest_dataset_root, snapshot=transfer_sequence[-1], base=transfer_sequence[0], flags=flags, options=options)
+  except ReplicationError as e:
+    if not isinstance(e.__cause__, Exception):
+      # interrupted
+      raise
+    log.warning(f"{e}. Falling back to per-dataset replication")
+    # snapshots are received one by one, so some might have been received
+    received = {s.longname for s in dest_cli.get_all_snapshots(datasets=[dest_dataset_root], recursive=True, cached=False)}
+    success = False
+  else:
+    received = None
+    success = True
+
+  # set tags and move holds from base to latest received snapshot, per dataset
+  batches = MetadataBatches((source_cli, dest_cli))
+  for ds, dest_ds in pairs.items():
+    by_shortname = {s.shortname: s for s in grouped[ds]}
+    snaps: list[Snapshot] = []
+    for snap in transfer_sequence[1:]:
+      if received is not None and snap.with_dataset(dest_ds).longname not in received:
+        break
+      snaps.append(by_shortname[snap.shortname])
+    if snaps:
+      add_transfer_metadata(batches, dest_ds, snaps, bases[ds][0], holdtags[ds])
+  batches.run()
+
+  if success:
+    log.info(f'Transfer complete')
+    options.progress.dataset_summary(dest_dataset_root)
+  return success
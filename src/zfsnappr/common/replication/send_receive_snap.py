@@ -1,17 +1,42 @@
 from typing import Optional, Callable, Union
+from subprocess import PIPE, Popen
+from collections.abc import Sequence
 from subprocess import CalledProcessError
 import logging
 import threading
-import time
+import os
 
-from ..zfs import ZfsCli, Snapshot, ZfsProperty, Dataset, ZfsDatasetType
+from ..zfs import ZfsCli, ZfsBatch, Snapshot, ZfsProperty, Dataset, ZfsDatasetType
 from zfsnappr.common.exception import ReplicationError
+from .options import TransferOptions, receive_exclude_properties
+from .stream import RingBuffer, Pump, Tee
+from .ratelimit import RateLimiter
+from .compression import CompressionPlan, plan_compression
+from .supervise import iter_exits
 
 Holdtag = Union[str, Callable[[Dataset],str]]
 
 log = logging.getLogger(__name__)
 
 
+class MetadataBatches:
+  """
+  Metadata changes of a source and a dest, applied by `run` in two phases:
+  first the holds and tags of both sides, then the releases of both sides.
+  The releases are only applied if all holds were created, so the base stays held on both sides until its successor is.
+  """
+  holds: tuple[ZfsBatch, ZfsBatch]
+  releases: tuple[ZfsBatch, ZfsBatch]
+
+  def __init__(self, clis: tuple[ZfsCli, ZfsCli]) -> None:
+    self.holds = (clis[0].batch(), clis[1].batch())
+    self.releases = (clis[0].batch(), clis[1].batch())
+
+  def run(self) -> None:
+    for batch in (*self.holds, *self.releases):
+      batch.run()
+
+
 def start_progress_thread(send_proc, on_progress):
     def _reader():
         assert send_proc.stderr is not None
@@ -24,78 +49,104 @@ def start_progress_thread(send_proc, on_progress):
     return t
 
 
-def _send_receive(
+def _run_pipeline(
   clis: tuple[ZfsCli, ZfsCli],
   dest_dataset: str,
-  snapshot: Snapshot,
-  base: Optional[Snapshot],
-  holdtags: tuple[Holdtag,Holdtag],
-  properties: dict[str, str] = {}
+  snapshot_fullname: Optional[str],
+  base_fullname: Optional[str],
+  properties: dict[str, str] = {},
+  intermediates: bool = False,
+  recursive: bool = False,
+  flags: str = '',
+  options: TransferOptions = TransferOptions(),
+  resume_token: Optional[str] = None
 ) -> None:
-  """If base is given, it must have a hold."""
+  """
+  Runs `zfs send | zfs receive` until both terminate. On failure or interrupt, both processes are stopped.
+  With `resume_token`, an interrupted transfer is resumed instead of sending `snapshot_fullname`.
+  With a buffer size in `options`, the stream passes through an in-memory buffer.
+  With a compression codec in `options`, the stream is compressed between the hosts.
+  """
   src_cli, dest_cli = clis
   send_proc, recv_proc = None, None
-  terminated_send, terminated_recv = False, False
+  stages: list[RingBuffer | Pump] = []
+
+  plan = plan_compression(clis, options.compression, options.compression_level, flags) if options.compression else None
+  use_stages = plan is not None or options.buffer_size > 0 or bool(options.rate_limiters)
+  progress = options.progress.start(dest_dataset, snapshot_fullname)
 
   try:
     # 1) Start sender: stdout=PIPE for data, stderr=PIPE for progress
-    send_proc = src_cli.send_snapshot_async(snapshot.longname, base.longname if base else None)
+    if resume_token is not None:
+      send_proc = src_cli.send_resume_async(resume_token, filter_cmd=plan.send_cmd if plan else None)
+    else:
+      assert snapshot_fullname is not None
+      send_proc = src_cli.send_snapshot_async(
+        snapshot_fullname,
+        base_fullname,
+        intermediates=intermediates,
+        recursive=recursive,
+        flags=flags,
+        filter_cmd=plan.send_cmd if plan else None
+      )
     assert send_proc.stdout is not None
     assert send_proc.stderr is not None
 
     # 2) Start receiver, feeding it the sender's stdout
-    recv_proc = dest_cli.receive_snapshot_async(dest_dataset, send_proc.stdout, properties)
+    recv_proc = dest_cli.receive_snapshot_async(
+      dest_dataset,
+      PIPE if use_stages else send_proc.stdout,
+      properties,
+      exclude_properties=receive_exclude_properties(flags, properties, recursive=recursive),
+      filter_cmd=plan.receive_cmd if plan else None,
+      # replication streams cannot be resumed
+      resumable=options.resumable and not recursive,
+      recursive=recursive
+    )
 
-    # Parent no longer needs its copy of the pipe
-    send_proc.stdout.close()
+    if use_stages:
+      assert recv_proc.stdin is not None
+      stages = _start_stages(send_proc.stdout, recv_proc.stdin, plan, options)
+    else:
+      # Parent no longer needs its copy of the pipe
+      send_proc.stdout.close()
 
-    # 4) Start a thread to drain progress output
-    progress_thread = start_progress_thread(send_proc, lambda s: log.info(f"    {s}"))
+    # 4) Start a thread to parse progress output
+    progress_thread = start_progress_thread(send_proc, lambda s: options.progress.handle_line(progress, s))
 
     # wait for both processes to terminate
-    while True:
-      send_status, recv_status = send_proc.poll(), recv_proc.poll()
-
-      if send_status is not None and recv_status is not None:
-        # both terminated
-        break
-
-      if send_status not in (None, 0) and not terminated_recv:
-        # zfs send process died with error
-        recv_proc.terminate()
-        terminated_recv = True
-
-      if recv_status not in (None, 0) and not terminated_send:
-        # zfs receive process died with error
-        send_proc.terminate()
-        terminated_send = True
-
-      time.sleep(0.1)
+    for proc in iter_exits((send_proc, recv_proc)):
+      if proc.returncode != 0:
+        # stop the other side right away, instead of letting it write into or wait on a dead pipe
+        for other in (send_proc, recv_proc):
+          if other.poll() is None:
+            other.terminate()
 
     progress_thread.join(timeout=1)
+    for stage in stages:
+      stage.join(timeout=1)
+      if isinstance(stage, RingBuffer):
+        log.info(f"    Buffer: {stage.stats}")
+      elif plan is not None:
+        log.info(f"    Compression ({plan}): {stage.stats}")
+      else:
+        log.info(f"    Stream: {stage.stats}")
 
     # check exit codes
     for p in send_proc, recv_proc:
       if p.returncode != 0:
         raise CalledProcessError(p.returncode, cmd=p.args)
-      
-    # set tags on dest snapshot
-    if snapshot.tags is not None:
-      dest_cli.set_tags(snapshot.with_dataset(dest_dataset).longname, snapshot.tags)
+    for stage in stages:
+      if stage.error is not None:
+        raise stage.error
+    options.progress.finish(progress, success=True)
 
-    # hold snaps
-    src_tag = holdtags[0] if isinstance(holdtags[0], str) else holdtags[0](dest_cli.get_dataset(dest_dataset))
-    dest_tag = holdtags[1] if isinstance(holdtags[1], str) else holdtags[1](src_cli.get_dataset(snapshot.dataset))
-    src_cli.hold([snapshot.longname], src_tag)
-    dest_cli.hold([snapshot.with_dataset(dest_dataset).longname], dest_tag)
-
-    # Release base snaps (must have hold)
-    if base is not None:
-      src_cli.release_hold([base.longname], src_tag)
-      dest_cli.release_hold([base.with_dataset(dest_dataset).longname], dest_tag)
-  
-  except BaseException as e:
+  except BaseException:
+    options.progress.finish(progress, success=False)
     log.info("Cleaning up")
+    for stage in stages:
+      if isinstance(stage, RingBuffer):
+        stage.close()
     # On Ctrl+C or any exception, try to stop both sides.
     # terminate() is "graceful-ish"; if you need hard kill, follow with kill().
     for p in (recv_proc, send_proc):
@@ -110,18 +161,201 @@ def _send_receive(
                     p.kill()
                 except Exception:
                     pass
-    raise ReplicationError(
-      f"Replication of snapshot '{snapshot.shortname}' from '{snapshot.dataset}' to '{dest_dataset}' failed"
-    ) from e
+    raise
 
 
-def send_receive_initial(
+def _run_fanout_pipeline(
+  src_cli: ZfsCli,
+  dests: Sequence[tuple[ZfsCli, str]],
+  snapshot_fullname: str,
+  base_fullname: Optional[str],
+  properties: dict[str, str] = {},
+  flags: str = '',
+  options: TransferOptions = TransferOptions(),
+  limiters: Sequence[Sequence[RateLimiter]] = ()
+) -> list[Optional[BaseException]]:
+  """
+  Runs a single `zfs send` into one `zfs receive` per destination, through a `Tee`.
+  `limiters` are the rate limiters of each destination, in addition to the ones in `options`.
+  A failed receiver is dropped without stopping the others. If the sender fails, all receivers are stopped.
+  With a buffer size in `options`, each receiver gets its own buffer, so that short stalls of one receiver do not hold up the others.
+  Returns the error of each destination, or None if it succeeded. Raises if the sender fails or on interrupt.
+  """
+  send_proc = None
+  recv_procs: list[Popen] = []
+  buffers: list[Optional[RingBuffer]] = []
+  tee: Optional[Tee] = None
+  progress = options.progress.start(snapshot_fullname.split('@')[0], snapshot_fullname)
+
+  try:
+    send_proc = src_cli.send_snapshot_async(snapshot_fullname, base_fullname, flags=flags)
+    assert send_proc.stdout is not None
+
+    sinks = []
+    for dest_cli, dest_dataset in dests:
+      recv_proc = dest_cli.receive_snapshot_async(
+        dest_dataset,
+        PIPE,
+        properties,
+        exclude_properties=receive_exclude_properties(flags, properties),
+        resumable=options.resumable
+      )
+      assert recv_proc.stdin is not None
+      recv_procs.append(recv_proc)
+      if options.buffer_size:
+        r, w = os.pipe()
+        buffers.append(RingBuffer(open(r, 'rb', buffering=0), recv_proc.stdin, options.buffer_size, options.buffer_high, options.buffer_low).start())
+        sinks.append(open(w, 'wb', buffering=0))
+      else:
+        buffers.append(None)
+        sinks.append(recv_proc.stdin)
+    tee = Tee(send_proc.stdout, sinks, options.rate_limiters, limiters).start()
+
+    progress_thread = start_progress_thread(send_proc, lambda s: options.progress.handle_line(progress, s))
+
+    for proc in iter_exits((send_proc, *recv_procs)):
+      if proc is send_proc and proc.returncode != 0:
+        # the receivers would only wait for the rest of the stream
+        for other in recv_procs:
+          if other.poll() is None:
+            other.terminate()
+
+    progress_thread.join(timeout=1)
+    tee.join(timeout=1)
+    log.info(f"    Tee: {tee.stats}")
+    for buffer in buffers:
+      if buffer is not None:
+        buffer.join(timeout=1)
+
+    if send_proc.returncode != 0:
+      raise CalledProcessError(send_proc.returncode, cmd=send_proc.args)
+    errors: list[Optional[BaseException]] = []
+    for i, (recv_proc, buffer) in enumerate(zip(recv_procs, buffers)):
+      if recv_proc.returncode != 0:
+        errors.append(CalledProcessError(recv_proc.returncode, cmd=recv_proc.args))
+      elif buffer is not None and buffer.error is not None:
+        errors.append(buffer.error)
+      else:
+        errors.append(tee.failed.get(i))
+    options.progress.finish(progress, success=not all(errors))
+    return errors
+
+  except BaseException:
+    options.progress.finish(progress, success=False)
+    log.info("Cleaning up")
+    for buffer in buffers:
+      if buffer is not None:
+        buffer.close()
+    procs = [p for p in (*recv_procs, send_proc) if p is not None]
+    for p in procs:
+      if p.poll() is None:
+        p.terminate()
+    for p in procs:
+      try:
+        p.wait(timeout=5)
+      except Exception:
+        try:
+          p.kill()
+        except Exception:
+          pass
+    raise
+
+
+def _start_stages(source, sink, plan: Optional[CompressionPlan], options: TransferOptions) -> list[RingBuffer | Pump]:
+  """
+  Connects source and sink through the in-process stages. The pump either compresses or decompresses
+  in Python, or only counts the compressed bytes, and applies the rate limits to the compressed bytes.
+  Local compression comes before the buffer, so that the buffer holds compressed data. Local decompression comes after it.
+  """
+  factories: list[Callable[..., RingBuffer | Pump]] = []
+  if plan is not None or options.rate_limiters:
+    # with local compression, the output of the pump is sent over the wire
+    limit_output = plan is not None and plan.send_cmd is None
+    factories.append(lambda src, dst: Pump(src, dst, plan.transform if plan else None, options.rate_limiters, limit_output))
+  if options.buffer_size:
+    buffer = lambda src, dst: RingBuffer(src, dst, options.buffer_size, options.buffer_high, options.buffer_low)
+    factories.insert(0 if plan is not None and plan.send_cmd is not None else len(factories), buffer)
+
+  stages: list[RingBuffer | Pump] = []
+  current = source
+  for i, factory in enumerate(factories):
+    if i == len(factories) - 1:
+      out, next_in = sink, None
+    else:
+      r, w = os.pipe()
+      out, next_in = open(w, 'wb', buffering=0), open(r, 'rb', buffering=0)
+    stages.append(factory(current, out).start())
+    current = next_in
+  return stages
+
+
+def _send_receive(
   clis: tuple[ZfsCli, ZfsCli],
   dest_dataset: str,
-  source_dataset_type: ZfsDatasetType,
   snapshot: Snapshot,
-  holdtags: tuple[Callable[[Dataset], str], Callable[[Dataset], str]]
+  base: Optional[Snapshot],
+  holdtags: tuple[Holdtag,Holdtag],
+  properties: dict[str, str] = {},
+  intermediates: Sequence[Snapshot] = (),
+  flags: str = '',
+  options: TransferOptions = TransferOptions(),
+  update_metadata: bool = True
 ) -> None:
+  """
+  If base is given, it must have a hold.
+  `intermediates` are the snapshots between base and snapshot. If given, they are sent in the same stream.
+  Without `update_metadata`, the caller must apply `add_transfer_metadata` after the transfer.
+  """
+  src_cli, dest_cli = clis
+
+  try:
+    _run_pipeline(
+      clis,
+      dest_dataset,
+      snapshot.longname,
+      base.longname if base else None,
+      properties=properties,
+      intermediates=bool(intermediates),
+      flags=flags,
+      options=options
+    )
+    if not update_metadata:
+      return
+
+    src_tag = holdtags[0] if isinstance(holdtags[0], str) else holdtags[0](dest_cli.get_dataset(dest_dataset))
+    dest_tag = holdtags[1] if isinstance(holdtags[1], str) else holdtags[1](src_cli.get_dataset(snapshot.dataset))
+    batches = MetadataBatches(clis)
+    add_transfer_metadata(batches, dest_dataset, [*intermediates, snapshot], base, (src_tag, dest_tag))
+    batches.run()
+
+  except BaseException as e:
+    what = f"snapshots up to '{snapshot.shortname}'" if intermediates else f"snapshot '{snapshot.shortname}'"
+    raise ReplicationError(
+      f"Replication of {what} from '{snapshot.dataset}' to '{dest_dataset}' failed"
+    ) from e
+
+
+def add_transfer_metadata(batches: MetadataBatches, dest_dataset: str, snapshots: Sequence[Snapshot], base: Optional[Snapshot], holdtags: tuple[str, str]) -> None:
+  """
+  Adds the metadata changes after `snapshots` were received, oldest first, to the batches:
+  tags are set on the dest snapshots, the latest snapshot is held on both sides and the holds on base are released.
+  Base is only released if the new holds were created on both sides.
+  """
+  for snap in snapshots:
+    if snap.tags is not None:
+      batches.holds[1].set_tags(snap.with_dataset(dest_dataset).longname, snap.tags)
+
+  latest = snapshots[-1]
+  batches.holds[0].hold([latest.longname], holdtags[0])
+  batches.holds[1].hold([latest.with_dataset(dest_dataset).longname], holdtags[1])
+
+  if base is not None:
+    batches.releases[0].release_hold([base.longname], holdtags[0])
+    batches.releases[1].release_hold([base.with_dataset(dest_dataset).longname], holdtags[1])
+
+
+def initial_properties(source_dataset_type: ZfsDatasetType) -> dict[str, str]:
+  """Properties of a newly created destination dataset"""
   assert source_dataset_type in (ZfsDatasetType.FILESYSTEM, ZfsDatasetType.VOLUME)
   properties: dict[str, str] = {
     ZfsProperty.READONLY: 'on'
@@ -132,13 +366,27 @@ def send_receive_initial(
       ZfsProperty.CANMOUNT: 'off',
       ZfsProperty.MOUNTPOINT: 'none'
     }
+  return properties
+
+
+def send_receive_initial(
+  clis: tuple[ZfsCli, ZfsCli],
+  dest_dataset: str,
+  source_dataset_type: ZfsDatasetType,
+  snapshot: Snapshot,
+  holdtags: tuple[Holdtag, Holdtag],
+  flags: str = '',
+  options: TransferOptions = TransferOptions()
+) -> None:
   _send_receive(
     clis=clis,
     dest_dataset=dest_dataset,
     snapshot=snapshot,
     base=None,
     holdtags=holdtags,
-    properties=properties
+    properties=initial_properties(source_dataset_type),
+    flags=flags,
+    options=options
   )
 
 
@@ -148,11 +396,112 @@ def send_receive_incremental(
   holdtags: tuple[str,str],
   snapshot: Snapshot,
   base: Snapshot,
+  flags: str = '',
+  options: TransferOptions = TransferOptions(),
+  update_metadata: bool = True
 ) -> None:
   _send_receive(
     clis=clis,
     dest_dataset=dest_dataset,
     snapshot=snapshot,
     base=base,
-    holdtags=holdtags
+    holdtags=holdtags,
+    flags=flags,
+    options=options,
+    update_metadata=update_metadata
+  )
+
+
+def send_receive_range(
+  clis: tuple[ZfsCli, ZfsCli],
+  dest_dataset: str,
+  holdtags: tuple[str,str],
+  snapshots: Sequence[Snapshot],
+  base: Snapshot,
+  flags: str = '',
+  options: TransferOptions = TransferOptions()
+) -> None:
+  """Sends `snapshots`, oldest first, as a single incremental stream from base to the last snapshot"""
+  assert snapshots
+  _send_receive(
+    clis=clis,
+    dest_dataset=dest_dataset,
+    snapshot=snapshots[-1],
+    base=base,
+    holdtags=holdtags,
+    intermediates=snapshots[:-1],
+    flags=flags,
+    options=options
   )
+
+
+def send_receive_tree(
+  clis: tuple[ZfsCli, ZfsCli],
+  dest_dataset: str,
+  snapshot: Snapshot,
+  base: Snapshot,
+  flags: str = '',
+  options: TransferOptions = TransferOptions()
+) -> None:
+  """
+  Sends all snapshots between base and snapshot of the dataset and all its descendants as a single
+  `zfs send -R -I` replication stream. Holds and tags are not updated.
+  """
+  try:
+    _run_pipeline(clis, dest_dataset, snapshot.longname, base.longname, intermediates=True, recursive=True, flags=flags, options=options)
+  except BaseException as e:
+    raise ReplicationError(
+      f"Recursive replication of snapshots up to '{snapshot.shortname}' from '{snapshot.dataset}' to '{dest_dataset}' failed"
+    ) from e
+
+
+def send_receive_resume(
+  clis: tuple[ZfsCli, ZfsCli],
+  dest_dataset: str,
+  token: str,
+  flags: str = '',
+  options: TransferOptions = TransferOptions()
+) -> None:
+  """
+  Resumes an interrupted transfer to dest_dataset. Holds and tags are not updated.
+  `flags` should be the flags of the interrupted send; they are only used to set up the pipeline.
+  """
+  try:
+    _run_pipeline(clis, dest_dataset, None, None, flags=flags, options=options, resume_token=token)
+  except BaseException as e:
+    raise ReplicationError(f"Resuming the interrupted transfer to '{dest_dataset}' failed") from e
+
+
+def send_receive_fanout(
+  src_cli: ZfsCli,
+  dests: Sequence[tuple[ZfsCli, str]],
+  snapshot: Snapshot,
+  base: Optional[Snapshot],
+  properties: dict[str, str] = {},
+  flags: str = '',
+  options: TransferOptions = TransferOptions(),
+  limiters: Sequence[Sequence[RateLimiter]] = ()
+) -> list[Optional[ReplicationError]]:
+  """
+  Sends snapshot once and receives it into all destinations, incrementally from base if given. Holds and tags are not updated.
+  `limiters` are the rate limiters of each destination.
+  Returns the error of each destination, or None if it succeeded. If the sender fails, all destinations fail.
+  """
+  what = f"snapshot '{snapshot.shortname}' from '{snapshot.dataset}'"
+  try:
+    errors = _run_fanout_pipeline(src_cli, dests, snapshot.longname, base.longname if base else None, properties=properties, flags=flags, options=options, limiters=limiters)
+  except BaseException as e:
+    if not isinstance(e, Exception):
+      # interrupted
+      raise ReplicationError(f"Replication of {what} was interrupted") from e
+    errors = [e] * len(dests)
+
+  results: list[Optional[ReplicationError]] = []
+  for (_, dest_dataset), error in zip(dests, errors):
+    if error is None:
+      results.append(None)
+      continue
+    result = ReplicationError(f"Replication of {what} to '{dest_dataset}' failed")
+    result.__cause__ = error
+    results.append(result)
+  return results
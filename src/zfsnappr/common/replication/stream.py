@@ -0,0 +1,381 @@
+from __future__ import annotations
+from typing import IO, Optional, Protocol
+from collections.abc import Sequence
+from dataclasses import dataclass
+import threading
+import logging
+import errno
+import time
+import os
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+from .ratelimit import RateLimiter
+
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def enlarge_pipe(file: IO[bytes], size: int = CHUNK_SIZE) -> None:
+  """Increases the kernel buffer of a pipe, if supported. Reduces the number of context switches."""
+  if fcntl is None or not hasattr(fcntl, 'F_SETPIPE_SZ'):
+    return
+  try:
+    fcntl.fcntl(file.fileno(), fcntl.F_SETPIPE_SZ, size)
+  except OSError:
+    # not a pipe, or size exceeds /proc/sys/fs/pipe-max-size
+    pass
+
+
+def format_size(num: float) -> str:
+  for unit in ['B', 'KiB', 'MiB', 'GiB']:
+    if abs(num) < 1024:
+      return f'{num:.1f} {unit}'
+    num /= 1024
+  return f'{num:.1f} TiB'
+
+
+@dataclass
+class BufferStats:
+  size: int
+  bytes: int = 0
+  duration: float = 0
+  # time-weighted fill level
+  fill_sum: float = 0
+  fill_max: int = 0
+  # receiver did not keep up
+  full_count: int = 0
+  full_time: float = 0
+  # sender did not keep up
+  empty_count: int = 0
+  empty_time: float = 0
+
+  @property
+  def fill_avg(self) -> float:
+    return self.fill_sum / self.duration if self.duration else 0
+
+  def __str__(self) -> str:
+    return (
+      f"{format_size(self.bytes)} through {format_size(self.size)} buffer in {self.duration:.1f}s, "
+      f"average fill {self.fill_avg / self.size:.0%}, max fill {self.fill_max / self.size:.0%}, "
+      f"full {self.full_count} times ({self.full_time:.1f}s), empty {self.empty_count} times ({self.empty_time:.1f}s)"
+    )
+
+
+class RingBuffer:
+  """
+  In-memory buffer stage between sender and receiver, similar to mbuffer.
+  Decouples stalls of either side: a reader thread fills the buffer from `source`,
+  a writer thread drains it into `sink`. Data is read into and written from the preallocated buffer
+  with `os.readv` and `os.write` on memoryviews, so it is not copied in Python.
+
+  The writer only starts draining an empty buffer once it is filled to the high watermark, or the source ended.
+  The reader only resumes filling a full buffer once it is drained to the low watermark.
+  Both watermarks are fractions of the size.
+  """
+  size: int
+  high: float
+  low: float
+  stats: BufferStats
+  error: Optional[BaseException]
+
+  def __init__(self, source: IO[bytes], sink: IO[bytes], size: int, high: float = 0, low: float = 1) -> None:
+    assert size > 0 and 0 <= high <= 1 and 0 <= low <= 1
+    self.source = source
+    self.sink = sink
+    self.size = size
+    self.high = high
+    self.low = low
+    self.stats = BufferStats(size=size)
+    self.error = None
+
+    self._buf = memoryview(bytearray(size))
+    self._start = 0  # read position of the writer
+    self._fill = 0
+    self._eof = False
+    self._closed = False
+    self._cond = threading.Condition()
+    self._last_update = 0.0
+    self._threads: list[threading.Thread] = []
+
+  def start(self) -> RingBuffer:
+    enlarge_pipe(self.source)
+    enlarge_pipe(self.sink)
+    self._started = self._last_update = time.monotonic()
+    self._threads = [
+      threading.Thread(target=self._run, args=(self._read,), daemon=True),
+      threading.Thread(target=self._run, args=(self._write,), daemon=True)
+    ]
+    for t in self._threads:
+      t.start()
+    return self
+
+  def join(self, timeout: Optional[float] = None) -> None:
+    for t in self._threads:
+      t.join(timeout)
+    self.stats.duration = time.monotonic() - self._started
+
+  def close(self) -> None:
+    """Stops both threads"""
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+
+  def _update(self, delta: int) -> None:
+    """Must be called with lock held"""
+    now = time.monotonic()
+    self.stats.fill_sum += self._fill * (now - self._last_update)
+    self._last_update = now
+    self._fill += delta
+    self.stats.fill_max = max(self.stats.fill_max, self._fill)
+    self._cond.notify_all()
+
+  def _run(self, target) -> None:
+    try:
+      target()
+    except BaseException as e:
+      if self.error is None:
+        self.error = e
+      self.close()
+
+  def _read(self) -> None:
+    try:
+      while True:
+        with self._cond:
+          if self._fill == self.size:
+            self.stats.full_count += 1
+            t = time.monotonic()
+            self._cond.wait_for(lambda: self._closed or self._fill <= min(self.low * self.size, self.size - 1))
+            self.stats.full_time += time.monotonic() - t
+          if self._closed:
+            return
+          # contiguous free region after the end of the data
+          end = (self._start + self._fill) % self.size
+          length = min(self.size - self._fill, self.size - end, CHUNK_SIZE)
+        n = os.readv(self.source.fileno(), [self._buf[end:end+length]])
+        if not n:
+          return
+        with self._cond:
+          self._update(n)
+    finally:
+      self.source.close()
+      with self._cond:
+        self._eof = True
+        self._cond.notify_all()
+
+  def _write(self) -> None:
+    try:
+      while True:
+        with self._cond:
+          if self._fill == 0 and not self._eof:
+            self.stats.empty_count += 1
+            t = time.monotonic()
+            self._cond.wait_for(lambda: self._closed or self._eof or self._fill >= max(self.high * self.size, 1))
+            self.stats.empty_time += time.monotonic() - t
+          if self._closed or (self._eof and self._fill == 0):
+            return
+          start = self._start
+          length = min(self._fill, self.size - start, CHUNK_SIZE)
+        n = os.write(self.sink.fileno(), self._buf[start:start+length])
+        with self._cond:
+          self._start = (start + n) % self.size
+          self.stats.bytes += n
+          self._update(-n)
+    finally:
+      self.sink.close()
+
+
+class Transform(Protocol):
+  def process(self, data: bytes) -> bytes: ...
+  def flush(self) -> bytes: ...
+
+
+@dataclass
+class PumpStats:
+  bytes_in: int = 0
+  bytes_out: int = 0
+  duration: float = 0
+  # time spent in the transform
+  busy: float = 0
+  # time spent waiting for rate limiters
+  throttled: float = 0
+
+  def __str__(self) -> str:
+    s = f"{format_size(self.bytes_in)} in, {format_size(self.bytes_out)} out in {self.duration:.1f}s"
+    if self.bytes_in != self.bytes_out and min(self.bytes_in, self.bytes_out):
+      # compression ratio, regardless of direction
+      s += f", ratio {max(self.bytes_in, self.bytes_out) / min(self.bytes_in, self.bytes_out):.2f}"
+    if self.duration:
+      s += f", {format_size(self.bytes_in / self.duration)}/s in, {format_size(self.bytes_out / self.duration)}/s out"
+    if self.busy:
+      s += f", {self.busy:.1f}s busy"
+    if self.throttled:
+      s += f", {self.throttled:.1f}s throttled"
+    return s
+
+
+class Pump:
+  """
+  Copies `source` to `sink` in a thread, optionally passing the data through a transform such as a compressor.
+  Without a transform, the data is spliced between the pipes where possible.
+  Counts bytes in both directions. Throughput is limited by all `limiters`, counting output bytes with `limit_output`
+  and input bytes otherwise.
+  """
+  stats: PumpStats
+  error: Optional[BaseException]
+
+  def __init__(self, source: IO[bytes], sink: IO[bytes], transform: Optional[Transform] = None, limiters: Sequence[RateLimiter] = (), limit_output: bool = False) -> None:
+    self.source = source
+    self.sink = sink
+    self.transform = transform
+    self.limiters = limiters
+    self.limit_output = limit_output
+    self.stats = PumpStats()
+    self.error = None
+    self._thread = threading.Thread(target=self._run, daemon=True)
+
+  def start(self) -> Pump:
+    enlarge_pipe(self.source)
+    enlarge_pipe(self.sink)
+    self._started = time.monotonic()
+    self._thread.start()
+    return self
+
+  def join(self, timeout: Optional[float] = None) -> None:
+    self._thread.join(timeout)
+    self.stats.duration = time.monotonic() - self._started
+
+  def _run(self) -> None:
+    try:
+      src, dst = self.source.fileno(), self.sink.fileno()
+      if self.transform is None and self._splice(src, dst):
+        return
+      while True:
+        data = os.read(src, CHUNK_SIZE)
+        eof = not data
+        self.stats.bytes_in += len(data)
+        n_in = len(data)
+        if self.transform is not None:
+          t = time.monotonic()
+          data = self.transform.flush() if eof else self.transform.process(data)
+          self.stats.busy += time.monotonic() - t
+        for limiter in self.limiters:
+          self.stats.throttled += limiter.acquire(len(data) if self.limit_output else n_in)
+        view = memoryview(data)
+        while view:
+          n = os.write(dst, view)
+          view = view[n:]
+        self.stats.bytes_out += len(data)
+        if eof:
+          return
+    except BaseException as e:
+      self.error = e
+    finally:
+      self.source.close()
+      self.sink.close()
+
+  def _splice(self, src: int, dst: int) -> bool:
+    """
+    Moves the data between the pipes in the kernel, without copying it through Python.
+    Returns False if splicing is not supported, e.g. if neither side is a pipe, in which case nothing was moved.
+    """
+    if not hasattr(os, 'splice'):
+      return False
+    while True:
+      try:
+        n = os.splice(src, dst, CHUNK_SIZE)
+      except OSError as e:
+        if self.stats.bytes_in == 0 and e.errno in (errno.EINVAL, errno.ENOSYS):
+          log.debug(f"Cannot splice, copying instead: {e}")
+          return False
+        raise
+      if not n:
+        return True
+      self.stats.bytes_in += n
+      self.stats.bytes_out += n
+      for limiter in self.limiters:
+        self.stats.throttled += limiter.acquire(n)
+
+
+class Tee:
+  """
+  Copies `source` to all `sinks` in a thread. Every chunk is written to all sinks before the next one is read,
+  so the slowest sink sets the pace. A sink that fails, e.g. because its receiver exited, is closed and dropped,
+  while the others continue. The tee only fails once all sinks failed. Throughput is limited by all `limiters`,
+  and the throughput into each sink additionally by its `sink_limiters`. Since the sinks are written in turn,
+  a limited sink slows down the others, unless they are buffered.
+  """
+  # bytes_out counts the bytes that reached at least one sink
+  stats: PumpStats
+  # errors of the dropped sinks by index
+  failed: dict[int, BaseException]
+  error: Optional[BaseException]
+
+  def __init__(self, source: IO[bytes], sinks: Sequence[IO[bytes]], limiters: Sequence[RateLimiter] = (), sink_limiters: Sequence[Sequence[RateLimiter]] = ()) -> None:
+    assert not sink_limiters or len(sink_limiters) == len(sinks)
+    self.source = source
+    self.sinks = sinks
+    self.limiters = limiters
+    self.sink_limiters = sink_limiters or [()] * len(sinks)
+    self.stats = PumpStats()
+    self.failed = {}
+    self.error = None
+    self._thread = threading.Thread(target=self._run, daemon=True)
+
+  def start(self) -> Tee:
+    enlarge_pipe(self.source)
+    for sink in self.sinks:
+      enlarge_pipe(sink)
+    self._started = time.monotonic()
+    self._thread.start()
+    return self
+
+  def join(self, timeout: Optional[float] = None) -> None:
+    self._thread.join(timeout)
+    self.stats.duration = time.monotonic() - self._started
+
+  def _drop(self, index: int, error: BaseException) -> None:
+    log.debug(f"Dropping sink {index} of tee: {error}")
+    self.failed[index] = error
+    try:
+      self.sinks[index].close()
+    except OSError:
+      pass
+
+  def _run(self) -> None:
+    try:
+      src = self.source.fileno()
+      while len(self.failed) < len(self.sinks):
+        data = os.read(src, CHUNK_SIZE)
+        if not data:
+          return
+        self.stats.bytes_in += len(data)
+        for limiter in self.limiters:
+          self.stats.throttled += limiter.acquire(len(data))
+        for i, sink in enumerate(self.sinks):
+          if i in self.failed:
+            continue
+          for limiter in self.sink_limiters[i]:
+            self.stats.throttled += limiter.acquire(len(data))
+          view = memoryview(data)
+          try:
+            while view:
+              n = os.write(sink.fileno(), view)
+              view = view[n:]
+          except OSError as e:
+            self._drop(i, e)
+        if len(self.failed) < len(self.sinks):
+          self.stats.bytes_out += len(data)
+      self.error = OSError(f"All {len(self.sinks)} sinks failed")
+    except BaseException as e:
+      self.error = e
+    finally:
+      self.source.close()
+      for i, sink in enumerate(self.sinks):
+        if i not in self.failed:
+          sink.close()
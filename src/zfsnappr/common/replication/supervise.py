@@ -0,0 +1,68 @@
+from __future__ import annotations
+from subprocess import Popen
+from collections.abc import Collection, Iterator
+import selectors
+import threading
+import logging
+import queue
+import os
+
+
+log = logging.getLogger(__name__)
+
+
+def iter_exits(procs: Collection[Popen]) -> Iterator[Popen]:
+  """
+  Yields the processes in the order in which they terminate, as soon as they do. Yielded processes are reaped.
+  Waits on pidfds if supported by the system, and in one thread per process otherwise.
+  """
+  pending = [p for p in procs if p.poll() is None]
+  yield from (p for p in procs if p not in pending)
+  if not pending:
+    return
+
+  pidfds: dict[int, Popen] = {}
+  if hasattr(os, 'pidfd_open'):
+    try:
+      for p in pending:
+        pidfds[os.pidfd_open(p.pid)] = p
+    except OSError as e:
+      # e.g. kernel older than 5.3
+      log.debug(f"Cannot open pidfd, waiting in threads instead: {e}")
+      for fd in pidfds:
+        os.close(fd)
+      pidfds = {}
+
+  if pidfds:
+    yield from _iter_exits_pidfd(pidfds)
+  else:
+    yield from _iter_exits_threads(pending)
+
+
+def _iter_exits_pidfd(pidfds: dict[int, Popen]) -> Iterator[Popen]:
+  """A pidfd becomes readable when its process terminates"""
+  sel = selectors.DefaultSelector()
+  try:
+    for fd, p in pidfds.items():
+      sel.register(fd, selectors.EVENT_READ, p)
+    while sel.get_map():
+      for key, _ in sel.select():
+        sel.unregister(key.fd)
+        os.close(key.fd)
+        key.data.wait()
+        yield key.data
+  finally:
+    for fd in list(sel.get_map()):
+      os.close(fd)
+    sel.close()
+
+
+def _iter_exits_threads(procs: Collection[Popen]) -> Iterator[Popen]:
+  exited: queue.SimpleQueue[Popen] = queue.SimpleQueue()
+  def _wait(p: Popen) -> None:
+    p.wait()
+    exited.put(p)
+  for p in procs:
+    threading.Thread(target=_wait, args=(p,), daemon=True).start()
+  for _ in procs:
+    yield exited.get()
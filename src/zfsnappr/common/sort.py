@@ -1,6 +1,8 @@
-from collections.abc import Collection
+from typing import overload
+from collections.abc import Iterable
 
 from zfsnappr.common.zfs import Snapshot
+from zfsnappr.common.table import SnapshotTable
 
 
 def _depth(dataset: str) -> int:
@@ -9,9 +11,15 @@ def _depth(dataset: str) -> int:
     return len(parts)
 
 
-def sort_snaps_by_time(snaps: Collection[Snapshot], reverse: bool = False) -> list[Snapshot]:
+@overload
+def sort_snaps_by_time(snaps: SnapshotTable, reverse: bool = False) -> SnapshotTable: ...
+@overload
+def sort_snaps_by_time(snaps: Iterable[Snapshot], reverse: bool = False) -> list[Snapshot]: ...
+def sort_snaps_by_time(snaps: Iterable[Snapshot], reverse: bool = False) -> list[Snapshot] | SnapshotTable:
+    if isinstance(snaps, SnapshotTable):
+        return snaps.sort_by_time(reverse)
     return list(sorted(
         snaps,
-        key=lambda s: (s.timestamp, _depth(s.dataset), s.dataset, s.guid),
+        key=lambda s: (s.creation, _depth(s.dataset), s.dataset, s.guid),
         reverse=reverse
     ))
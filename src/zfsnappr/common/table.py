@@ -0,0 +1,190 @@
+from __future__ import annotations
+from typing import Optional, Any, overload
+from collections.abc import Callable, Collection, Hashable, Iterable, Iterator, Sequence
+
+from .zfs import Snapshot
+
+try:
+  import numpy as np
+except ImportError:
+  # pure-Python fallback
+  np = None
+
+
+def has_numpy() -> bool:
+  return np is not None
+
+
+class SnapshotTable(Sequence[Snapshot]):
+  """
+  Columnar container for snapshots. Holds parallel columns for creation epoch, GUID, dataset id,
+  dataset depth, userrefs and tag set id, which are used for sorting, filtering and grouping.
+  With NumPy installed, the columns are NumPy arrays and these operations are vectorized.
+  Otherwise, the columns are plain lists.
+
+  Dataset ids are assigned in order of dataset names, so comparing ids is equivalent to comparing names.
+  Tables derived from each other share the dataset and tag set dictionaries.
+  """
+  rows: list[Snapshot]
+  epoch: Any
+  guid: Any
+  dataset_id: Any
+  depth: Any
+  userrefs: Any
+  tagset_id: Any
+
+  datasets: list[str]
+  tagsets: list[Optional[frozenset[str]]]
+
+  def __init__(self, rows: list[Snapshot], columns: dict[str, Any], datasets: list[str], tagsets: list[Optional[frozenset[str]]]) -> None:
+    self.rows = rows
+    self.epoch = columns['epoch']
+    self.guid = columns['guid']
+    self.dataset_id = columns['dataset_id']
+    self.depth = columns['depth']
+    self.userrefs = columns['userrefs']
+    self.tagset_id = columns['tagset_id']
+    self.datasets = datasets
+    self.tagsets = tagsets
+
+  @staticmethod
+  def from_snapshots(snapshots: Iterable[Snapshot]) -> SnapshotTable:
+    rows = list(snapshots)
+    datasets = sorted({s.dataset for s in rows})
+    dataset_ids = {d: i for i, d in enumerate(datasets)}
+    depths = [len(d.split('/')) for d in datasets]
+
+    tagsets: list[Optional[frozenset[str]]] = []
+    tagset_ids: dict[Optional[frozenset[str]], int] = {}
+    tagset_id: list[int] = []
+    for snap in rows:
+      tags = snap.tags
+      if (i := tagset_ids.get(tags)) is None:
+        i = tagset_ids[tags] = len(tagsets)
+        tagsets.append(tags)
+      tagset_id.append(i)
+
+    dataset_id = [dataset_ids[s.dataset] for s in rows]
+    columns: dict[str, Any] = dict(
+      epoch=[s.creation for s in rows],
+      guid=[s.guid for s in rows],
+      dataset_id=dataset_id,
+      depth=[depths[i] for i in dataset_id],
+      userrefs=[s.holds for s in rows],
+      tagset_id=tagset_id
+    )
+    if np is not None:
+      columns = {k: np.array(v, dtype=np.uint64 if k == 'guid' else np.int64) for k, v in columns.items()}
+    return SnapshotTable(rows, columns, datasets, tagsets)
+
+  def _columns(self) -> dict[str, Any]:
+    return dict(
+      epoch=self.epoch,
+      guid=self.guid,
+      dataset_id=self.dataset_id,
+      depth=self.depth,
+      userrefs=self.userrefs,
+      tagset_id=self.tagset_id
+    )
+
+  def take(self, indices: Sequence[int] | Any) -> SnapshotTable:
+    """Returns a new table with the rows at `indices`, in that order"""
+    if np is not None:
+      indices = np.asarray(indices, dtype=np.intp)
+      columns = {k: v[indices] for k, v in self._columns().items()}
+      indices = indices.tolist()
+    else:
+      columns = {k: [v[i] for i in indices] for k, v in self._columns().items()}
+    return SnapshotTable([self.rows[i] for i in indices], columns, self.datasets, self.tagsets)
+
+  def __len__(self) -> int:
+    return len(self.rows)
+
+  def __iter__(self) -> Iterator[Snapshot]:
+    return iter(self.rows)
+
+  @overload
+  def __getitem__(self, index: int) -> Snapshot: ...
+  @overload
+  def __getitem__(self, index: slice) -> SnapshotTable: ...
+  def __getitem__(self, index: int | slice) -> Snapshot | SnapshotTable:
+    if isinstance(index, slice):
+      return self.take(range(len(self))[index])
+    return self.rows[index]
+
+  def __repr__(self) -> str:
+    return f"SnapshotTable({len(self)} snapshots)"
+
+  # --- sorting ---
+
+  def argsort_by_time(self, reverse: bool = False) -> Sequence[int] | Any:
+    """
+    Sorts by (creation, depth, dataset, guid), like `sort_snaps_by_time`.
+    The sort is stable in both directions, just like `sorted`.
+    """
+    n = len(self)
+    if np is not None:
+      if not reverse:
+        return np.lexsort((self.guid, self.dataset_id, self.depth, self.epoch))
+      # stable descending sort: sort reversed input ascending, then reverse the result
+      order = np.lexsort((self.guid[::-1], self.dataset_id[::-1], self.depth[::-1], self.epoch[::-1]))
+      return (n - 1) - order[::-1]
+    return sorted(
+      range(n),
+      key=lambda i: (self.epoch[i], self.depth[i], self.dataset_id[i], self.guid[i]),
+      reverse=reverse
+    )
+
+  def sort_by_time(self, reverse: bool = False) -> SnapshotTable:
+    return self.take(self.argsort_by_time(reverse))
+
+  # --- filtering ---
+
+  def mask_tagsets(self, predicate: Callable[[Optional[frozenset[str]]], bool]) -> Sequence[bool] | Any:
+    """Evaluates `predicate` once per distinct tag set"""
+    matches = [predicate(t) for t in self.tagsets]
+    if np is not None:
+      return np.array(matches, dtype=bool)[self.tagset_id]
+    return [matches[i] for i in self.tagset_id]
+
+  def mask_datasets(self, datasets: Collection[str]) -> Sequence[bool] | Any:
+    datasets = set(datasets)
+    matches = [d in datasets for d in self.datasets]
+    if np is not None:
+      return np.array(matches, dtype=bool)[self.dataset_id]
+    return [matches[i] for i in self.dataset_id]
+
+  def mask_shortnames(self, shortnames: Collection[str]) -> Sequence[bool] | Any:
+    shortnames = set(shortnames)
+    matches = [s.shortname in shortnames for s in self.rows]
+    if np is not None:
+      return np.array(matches, dtype=bool)
+    return matches
+
+  def filter(self, *masks: Sequence[bool] | Any) -> SnapshotTable:
+    """Keeps the rows for which all masks are true"""
+    if not masks:
+      return self
+    if np is not None:
+      return self.take(np.flatnonzero(np.logical_and.reduce(masks)))
+    return self.take([i for i, m in enumerate(zip(*masks)) if all(m)])
+
+  # --- grouping ---
+
+  def group_by_dataset(self) -> dict[str, SnapshotTable]:
+    """Groups are ordered by first occurrence, rows keep their order within a group"""
+    if np is not None:
+      order = np.argsort(self.dataset_id, kind='stable')
+      ids, starts = np.unique(self.dataset_id[order], return_index=True)
+      parts = np.split(order, starts[1:])
+      groups = {self.datasets[i]: part for i, part in zip(ids.tolist(), parts)}
+      # order groups by first occurrence
+      return {d: self.take(groups[d]) for d in sorted(groups, key=lambda d: groups[d][0])}
+    return self.group_by(lambda s: s.dataset)
+
+  def group_by[T: Hashable](self, get_group: Callable[[Snapshot], T]) -> dict[T, SnapshotTable]:
+    """Generic grouping. Groups are ordered by first occurrence."""
+    indices: dict[T, list[int]] = {}
+    for i, snap in enumerate(self.rows):
+      indices.setdefault(get_group(snap), []).append(i)
+    return {k: self.take(v) for k, v in indices.items()}
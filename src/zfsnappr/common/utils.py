@@ -1,18 +1,38 @@
-from typing import Callable, Optional, Literal
+from typing import Callable, Optional, Literal, overload
 from dataclasses import dataclass
-from collections.abc import Collection, Hashable
+from collections.abc import Collection, Hashable, Iterable
 import string
 
-from .zfs import Snapshot, LocalZfsCli, RemoteZfsCli, ZfsCli
+from .zfs import Snapshot, LocalZfsCli, RemoteZfsCli, ChannelZfsCli, ZfsCli
+from .table import SnapshotTable
+from .cache import SnapshotCache
 
 
-def group_snaps_by[T: Hashable](snapshots: Collection[Snapshot], get_group: Callable[[Snapshot], T]) -> dict[T, list[Snapshot]]:
-  groups: dict[T, list[Snapshot]] = {get_group(s): [] for s in snapshots}
+@overload
+def group_snaps_by[T: Hashable](snapshots: SnapshotTable, get_group: Callable[[Snapshot], T]) -> dict[T, SnapshotTable]: ...
+@overload
+def group_snaps_by[T: Hashable](snapshots: Iterable[Snapshot], get_group: Callable[[Snapshot], T]) -> dict[T, list[Snapshot]]: ...
+def group_snaps_by[T: Hashable](snapshots: Iterable[Snapshot], get_group: Callable[[Snapshot], T]) -> dict[T, list[Snapshot]] | dict[T, SnapshotTable]:
+  """Groups are ordered by first occurrence. Consumes `snapshots` in a single pass."""
+  if isinstance(snapshots, SnapshotTable):
+    return snapshots.group_by(get_group)
+  groups: dict[T, list[Snapshot]] = {}
   for snap in snapshots:
-    groups[get_group(snap)].append(snap)
+    groups.setdefault(get_group(snap), []).append(snap)
   return groups
 
 
+@overload
+def group_snaps_by_dataset(snapshots: SnapshotTable) -> dict[str, SnapshotTable]: ...
+@overload
+def group_snaps_by_dataset(snapshots: Iterable[Snapshot]) -> dict[str, list[Snapshot]]: ...
+def group_snaps_by_dataset(snapshots: Iterable[Snapshot]) -> dict[str, list[Snapshot]] | dict[str, SnapshotTable]:
+  """Like `group_snaps_by` with the dataset as group, but vectorized for tables"""
+  if isinstance(snapshots, SnapshotTable):
+    return snapshots.group_by_dataset()
+  return group_snaps_by(snapshots, lambda s: s.dataset)
+
+
 class DatasetParseError(Exception):
   def __init__(self, spec: str) -> None:
     super().__init__(f"Invalid dataset spec '{spec}'")
@@ -94,18 +114,27 @@ def parse_dataset_spec(spec: str):
   )
 
 
-def get_zfs_cli(value: str | None) -> tuple[ZfsCli, str | None]:
+def get_zfs_cli(value: str | None, shell_channel: bool = False, snapshot_cache: str | None = None) -> tuple[ZfsCli, str | None]:
+  """
+  With `shell_channel`, text commands are sent through a single long-lived shell.
+  With `snapshot_cache`, snapshot listings are cached in the SQLite database at that path.
+  """
   if value is None:
-    return LocalZfsCli(), None
-
-  config = parse_dataset_spec(value)
-  if config.host:
-    cli = RemoteZfsCli(
-      host=config.host,
-      user=config.user,
-      port=config.port
-    )
+    cli, dataset = LocalZfsCli(), None
   else:
-    cli = LocalZfsCli()
-
-  return cli, config.dataset
+    config = parse_dataset_spec(value)
+    if config.host:
+      cli = RemoteZfsCli(
+        host=config.host,
+        user=config.user,
+        port=config.port
+      )
+    else:
+      cli = LocalZfsCli()
+    dataset = config.dataset
+
+  if shell_channel:
+    cli = ChannelZfsCli(cli)
+  if snapshot_cache is not None:
+    cli.cache = SnapshotCache(snapshot_cache)
+  return cli, dataset
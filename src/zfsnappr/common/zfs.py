@@ -1,13 +1,23 @@
 from __future__ import annotations
 from datetime import datetime
-from subprocess import Popen, PIPE, CalledProcessError
+from subprocess import Popen, PIPE, DEVNULL, CalledProcessError
 from typing import Optional, IO, Literal
-from collections.abc import Collection
+from collections.abc import Collection, Iterable, Iterator
 from dataclasses import dataclass
 from abc import ABC, abstractmethod
-from itertools import batched
 from enum import StrEnum
 import logging
+import threading
+import tempfile
+import shutil
+import atexit
+import time
+import os
+import sys
+import shlex
+import secrets
+
+from .cache import SnapshotCache
 
 
 log = logging.getLogger(__name__)
@@ -23,6 +33,11 @@ class ZfsProperty:
   MOUNTPOINT = 'mountpoint'
   CANMOUNT = 'canmount'
   TYPE = 'type'
+  SNAPSHOTS_CHANGED = 'snapshots_changed'
+  COMPRESSION = 'compression'
+  RECORDSIZE = 'recordsize'
+  ENCRYPTION = 'encryption'
+  RECEIVE_RESUME_TOKEN = 'receive_resume_token'
   CUSTOM_TAGS = 'zfsnappr:tags'  # the user property used to store and read tags
 
 
@@ -33,34 +48,131 @@ class ZfsDatasetType(StrEnum):
   BOOKMARK = 'bookmark'
 
 
+# Conservative upper bound for the length of a single command line. The real ARG_MAX is usually much larger,
+# but remote commands are additionally limited by the ssh transport and the remote shell.
+MAX_ARGS_LENGTH = 100_000
+
+
+def batched_by_length(items: Iterable[str], max_length: int = MAX_ARGS_LENGTH, sep_length: int = 1) -> Iterator[list[str]]:
+  """Splits items into batches whose joined length, including separators, stays below `max_length`.
+  An item that is longer than `max_length` on its own forms a batch by itself."""
+  batch: list[str] = []
+  length = 0
+  for item in items:
+    if batch and length + sep_length + len(item) > max_length:
+      yield batch
+      batch, length = [], 0
+    length += len(item) + (sep_length if batch else 0)
+    batch.append(item)
+  if batch:
+    yield batch
+
+
 # properties that will always be fetched
 REQUIRED_PROPS = [ZfsProperty.NAME, ZfsProperty.CREATION, ZfsProperty.GUID, ZfsProperty.CUSTOM_TAGS, ZfsProperty.USERREFS, ZfsProperty.TYPE]
+_REQUIRED_PROPS_SET = frozenset(REQUIRED_PROPS)
+
+
+# Tag sets are shared between all snapshots with the same raw tags property value
+_TAGSETS: dict[str, Optional[frozenset[str]]] = {}
+
+def _parse_tags(value: str) -> Optional[frozenset[str]]:
+  try:
+    return _TAGSETS[value]
+  except KeyError:
+    pass
+  if value == '-':
+    tags = None
+  else:
+    tags = frozenset(sys.intern(t) for t in value.split(',') if t)  # ignore empty tags
+  _TAGSETS[value] = tags
+  return tags
 
 
 class Snapshot:
-  properties: dict[str, str]
+  """
+  Memory-lean snapshot representation.
+  The creation time is stored as epoch seconds, tags and timestamp are decoded on first access.
+  Dataset names and tag strings are interned, so that they are shared between snapshots.
+  Properties that are not required are only stored if they were explicitly requested.
+  """
+  __slots__ = ('dataset', 'shortname', 'guid', 'creation', 'holds', '_tags_raw', '_timestamp', '_extra')
 
   dataset: str
   shortname: str
   guid: int
-  timestamp: datetime
-  tags: Optional[set[str]]
+  creation: int
   holds: int
+  _tags_raw: str
+  _timestamp: Optional[datetime]
+  _extra: Optional[dict[str, str]]
 
   def __init__(self, properties: dict[str, str]):
     P = ZfsProperty
     ps = properties
 
-    self.properties = ps
-    self.dataset, self.shortname = ps[P.NAME].split('@')
+    dataset, self.shortname = ps[P.NAME].split('@')
+    self.dataset = sys.intern(dataset)
     self.guid = int(ps[P.GUID])
-    self.timestamp = datetime.fromtimestamp(int(ps[P.CREATION]))
+    self.creation = int(ps[P.CREATION])
     self.holds = int(ps[P.USERREFS])
+    self._tags_raw = sys.intern(ps[P.CUSTOM_TAGS])
+    self._timestamp = None
+    extra = {p: v for p, v in ps.items() if p not in _REQUIRED_PROPS_SET}
+    self._extra = extra or None
+
+  @staticmethod
+  def from_row(values: list[str], extra_properties: list[str] = []) -> Snapshot:
+    """Fast path for parsing. `values` are ordered like `REQUIRED_PROPS`, followed by `extra_properties`."""
+    name, creation, guid, tags, userrefs, _type = values[:len(REQUIRED_PROPS)]
+    dataset, shortname = name.split('@')
+    snap = object.__new__(Snapshot)
+    snap.dataset = sys.intern(dataset)
+    snap.shortname = shortname
+    snap.guid = int(guid)
+    snap.creation = int(creation)
+    snap.holds = int(userrefs)
+    snap._tags_raw = sys.intern(tags)
+    snap._timestamp = None
+    snap._extra = dict(zip(extra_properties, values[len(REQUIRED_PROPS):])) if extra_properties else None
+    return snap
+
+  def _copy(self, dataset: str, shortname: str) -> Snapshot:
+    snap = object.__new__(Snapshot)
+    snap.dataset = sys.intern(dataset)
+    snap.shortname = shortname
+    snap.guid = self.guid
+    snap.creation = self.creation
+    snap.holds = self.holds
+    snap._tags_raw = self._tags_raw
+    snap._timestamp = self._timestamp
+    snap._extra = self._extra
+    return snap
 
-    if ps[P.CUSTOM_TAGS] == '-':
-      self.tags = None
-    else:
-      self.tags = set(t for t in ps[P.CUSTOM_TAGS].split(',') if t)  # ignore empty tags
+  @property
+  def tags(self) -> Optional[frozenset[str]]:
+    return _parse_tags(self._tags_raw)
+
+  @property
+  def timestamp(self) -> datetime:
+    if self._timestamp is None:
+      self._timestamp = datetime.fromtimestamp(self.creation)
+    return self._timestamp
+
+  @property
+  def properties(self) -> dict[str, str]:
+    P = ZfsProperty
+    props = {
+      P.NAME: self.longname,
+      P.CREATION: str(self.creation),
+      P.GUID: str(self.guid),
+      P.CUSTOM_TAGS: self._tags_raw,
+      P.USERREFS: str(self.holds),
+      P.TYPE: ZfsDatasetType.SNAPSHOT.value
+    }
+    if self._extra is not None:
+      props |= self._extra
+    return props
 
   def __repr__(self) -> str:
     return f"Snapshot({self.properties})"
@@ -70,14 +182,10 @@ class Snapshot:
     return f'{self.dataset}@{self.shortname}'
   
   def with_dataset(self, dataset: str) -> Snapshot:
-    new_props = self.properties.copy()
-    new_props[ZfsProperty.NAME] = f"{dataset}@{self.shortname}"
-    return Snapshot(new_props)
+    return self._copy(dataset, self.shortname)
 
   def with_shortname(self, shortname: str) -> Snapshot:
-    new_props = self.properties.copy()
-    new_props[ZfsProperty.NAME] = f"{self.dataset}@{shortname}"
-    return Snapshot(new_props)
+    return self._copy(self.dataset, shortname)
 
 
 @dataclass(eq=True, frozen=True)
@@ -104,6 +212,13 @@ class Dataset:
   def __repr__(self) -> str:
     return f"Dataset({self.properties})"
 
+@dataclass
+class Inventory:
+  """Datasets of a hierarchy and their snapshots, in the order listed by zfs"""
+  datasets: dict[str, Dataset]
+  snapshots: dict[str, list[Snapshot]]
+
+
 @dataclass(eq=True, frozen=True)
 class Hold:
   snap_longname: str
@@ -114,28 +229,110 @@ class Hold:
 Each method call should correspond to exactly one CLI call
 """
 class ZfsCli(ABC):
+  is_remote: bool = False
+  cache: Optional[SnapshotCache] = None
+
   @abstractmethod
   def _start_command(self, cmd: list[str], stdin=None, stdout=None, stderr=None, text=False) -> Popen: ...
 
+  def close(self) -> None:
+    """Releases resources held by the CLI. The CLI must not be used afterwards."""
+    pass
+
+  def _start_pipeline(self, cmds: list[list[str]], stdin=None, stdout=None, stderr=None) -> Popen:
+    """Runs the commands as a shell pipeline. Fails if any command fails."""
+    return self._start_command(['sh', '-c', _pipeline_script(cmds)], stdin=stdin, stdout=stdout, stderr=stderr)
+
+  def has_command(self, name: str) -> bool:
+    p = self._start_pipeline([['command', '-v', name]], stdout=DEVNULL, stderr=DEVNULL)
+    return p.wait() == 0
+
   def _run_text_command(self, cmd: list[str]) -> str:
-    p: Popen[str] = self._start_command(cmd, stdout=PIPE, text=True)
-    stdout, _ = p.communicate()
+    """stderr is passed through, and attached to the raised error if the command fails"""
+    p: Popen[str] = self._start_command(cmd, stdout=PIPE, stderr=PIPE, text=True)
+    stdout, stderr = p.communicate()
+    if stderr:
+      sys.stderr.write(stderr)
+      sys.stderr.flush()
     if p.returncode > 0:
-      raise CalledProcessError(p.returncode, cmd=p.args, output=stdout)
+      raise CalledProcessError(p.returncode, cmd=p.args, output=stdout, stderr=stderr)
     return stdout
 
-  def send_snapshot_async(self, snapshot_fullname: str, base_fullname: Optional[str] = None) -> Popen[bytes]:
-    cmd = ['zfs', 'send', '-v']
-    if base_fullname:
-      cmd += ['-i', base_fullname]
-    cmd += [snapshot_fullname]
+  def _stream_text_command(self, cmd: list[str]) -> Iterator[str]:
+    """Yields output lines as they arrive. The process is terminated if the iterator is not exhausted."""
+    p: Popen[str] = self._start_command(cmd, stdout=PIPE, text=True)
+    assert p.stdout is not None
+    try:
+      yield from p.stdout
+    finally:
+      p.stdout.close()
+      if p.poll() is None:
+        p.terminate()
+      p.wait()
+    if p.returncode > 0:
+      raise CalledProcessError(p.returncode, cmd=p.args)
+
+  def _run_text_commands(self, cmds: list[list[str]]) -> list[str]:
+    """
+    Runs commands in order and returns their outputs. Stops at the first failing command.
+    Subclasses may send all commands at once instead of waiting for each command to complete.
+    """
+    return [self._run_text_command(cmd) for cmd in cmds]
+
+  def _invalidate_cache(self, datasets: Collection[str], recursive: bool = False) -> None:
+    """Must be called for all datasets whose snapshots are changed by this CLI"""
+    if self.cache is not None:
+      self.cache.invalidate(datasets, recursive=recursive)
+
+  def batch(self) -> ZfsBatch:
+    """Collects metadata changes so that they can be applied with `_run_text_commands`"""
+    return ZfsBatch(self)
+
+  def send_snapshot_async(self, snapshot_fullname: str, base_fullname: Optional[str] = None, intermediates: bool = False, recursive: bool = False, flags: str = '', filter_cmd: Optional[list[str]] = None) -> Popen[bytes]:
+    """
+    With `intermediates`, all snapshots between base and snapshot are sent as well.
+    With `recursive`, a replication stream of the dataset and all its descendants is sent.
+    `flags` are additional single-letter send flags, e.g. 'cLe'.
+    `filter_cmd` is a command that the stream is piped through on the sending host, e.g. a compressor.
+    """
+    cmd = ['zfs', 'send', '-v', '-P', *_send_args(snapshot_fullname, base_fullname, intermediates, recursive, flags)]
+    if filter_cmd:
+      return self._start_pipeline([cmd, filter_cmd], stdout=PIPE, stderr=PIPE)
+    return self._start_command(cmd, stdout=PIPE, stderr=PIPE)
+
+  def send_resume_async(self, token: str, filter_cmd: Optional[list[str]] = None) -> Popen[bytes]:
+    """Resumes an interrupted send. Flags and snapshots are encoded in the token."""
+    cmd = ['zfs', 'send', '-v', '-P', '-t', token]
+    if filter_cmd:
+      return self._start_pipeline([cmd, filter_cmd], stdout=PIPE, stderr=PIPE)
     return self._start_command(cmd, stdout=PIPE, stderr=PIPE)
 
-  def receive_snapshot_async(self, dataset: str, stdin: IO[bytes], properties: dict[str, str] = {}) -> Popen[bytes]:
+  def estimate_send_sizes(self, sends: Collection[tuple[str, Optional[str], bool]], flags: str = '') -> list[int]:
+    """
+    Estimates the stream sizes of (snapshot, base, intermediates) sends with `zfs send -n`.
+    Nothing is sent. All commands are run as one batch.
+    """
+    cmds = [['zfs', 'send', '-n', '-v', '-P', *_send_args(snapshot, base, intermediates, False, flags)] for snapshot, base, intermediates in sends]
+    return [_parse_send_estimate(out) for out in self._run_text_commands(cmds)]
+
+  def receive_snapshot_async(self, dataset: str, stdin: IO[bytes] | int, properties: dict[str, str] = {}, exclude_properties: Collection[str] = (), filter_cmd: Optional[list[str]] = None, resumable: bool = False, recursive: bool = False) -> Popen[bytes]:
+    """
+    `exclude_properties` are properties in the stream that are not received.
+    `filter_cmd` is a command that the stream is piped through on the receiving host, e.g. a decompressor.
+    With `resumable`, an interrupted receive leaves a resume token on the dataset.
+    With `recursive`, the stream is a replication stream that also changes the descendants of dataset.
+    """
     cmd = ['zfs', 'receive', '-u']
+    if resumable:
+      cmd += ['-s']
     for property, value in properties.items():
       cmd += ['-o', f'{property}={value}']
+    for property in exclude_properties:
+      cmd += ['-x', property]
     cmd += [dataset]
+    self._invalidate_cache([dataset], recursive=recursive)
+    if filter_cmd:
+      return self._start_pipeline([filter_cmd, cmd], stdin=stdin)
     return self._start_command(cmd, stdin=stdin)
 
   # TrueNAS CORE 13.0 does not support holds -p, so we do not fetch timestamp
@@ -148,7 +345,7 @@ class ZfsCli(ABC):
       return set()
 
     holds: set[Hold] = set()
-    for batch in batched(snapshots_fullnames, 5000):  # limit how many snapshots can be processed in a single command
+    for batch in batched_by_length(snapshots_fullnames):  # limit the length of a single command
       lines = self._run_text_command(['zfs', 'holds', '-H', *batch]).splitlines()
       for line in lines:
         snapname, tag, _ = line.split('\t', 2)
@@ -170,14 +367,10 @@ class ZfsCli(ABC):
     return any((s.tag == tag for s in self.get_holds([snapshot_fullname])))
 
   def hold(self, snapshots_fullnames: Collection[str], tag: str) -> None:
-    if not snapshots_fullnames:
-      return
-    self._run_text_command(['zfs', 'hold', tag, *snapshots_fullnames])
+    self.batch().hold(snapshots_fullnames, tag).run()
 
   def release_hold(self, snapshots_fullnames: Collection[str], tag: str) -> None:
-    if not snapshots_fullnames:
-      return
-    self._run_text_command(['zfs', 'release', tag, *snapshots_fullnames])
+    self.batch().release_hold(snapshots_fullnames, tag).run()
 
   def get_pool_from_dataset(self, dataset: str) -> Pool:
     name = dataset.split('/')[0]
@@ -204,19 +397,59 @@ class ZfsCli(ABC):
     return next(iter(self.get_datasets([name], properties)))
 
   
-  def get_all_datasets(self, properties: Collection[str] = []) -> list[Dataset]:
+  def get_all_datasets(self, properties: Collection[str] = [], datasets: Collection[str] | None = None, recursive: bool = False) -> list[Dataset]:
+    """Lists all datasets on the host, or only the given datasets and optionally their descendants"""
     properties = list(dict.fromkeys(REQUIRED_PROPS + list(properties)))  # eliminate duplicates
 
     cmd = ['zfs', 'list', '-Hp', '-o', ','.join(properties)]
+    if datasets is not None:
+      if not datasets:
+        return []
+      cmd += ['-r', *datasets] if recursive else list(datasets)
     lines = self._run_text_command(cmd).splitlines()
 
-    datasets: list[Dataset] = []
+    result: list[Dataset] = []
     for line in lines:
       props = {p: v for p, v in zip(properties, line.split('\t'))}
-      datasets.append(Dataset(props))
+      result.append(Dataset(props))
   
-    return datasets
+    return result
   
+  def get_inventory(self, root: str, recursive: bool = True, properties: Collection[str] = []) -> Inventory:
+    """
+    Lists the root dataset, its descendants and all their snapshots with a single command.
+    `properties` are additional dataset properties. If root does not exist, the inventory is empty.
+    """
+    properties = list(dict.fromkeys(REQUIRED_PROPS + list(properties)))  # eliminate duplicates
+    cmd = ['zfs', 'list', '-Hp', '-t', 'filesystem,volume,snapshot', '-o', ','.join(properties)]
+    cmd += ['-r', root] if recursive else ['-d', '1', root]
+    try:
+      lines = self._run_text_command(cmd).splitlines()
+    except CalledProcessError:
+      if not self.dataset_exists(root):
+        return Inventory({}, {})
+      raise
+
+    inventory = Inventory({}, {})
+    for line in lines:
+      values = line.split('\t')
+      if values[len(REQUIRED_PROPS)-1] == ZfsDatasetType.SNAPSHOT:
+        snap = Snapshot.from_row(values)
+        if snap.dataset in inventory.snapshots:
+          inventory.snapshots[snap.dataset].append(snap)
+      else:
+        dataset = Dataset(dict(zip(properties, values)))
+        if not recursive and dataset.name != root:
+          # children are listed with -d 1, but not their snapshots
+          continue
+        inventory.datasets[dataset.name] = dataset
+        inventory.snapshots[dataset.name] = []
+    return inventory
+
+  def dataset_exists(self, name: str) -> bool:
+    p = self._start_command(['zfs', 'list', '-H', '-o', 'name', name], stdout=DEVNULL, stderr=DEVNULL)
+    return p.wait() == 0
+
   def create_snapshot(self, fullname: str, recursive: bool = False, properties: dict[str, str] = {}) -> None:
     cmd = ['zfs', 'snapshot']
     if recursive:
@@ -224,11 +457,17 @@ class ZfsCli(ABC):
     for property, value in properties.items():
       cmd += ['-o', f'{property}={value}']
     cmd += [fullname]
-    self._run_text_command(cmd)
+    try:
+      self._run_text_command(cmd)
+    finally:
+      self._invalidate_cache([fullname.split('@')[0]], recursive=recursive)
   
   def rename_snapshot(self, fullname: str, new_shortname: str) -> None:
     cmd = ['zfs', 'rename', fullname, new_shortname]
-    self._run_text_command(cmd)
+    try:
+      self._run_text_command(cmd)
+    finally:
+      self._invalidate_cache([fullname.split('@')[0]])
 
   def get_snapshots(self, fullnames: Collection[str], properties: Collection[str] = []) -> list[Snapshot]:
     if not fullnames:
@@ -250,44 +489,209 @@ class ZfsCli(ABC):
     recursive: bool = False,
     exclude_datasets: Collection[str] | None = None,
     properties: Collection[str] = [],
+    cached: bool = True
   ) -> list[Snapshot]:
+    return list(self.iter_snapshots(datasets, recursive, exclude_datasets, properties, cached))
+
+  def iter_snapshots(
+    self,
+    datasets: Collection[str] | None = None,
+    recursive: bool = False,
+    exclude_datasets: Collection[str] | None = None,
+    properties: Collection[str] = [],
+    cached: bool = True
+  ) -> Iterator[Snapshot]:
+    """
+    Like `get_all_snapshots`, but parses and yields snapshots while the output is still arriving.
+    Without `cached`, the snapshot cache is bypassed. Cached holds counts and tags may be outdated,
+    so code that relies on them, such as hold reconciliation, must not use the cache.
+    """
     properties = list(dict.fromkeys(REQUIRED_PROPS + list(properties)))  # eliminate duplicates
     exclude_datasets = set(exclude_datasets) if exclude_datasets else set()
     if datasets is not None and not datasets:
       # empty dataset container
-      return []
+      return
+
+    if cached and self.cache is not None and properties == REQUIRED_PROPS:
+      try:
+        yield from self._iter_snapshots_cached(datasets, recursive, exclude_datasets)
+        return
+      except _CacheUnsupported:
+        log.warning(f"Snapshot cache requires the '{ZfsProperty.SNAPSHOTS_CHANGED}' property, which is not supported. Disabling cache.")
+        self.cache = None
 
     cmd = ['zfs', 'list', '-Hp', '-t', 'snapshot', '-o', ','.join(properties)]
     if recursive:
       cmd += ['-r']
     if datasets is not None:
       cmd += list(datasets)
-    lines = self._run_text_command(cmd).splitlines()
-
-    snapshots: list[Snapshot] = []
-    for line in lines:
-      props = {p: v for p, v in zip(properties, line.split('\t'))}
-      snapshots.append(Snapshot(props))
-
-    # Filter snapshots
-    snapshots = [s for s in snapshots if s.dataset not in exclude_datasets]
-
-    return snapshots
 
+    assert properties[:len(REQUIRED_PROPS)] == REQUIRED_PROPS
+    extra_properties = properties[len(REQUIRED_PROPS):]
+    for line in self._stream_text_command(cmd):
+      # Filter snapshots before parsing them
+      if exclude_datasets and line.split('@', 1)[0] in exclude_datasets:
+        continue
+      yield Snapshot.from_row(line.rstrip('\n').split('\t'), extra_properties)
+
+  def _iter_snapshots_cached(self, datasets: Collection[str] | None, recursive: bool, exclude_datasets: Collection[str]) -> Iterator[Snapshot]:
+    """
+    Lists datasets with their `snapshots_changed` property and serves snapshots of unchanged datasets from the cache.
+    Only snapshots of changed datasets are listed.
+    """
+    assert self.cache is not None
+    listed_at = time.time()
+
+    pool_guids = {
+      name: int(guid) for name, guid in
+      (line.split('\t') for line in self._run_text_command(['zpool', 'list', '-Hp', '-o', 'name,guid']).splitlines())
+    }
+
+    cmd = ['zfs', 'list', '-Hp', '-t', 'filesystem,volume', '-o', f'{ZfsProperty.NAME},{ZfsProperty.GUID},{ZfsProperty.SNAPSHOTS_CHANGED}']
+    if recursive:
+      cmd += ['-r']
+    if datasets is not None:
+      cmd += list(datasets)
+    try:
+      dataset_rows = [line.split('\t') for line in self._run_text_command(cmd).splitlines()]
+    except CalledProcessError:
+      # check whether the failure was caused by an unsupported property
+      pool = next(iter(pool_guids), None)
+      try:
+        if pool is not None:
+          self._run_text_command(['zfs', 'list', '-H', '-d', '0', '-o', ZfsProperty.SNAPSHOTS_CHANGED, pool])
+      except CalledProcessError:
+        raise _CacheUnsupported()
+      raise
+
+    cached: dict[str, list[str]] = {}
+    stale: list[tuple[str, tuple[int, int], str]] = []
+    for name, guid, changed in dataset_rows:
+      if name in exclude_datasets:
+        continue
+      key = (pool_guids[name.split('/')[0]], int(guid))
+      rows = self.cache.get(*key, name, changed) if changed != '-' else None
+      if rows is None:
+        stale.append((name, key, changed))
+      else:
+        cached[name] = rows
+    log.debug(f"Serving snapshots of {len(cached)} datasets from cache, listing {len(stale)} datasets")
+
+    # list snapshots of changed datasets only
+    listed: dict[str, list[str]] = {name: [] for name, _, _ in stale}
+    for batch in batched_by_length([name for name, _, _ in stale]):
+      cmd = ['zfs', 'list', '-Hp', '-t', 'snapshot', '-o', ','.join(REQUIRED_PROPS), '-d', '1', *batch]
+      for line in self._stream_text_command(cmd):
+        line = line.rstrip('\n')
+        listed[line.split('@', 1)[0]].append(line)
+
+    for name, key, changed in stale:
+      # snapshots_changed has a resolution of one second, so changes in the second of listing might have been missed
+      if changed != '-' and int(changed) < listed_at - 1:
+        self.cache.put(*key, name, changed, listed[name])
+
+    for name, _, _ in dataset_rows:
+      for row in cached.get(name) or listed.get(name) or []:
+        yield Snapshot.from_row(row.split('\t'))
 
   def set_tags(self, snap_fullname: str, tags: Collection[str]):
-    cmd = ['zfs', 'set', f"{ZfsProperty.CUSTOM_TAGS}={','.join(tags)}", snap_fullname]
-    self._run_text_command(cmd)
+    self.batch().set_tags(snap_fullname, tags).run()
 
   def destroy_snapshots(self, dataset: str, snapshots_shortnames: Collection[str]) -> None:
     if not snapshots_shortnames:
       return
     shortnames_str = ','.join(snapshots_shortnames)
-    self._run_text_command(['zfs', 'destroy', f'{dataset}@{shortnames_str}'])
+    try:
+      self._run_text_command(['zfs', 'destroy', f'{dataset}@{shortnames_str}'])
+    finally:
+      self._invalidate_cache([dataset])
+
+  def abort_receive(self, dataset: str) -> None:
+    """Discards the partially received state of an interrupted resumable receive"""
+    try:
+      self._run_text_command(['zfs', 'receive', '-A', dataset])
+    finally:
+      self._invalidate_cache([dataset])
 
   def rollback(self, snap_fullname: str) -> None:
     cmd = ['zfs', 'rollback', snap_fullname]
-    self._run_text_command(cmd)
+    try:
+      self._run_text_command(cmd)
+    finally:
+      self._invalidate_cache([snap_fullname.split('@')[0]])
+
+
+def _send_args(snapshot_fullname: str, base_fullname: Optional[str], intermediates: bool, recursive: bool, flags: str) -> list[str]:
+  args = ['-R'] if recursive else []
+  args += [f'-{f}' for f in flags]
+  if base_fullname:
+    args += ['-I' if intermediates else '-i', base_fullname]
+  return args + [snapshot_fullname]
+
+
+def _parse_send_estimate(output: str) -> int:
+  """Total size from `zfs send -nvP` output, or the sum of the individual streams if there is no total"""
+  total = 0
+  for line in output.splitlines():
+    fields = line.split('\t')
+    if fields[0] == 'size':
+      return int(fields[1])
+    if fields[0] in ('full', 'incremental'):
+      total += int(fields[-1])
+  return total
+
+
+def _pipeline_script(cmds: list[list[str]]) -> str:
+  # pipefail is not supported by all shells, so a failing command kills the shell instead
+  return ' | '.join([*(f'{{ {shlex.join(c)} || kill $$; }}' for c in cmds[:-1]), shlex.join(cmds[-1])])
+
+
+class _CacheUnsupported(Exception):
+  pass
+
+
+class ZfsBatch:
+  """
+  Sequence of metadata changes that is applied in order by a single `run`.
+  If a change fails, the remaining changes are not applied.
+  """
+  cli: ZfsCli
+  cmds: list[list[str]]
+  datasets: set[str]
+
+  def __init__(self, cli: ZfsCli) -> None:
+    self.cli = cli
+    self.cmds = []
+    self.datasets = set()
+
+  def __len__(self) -> int:
+    return len(self.cmds)
+
+  def hold(self, snapshots_fullnames: Collection[str], tag: str) -> ZfsBatch:
+    for batch in batched_by_length(snapshots_fullnames):
+      self.cmds.append(['zfs', 'hold', tag, *batch])
+    self.datasets.update(s.split('@')[0] for s in snapshots_fullnames)
+    return self
+
+  def release_hold(self, snapshots_fullnames: Collection[str], tag: str) -> ZfsBatch:
+    for batch in batched_by_length(snapshots_fullnames):
+      self.cmds.append(['zfs', 'release', tag, *batch])
+    self.datasets.update(s.split('@')[0] for s in snapshots_fullnames)
+    return self
+
+  def set_tags(self, snap_fullname: str, tags: Collection[str]) -> ZfsBatch:
+    self.cmds.append(['zfs', 'set', f"{ZfsProperty.CUSTOM_TAGS}={','.join(tags)}", snap_fullname])
+    self.datasets.add(snap_fullname.split('@')[0])
+    return self
+
+  def run(self) -> None:
+    try:
+      if self.cmds:
+        self.cli._run_text_commands(self.cmds)
+    finally:
+      self.cli._invalidate_cache(self.datasets)
+      self.cmds = []
+      self.datasets = set()
 
 
 class LocalZfsCli(ZfsCli):
@@ -296,19 +700,229 @@ class LocalZfsCli(ZfsCli):
 
 
 class RemoteZfsCli(ZfsCli):
-  ssh_command: list[str]
-
-  def __init__(self, host: str, user: Optional[str], port: Optional[int]) -> None:
+  """
+  Runs commands on a remote host via ssh.
+  With `multiplex`, a single master connection is opened on first use and shared by all commands,
+  so that only the first command pays for the TCP and key exchange handshake.
+  The master is closed on exit. If that does not happen, it exits on its own after being idle for `CONTROL_PERSIST`.
+  """
+  is_remote = True
+  CONTROL_PERSIST = '10m'
+  host: str
+  ssh_options: list[str]
+  multiplex: bool
+
+  _control_dir: Optional[str] = None
+  _master_failed: bool = False
+  _num_commands: int = 0
+
+  def __init__(self, host: str, user: Optional[str], port: Optional[int], multiplex: bool = True) -> None:
     super().__init__()
 
-    cmd = ['ssh']
+    opts: list[str] = []
     if user is not None:
-      cmd += ['-l', user]
+      opts += ['-l', user]
     if port is not None:
-      cmd += ['-p', str(port)]
-    cmd += [host]
-    self.ssh_command = cmd
+      opts += ['-p', str(port)]
+    self.host = host
+    self.ssh_options = opts
+    self.multiplex = multiplex
+    self._lock = threading.Lock()
+
+  @property
+  def ssh_command(self) -> list[str]:
+    cmd = ['ssh', *self.ssh_options]
+    if self._control_dir is not None:
+      cmd += ['-o', 'ControlMaster=no', '-o', f'ControlPath={self._control_path}']
+    return cmd + [self.host]
+
+  @property
+  def _control_path(self) -> str:
+    assert self._control_dir is not None
+    return os.path.join(self._control_dir, 'master')
 
   def _start_command(self, cmd: list[str], stdin=None, stdout=None, stderr=None, text=False) -> Popen:
+    if self.multiplex:
+      self._ensure_master()
+    with self._lock:
+      self._num_commands += 1
     cmd = self.ssh_command + cmd
     return Popen(cmd, stdin=stdin, stdout=stdout, stderr=stderr, text=text)
+
+  def _start_pipeline(self, cmds: list[list[str]], stdin=None, stdout=None, stderr=None) -> Popen:
+    # ssh joins its arguments with spaces, so the script must be quoted for the remote login shell
+    return self._start_command(['sh', '-c', shlex.quote(_pipeline_script(cmds))], stdin=stdin, stdout=stdout, stderr=stderr)
+
+  def _ensure_master(self) -> None:
+    with self._lock:
+      if self._control_dir is not None or self._master_failed:
+        return
+
+      # private directory, only accessible by the current user
+      control_dir = tempfile.mkdtemp(prefix='zfsnappr-ssh-')
+      control_path = os.path.join(control_dir, 'master')
+      cmd = [
+        'ssh', *self.ssh_options,
+        '-o', 'ControlMaster=yes',
+        '-o', f'ControlPath={control_path}',
+        '-o', f'ControlPersist={self.CONTROL_PERSIST}',
+        '-N', '-f', self.host
+      ]
+      start = time.monotonic()
+      # the forked master must not hold on to our stdout and stderr, e.g. a pipe to `tee`
+      p = Popen(cmd, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+      if p.wait() != 0:
+        log.warning(f"Failed to open ssh master connection to '{self.host}', using separate connections")
+        shutil.rmtree(control_dir, ignore_errors=True)
+        self._master_failed = True
+        return
+
+      self._control_dir = control_dir
+      log.info(f"Opened ssh master connection to '{self.host}' in {time.monotonic() - start:.2f}s")
+      atexit.register(self.close)
+
+  def close(self) -> None:
+    with self._lock:
+      if self._control_dir is None:
+        return
+      cmd = ['ssh', *self.ssh_options, '-o', f'ControlPath={self._control_path}', '-O', 'exit', self.host]
+      p = Popen(cmd, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+      if p.wait() != 0:
+        log.warning(f"Failed to close ssh master connection to '{self.host}'")
+      shutil.rmtree(self._control_dir, ignore_errors=True)
+      self._control_dir = None
+      atexit.unregister(self.close)
+      log.info(f"Closed ssh master connection to '{self.host}' after {self._num_commands} multiplexed commands")
+
+
+class ChannelZfsCli(ZfsCli):
+  """
+  Runs text commands through a single long-lived shell that is started via `base`.
+  All commands of a `_run_text_commands` call are written to the shell at once and their stdout, stderr and
+  exit status are read back afterwards, separated by a random marker. Streaming commands like send and
+  receive are still started separately via `base`.
+
+  With a `LocalZfsCli` as base, this runs a local `sh`, which is useful for testing.
+  The shell is closed on exit, or by `close`.
+  """
+  base: ZfsCli
+  shell: list[str]
+
+  _proc: Optional[Popen[bytes]] = None
+  _buffer: bytearray
+
+  def __init__(self, base: ZfsCli, shell: list[str] = ['sh']) -> None:
+    super().__init__()
+    self.base = base
+    self.shell = shell
+    self.is_remote = base.is_remote
+    self._marker = secrets.token_hex(16).encode()
+    self._lock = threading.Lock()
+    self._buffer = bytearray()
+
+  def _start_command(self, cmd: list[str], stdin=None, stdout=None, stderr=None, text=False) -> Popen:
+    return self.base._start_command(cmd, stdin=stdin, stdout=stdout, stderr=stderr, text=text)
+
+  def _start_pipeline(self, cmds: list[list[str]], stdin=None, stdout=None, stderr=None) -> Popen:
+    return self.base._start_pipeline(cmds, stdin=stdin, stdout=stdout, stderr=stderr)
+
+  def _run_text_command(self, cmd: list[str]) -> str:
+    return self._run_text_commands([cmd])[0]
+
+  def _run_text_commands(self, cmds: list[list[str]]) -> list[str]:
+    if not cmds:
+      return []
+    with self._lock:
+      proc = self._ensure_shell()
+      assert proc.stdin is not None
+
+      # Commands are skipped once a command failed. Their stdin is redirected so they cannot consume the script.
+      script = ['__f=0']
+      for cmd in cmds:
+        script += [
+          f'if [ "$__f" = 0 ]; then {shlex.join(cmd)} </dev/null 2>"$__e"; __s=$?; else __s=skip; : >"$__e"; fi',
+          f'printf \'\\n%s %s\\n\' {self._marker.decode()} "$__s"',
+          'cat "$__e"',
+          f'printf \'\\n%s\\n\' {self._marker.decode()}',
+          '[ "$__s" = 0 ] || __f=1'
+        ]
+      data = ('\n'.join(script) + '\n').encode()
+
+      # write from a separate thread, since the shell may block on output before the whole script was read
+      def _write():
+        try:
+          assert proc.stdin is not None
+          proc.stdin.write(data)
+          proc.stdin.flush()
+        except (BrokenPipeError, ValueError):
+          # the shell exited, or was closed after it exited
+          pass
+      writer = threading.Thread(target=_write, daemon=True)
+      writer.start()
+
+      outputs: list[str] = []
+      error: Optional[CalledProcessError] = None
+      for cmd in cmds:
+        stdout = self._read_until(b'\n' + self._marker + b' ')
+        status = self._read_until(b'\n').decode()
+        stderr = self._read_until(b'\n' + self._marker + b'\n')
+        if status == 'skip':
+          continue
+        if stderr:
+          sys.stderr.buffer.write(stderr)
+          sys.stderr.flush()
+        if status != '0' and error is None:
+          error = CalledProcessError(int(status), cmd=cmd, output=stdout.decode(), stderr=stderr.decode())
+        outputs.append(stdout.decode())
+      writer.join()
+
+    if error is not None:
+      raise error
+    return outputs
+
+  def _ensure_shell(self) -> Popen[bytes]:
+    if self._proc is not None:
+      return self._proc
+    start = time.monotonic()
+    proc = self.base._start_command(self.shell, stdin=PIPE, stdout=PIPE)
+    assert proc.stdin is not None
+    proc.stdin.write(b'__e=$(mktemp) || exit 1\ntrap \'rm -f "$__e"\' EXIT\n')
+    proc.stdin.flush()
+    self._proc = proc
+    self._buffer = bytearray()
+    log.debug(f"Started command channel in {time.monotonic() - start:.2f}s")
+    atexit.register(self.close)
+    return proc
+
+  def _stop_shell(self) -> None:
+    """Closes stdin, so that the shell removes its temporary file and exits, and waits for it"""
+    assert self._proc is not None and self._proc.stdin is not None and self._proc.stdout is not None
+    try:
+      self._proc.stdin.close()
+    except BrokenPipeError:
+      pass
+    self._proc.wait()
+    self._proc.stdout.close()
+    self._proc = None
+    atexit.unregister(self.close)
+
+  def _read_until(self, delimiter: bytes) -> bytes:
+    assert self._proc is not None and self._proc.stdout is not None
+    start = 0
+    while (i := self._buffer.find(delimiter, start)) < 0:
+      chunk = self._proc.stdout.read1(65536)
+      if not chunk:
+        self._stop_shell()
+        raise RuntimeError(f"Command channel closed unexpectedly")
+      # only search the new data, plus a possible partial delimiter at the end of the old data
+      start = max(0, len(self._buffer) - len(delimiter) + 1)
+      self._buffer += chunk
+    res = bytes(self._buffer[:i])
+    del self._buffer[:i+len(delimiter)]
+    return res
+
+  def close(self) -> None:
+    with self._lock:
+      if self._proc is not None:
+        self._stop_shell()
+    self.base.close()
@@ -0,0 +1,65 @@
+from __future__ import annotations
+from subprocess import CalledProcessError
+import os
+
+import pytest
+
+from zfsnappr.common.zfs import ChannelZfsCli, LocalZfsCli
+
+
+@pytest.fixture
+def cli():
+  cli = ChannelZfsCli(LocalZfsCli())
+  yield cli
+  cli.close()
+
+
+def tempfile_of(cli: ChannelZfsCli) -> str:
+  # eval runs in the channel shell itself, which holds the path of its stderr file
+  return cli._run_text_command(['eval', 'echo "$__e"']).strip()
+
+
+def test_outputs(cli: ChannelZfsCli):
+  assert cli._run_text_commands([['echo', 'a'], ['printf', '%s\\n', 'b c', 'd']]) == ['a\n', 'b c\nd\n']
+  # the shell is reused
+  proc = cli._proc
+  assert cli._run_text_command(['echo', 'e']) == 'e\n'
+  assert cli._proc is proc
+
+
+def test_failure_skips_remaining(cli: ChannelZfsCli, tmp_path):
+  marker = tmp_path / 'ran'
+  with pytest.raises(CalledProcessError) as e:
+    cli._run_text_commands([['echo', 'a'], ['sh', '-c', 'echo err >&2; exit 3'], ['touch', str(marker)]])
+  assert e.value.returncode == 3
+  assert e.value.stderr == 'err\n'
+  assert not marker.exists()
+  # the channel is still usable
+  assert cli._run_text_command(['echo', 'b']) == 'b\n'
+
+
+def test_commands_do_not_read_script(cli: ChannelZfsCli):
+  assert cli._run_text_commands([['cat'], ['echo', 'a']]) == ['', 'a\n']
+
+
+def test_close(cli: ChannelZfsCli):
+  path = tempfile_of(cli)
+  proc = cli._proc
+  assert proc is not None and os.path.exists(path)
+  cli.close()
+  assert cli._proc is None
+  assert proc.returncode == 0
+  assert not os.path.exists(path)
+
+
+def test_shell_exits(cli: ChannelZfsCli):
+  path = tempfile_of(cli)
+  proc = cli._proc
+  assert proc is not None
+  with pytest.raises(RuntimeError):
+    cli._run_text_command(['exit'])
+  # the exited shell is reaped, and a new one is started on the next command
+  assert cli._proc is None
+  assert proc.returncode is not None
+  assert not os.path.exists(path)
+  assert cli._run_text_command(['echo', 'a']) == 'a\n'
@@ -0,0 +1,35 @@
+from __future__ import annotations
+import random
+
+import pytest
+
+from zfsnappr.common.zfs import Snapshot
+from zfsnappr.common.table import SnapshotTable
+from zfsnappr.common.utils import group_snaps_by, group_snaps_by_dataset
+
+pytest.importorskip('numpy')
+
+
+DATASETS = ['pool', 'pool/a', 'pool/a/b', 'pool/b', 'tank/x']
+
+
+def random_snapshots(rng: random.Random) -> list[Snapshot]:
+  return [
+    Snapshot.from_row([f'{rng.choice(DATASETS)}@snap{i}', str(rng.randint(0, 1000)), str(i), '-', '0', 'snapshot'])
+    for i in range(rng.randint(0, 100))
+  ]
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_group_by_dataset(seed: int):
+  """Vectorized grouping matches generic grouping, in group order and row order"""
+  snaps = random_snapshots(random.Random(seed))
+  table = SnapshotTable.from_snapshots(snaps)
+  expected = {ds: list(group) for ds, group in group_snaps_by(snaps, lambda s: s.dataset).items()}
+  grouped = group_snaps_by_dataset(table)
+  assert all(isinstance(group, SnapshotTable) for group in grouped.values())
+  assert {ds: list(group) for ds, group in grouped.items()} == expected
+  assert list(grouped) == list(expected)
+  # columns are taken along with the rows
+  for group in grouped.values():
+    assert list(group.guid) == [s.guid for s in group]
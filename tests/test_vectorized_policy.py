@@ -0,0 +1,113 @@
+from __future__ import annotations
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+import random
+import time
+import os
+import re
+
+import pytest
+
+from zfsnappr.common.zfs import Snapshot
+from zfsnappr.commands.prune.policy import KeepPolicy, apply_policy
+from zfsnappr.commands.prune.vectorized_policy import apply_policy_vectorized
+
+pytest.importorskip('numpy')
+
+
+TIMEZONES = ['UTC', 'Europe/Berlin', 'America/New_York', 'Australia/Lord_Howe', 'Asia/Kolkata']
+
+# DST transitions, as epoch seconds
+TRANSITIONS = [
+  1711846800,  # 2024-03-31 01:00 UTC, Europe
+  1729990800,  # 2024-10-27 01:00 UTC, Europe
+  1710054000,  # 2024-03-10 07:00 UTC, America/New_York
+  1730613600,  # 2024-11-03 06:00 UTC, America/New_York
+  1712415600,  # 2024-04-07 01:30 local, Australia/Lord_Howe (30 minute shift)
+  1735603200,  # 2024-12-31 00:00 UTC, new year
+]
+
+
+@pytest.fixture(params=TIMEZONES)
+def timezone(request):
+  old = os.environ.get('TZ')
+  os.environ['TZ'] = request.param
+  time.tzset()
+  yield request.param
+  if old is None:
+    del os.environ['TZ']
+  else:
+    os.environ['TZ'] = old
+  time.tzset()
+
+
+def random_history(rng: random.Random) -> list[Snapshot]:
+  """Snapshots spread over a few years, clustered around DST transitions, with some equal creation times"""
+  creations: list[int] = []
+  for _ in range(rng.randint(0, 150)):
+    r = rng.random()
+    if r < 0.4:
+      creations.append(rng.choice(TRANSITIONS) + rng.randint(-3 * 3600, 3 * 3600))
+    elif r < 0.5 and creations:
+      creations.append(rng.choice(creations))
+    else:
+      creations.append(rng.randint(1640995200, 1767225600))  # 2022 to 2025
+  rng.shuffle(creations)
+  tags = ['-', '', 'daily', 'weekly', 'daily,weekly', 'manual']
+  return [
+    Snapshot.from_row([f'pool/fs@snap{i}', str(creation), str(i), rng.choice(tags), '0', 'snapshot'])
+    for i, creation in enumerate(creations)
+  ]
+
+
+def random_policy(rng: random.Random) -> KeepPolicy:
+  def count() -> int:
+    return rng.choice([0, 0, 0, 1, 2, 3, 5, 10, -1])
+  def within() -> relativedelta:
+    if rng.random() < 0.6:
+      return relativedelta()
+    return relativedelta(**{rng.choice(['hours', 'days', 'weeks', 'months', 'years']): rng.randint(1, 30)})
+  return KeepPolicy(
+    last=count(),
+    hourly=count(),
+    daily=count(),
+    weekly=count(),
+    monthly=count(),
+    yearly=count(),
+    within=within(),
+    within_hourly=within(),
+    within_daily=within(),
+    within_weekly=within(),
+    within_monthly=within(),
+    within_yearly=within(),
+    name=re.compile(r'snap1\d') if rng.random() < 0.2 else None,
+    tags=frozenset(rng.sample(['daily', 'weekly', 'monthly'], rng.randint(1, 2))) if rng.random() < 0.2 else frozenset()
+  )
+
+
+def names(snaps: list[Snapshot]) -> list[str]:
+  return [s.shortname for s in snaps]
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_matches_apply_policy(timezone: str, seed: int):
+  rng = random.Random(f'{timezone}-{seed}')
+  # snapshots cache their timestamp, so they are created after the time zone is set
+  snaps = random_history(rng)
+  policy = random_policy(rng)
+  now = datetime.fromtimestamp(rng.choice([rng.choice(TRANSITIONS) + rng.randint(-7200, 7200), rng.randint(1640995200, 1798761600)]))
+
+  keep, destroy = apply_policy(snaps, policy, now=now)
+  keep_vec, destroy_vec = apply_policy_vectorized(snaps, policy, now=now)
+  assert names(keep_vec) == names(keep)
+  assert names(destroy_vec) == names(destroy)
+
+
+def test_equal_creation_times(timezone: str):
+  snaps = [
+    Snapshot.from_row([f'pool/fs@snap{i}', str(1711846800 + 1800 * (i // 3)), str(i), '-', '0', 'snapshot'])
+    for i in range(30)
+  ]
+  for policy in [KeepPolicy(last=4), KeepPolicy(hourly=3), KeepPolicy(daily=-1), KeepPolicy(within_hourly=relativedelta(hours=5))]:
+    now = datetime.fromtimestamp(1711846800 + 86400)
+    assert apply_policy_vectorized(snaps, policy, now=now) == apply_policy(snaps, policy, now=now)